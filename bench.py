@@ -0,0 +1,612 @@
+#!/usr/bin/env python3
+
+#
+#    CFNS - Rijkswaterstaat CIV, Delft © 2022 <cfns@rws.nl>
+#
+#    Copyright 2022 Bastiaan Teeuwen <bastiaan@mkcl.nl>
+#
+#    This file is part of cap-dab-server
+#
+#    cap-dab-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    cap-dab-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
+#
+
+"""
+Data path microbenchmarks
+
+Measures the CRC, MSC Data Group, Packet and FEC builders and a full data stream with FEC (input file to output FIFO)
+for inputs ranging from 20 bytes to 1 MB. Exits with a non-zero status if the data path, including FEC, can't sustain a
+packet mode subchannel of the specified bitrate in real time.
+
+Also measures the latency of ODR-DabMux remote control commands against a local remote control, the time it takes to
+parse, write and snapshot multiplexer configs with many services, and simulates the switch latency and underrun rate of
+the ZMQ input buffering profiles for various amounts of network jitter.
+
+This only measures performance, correctness is checked by the unit tests in tests/.
+"""
+
+import argparse                         # For parsing command line arguments
+from configparser import ConfigParser   # For creating a server config
+import copy                             # For comparing snapshots to copies
+import os                               # For file I/O
+import random                           # For simulating network jitter
+import shutil                           # For removing the temporary directory
+import sys                              # For the exit status
+import tempfile                         # For creating temporary input and output files
+import threading                        # For reading the output FIFO in the background
+import time                             # For timing the benchmarks
+import tracemalloc                      # For measuring memory allocations
+import zmq                              # For benchmarking the ODR-DabMux remote control
+import utils
+import dab.buffering as buffering
+import dab.data as data
+from dab.boost_info_parser import BoostInfoParser
+from dab.muxctl import MuxControlClient
+from dab.procmgr import ODRProcessManager
+from dab.streamscfg import StreamsConfig
+
+# Input sizes
+SIZES = (20, 200, 2000, 20000, 200000, 1000000)
+
+# Highest bitrate (kbit/s) that can be configured for a subchannel
+MAX_BITRATE = 192
+
+# Minimum time to run each benchmark for
+MIN_TIME = 0.2
+
+def _count_packets(packets) -> int:
+    """ Count the number of packets in a sequence of packets """
+
+    count = 0
+    offset = 0
+
+    while offset < len(packets):
+        offset += data.PacketBuilder.PACKET_LENGTH[packets[offset] >> 6]
+        count += 1
+
+    return count
+
+def _measure(func, *args) -> tuple:
+    """
+    Run func repeatedly for at least MIN_TIME seconds.
+
+    Return a tuple with the time per call in seconds and the peak traced memory of a single call in bytes
+    """
+
+    # Warm up, and measure allocations separately as tracing slows everything down considerably
+    func(*args)
+
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        func(*args)
+        calls += 1
+
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_TIME:
+            return elapsed / calls, peak
+
+def _report(name:str, size:int, duration:float, packets:int, nbytes:int, peak:int) -> float:
+    """ Print a single benchmark result, return the throughput in bytes per second """
+
+    rate = nbytes / duration
+    print(f'{name:<8}{size:>10}{packets / duration:>14.0f}{rate / 1e6:>10.2f}{peak / max(packets, 1):>14.1f}')
+
+    return rate
+
+def bench_crc(size:int) -> float:
+    packet = os.urandom(data.PacketBuilder.PACKET_LENGTH[-1] - 2)
+    count = max(1, size // len(packet))
+
+    def run():
+        for _ in range(count):
+            data._crc16_int(packet)
+
+    duration, peak = _measure(run)
+    return _report('crc', size, duration, count, count * len(packet), peak)
+
+def bench_group(size:int) -> float:
+    message = os.urandom(size)
+    builder = data.MSCDataGroupBuilder()
+
+    # Count the packets the data groups result in, so the results can be compared
+    packets = sum(_count_packets(data.PacketBuilder(1000).build(g)) for g in builder.build(message))
+
+    duration, peak = _measure(builder.build, message)
+    return _report('group', size, duration, packets, size, peak)
+
+def bench_packet(size:int) -> float:
+    groups = data.MSCDataGroupBuilder().build(os.urandom(size))
+    builder = data.PacketBuilder(1000)
+
+    packets = sum(_count_packets(builder.build(g)) for g in groups)
+
+    def run():
+        for g in groups:
+            builder.build(g)
+
+    duration, peak = _measure(run)
+    return _report('packet', size, duration, packets, sum(len(g) for g in groups), peak)
+
+def bench_fec(size:int) -> float:
+    """
+    Measure the FEC builder. Calculating the parity of a full ADT (2256 bytes of packets) and building its FEC packets
+    takes about 0.4 ms (5-6 MB/s), a 192 kbit/s subchannel fills an ADT every 4 frames
+    """
+
+    fec = data.PacketFEC()
+    packets = data.PacketBuilder(1000).build(data.MSCDataGroupBuilder().build(os.urandom(size))[0])
+    count = _count_packets(packets)
+
+    def run():
+        offset = 0
+        while offset < len(packets):
+            length = data.PacketBuilder.PACKET_LENGTH[packets[offset] >> 6]
+            fec.add(memoryview(packets)[offset:offset + length])
+            offset += length
+
+    duration, peak = _measure(run)
+    return _report('fec', size, duration, count, len(packets), peak)
+
+def bench_stream(size:int, bitrate:int, engine:data.DABDataEngine, tmpdir:str) -> float:
+    """ Send an input file through a data stream with FEC to an output FIFO, as fast as possible (without pacing) """
+
+    infile = f'{tmpdir}/input-{size}'
+    with open(infile, 'wb') as f:
+        f.write(os.urandom(size))
+
+    output = utils.create_fifo(f'{tmpdir}/output-{size}')
+
+    srvcfg = ConfigParser()
+    srvcfg['general'] = {'logdir': tmpdir}
+    streamcfg = ConfigParser()
+    streamcfg['bench'] = {'input_type': 'file', 'input': infile, 'bitrate': str(bitrate), 'fec': 'yes'}
+
+    stream = data.DABDataStream(srvcfg, 'bench', streamcfg['bench'], output, engine)
+
+    # Start a local reader, odr-dabmux normally reads the FIFO
+    def reader():
+        with open(output, 'rb', buffering=0) as f:
+            while f.read(65536):
+                pass
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+
+    # Start the stream so it opens the output, then take it out of the engine to send frames back to back instead of
+    # one every 24 ms
+    stream.start()
+    while not stream.status()['data']['connected']:
+        time.sleep(0.01)
+    engine.procmgr.call(engine.remove, stream)
+
+    def run():
+        # The input file is queued again once everything has been sent, send it once
+        stream.tick()
+        while stream.pacer.pending() > 0:
+            stream.tick()
+
+    run()
+    before = stream.status()['data']
+    run()
+    after = stream.status()['data']
+
+    frames = after['frames'] - before['frames']
+    packets = after['packets'] - before['packets']
+
+    duration, peak = _measure(run)
+
+    stream.join()
+    thread.join()
+
+    return _report('stream', size, duration, packets, frames * stream.pacer.frame_size, peak)
+
+def _mux_server(sock):
+    """ Minimal ODR-DabMux remote control, replying to every command """
+
+    while True:
+        try:
+            msg = sock.recv_multipart()
+        except zmq.ContextTerminated:
+            break
+
+        sock.send(b'ok' if msg[0] in (b'ping', b'set') else b'0')
+
+    sock.close()
+
+def _report_latency(name:str, commands:int, duration:float):
+    print(f'{name:<16}{commands:>10}{commands / duration:>14.0f}{duration / commands * 1e6:>14.1f}')
+
+def bench_mux(tmpdir:str, commands:int):
+    """ Measure the latency of remote control commands, with the old ping before every command and with the client """
+
+    context = zmq.Context()
+    endpoint = f'ipc://{tmpdir}/rc'
+
+    server = context.socket(zmq.REP)
+    server.bind(endpoint)
+    thread = threading.Thread(target=_mux_server, args=(server,), daemon=True)
+    thread.start()
+
+    print(f'{"name":<16}{"commands":>10}{"commands/s":>14}{"latency us":>14}')
+
+    # REQ socket sending a ping before every command
+    sock = context.socket(zmq.REQ)
+    sock.connect(endpoint)
+
+    start = time.perf_counter()
+    for _ in range(commands):
+        sock.send(b'ping')
+        sock.recv_multipart()
+        sock.send_multipart([b'get', b'alarm', b'active'])
+        sock.recv_multipart()
+    _report_latency('req+ping', commands, time.perf_counter() - start)
+
+    sock.close()
+
+    # The client, from a single thread and shared between multiple threads, bypassing the mirror
+    client = MuxControlClient(context, endpoint)
+
+    start = time.perf_counter()
+    for _ in range(commands):
+        client.get('alarm', 'active', cached=False)
+    _report_latency('client', commands, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(commands):
+        client.get('alarm', 'active')
+    _report_latency('client mirror', commands, time.perf_counter() - start)
+
+    # A batch of 9 commands, pipelined in a single round trip
+    params = [('alarm', 'active', '1'), *((f'srv-{i}', 'label', 'Alert,Alert') for i in range(8))]
+
+    start = time.perf_counter()
+    for _ in range(commands // len(params)):
+        client.set_many(params, force=True)
+    _report_latency('client batch', commands // len(params) * len(params), time.perf_counter() - start)
+
+    def worker():
+        for _ in range(commands // 4):
+            client.get('alarm', 'active', cached=False)
+
+    workers = [threading.Thread(target=worker) for _ in range(4)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    _report_latency('client x4', commands // 4 * 4, time.perf_counter() - start)
+
+    client.close()
+    context.term()
+    thread.join()
+
+def _simulate(jitter:float, profile:str, adaptive:bool, duration:float) -> tuple:
+    """
+    Simulate a ZMQ input of odr-dabmux, fed with AAC superframes (5 frames every 120 ms) that are delayed in order by
+    an exponentially distributed network delay with a mean of jitter seconds. odr-dabmux takes a frame every 24 ms.
+
+    Return a tuple with the switch latency (time until the input starts streaming) and the mean latency in seconds,
+    the number of underruns per hour and the final prebuffering
+    """
+
+    rng = random.Random(1)
+    tuner = buffering.BufferTuner(profile)
+    interval = round(2 / 0.024)                 # Telemetry samples every 2 seconds
+
+    def delay():
+        return rng.expovariate(1 / jitter) if jitter > 0 else 0
+
+    frames = int(duration / 0.024)
+    superframe = 0
+    arrival = delay()
+
+    fill = 0
+    streaming = False
+    switch = None
+    underruns = 0
+    latency = 0
+    streamed = 0
+
+    window_underruns = 0
+    window_fill = None
+
+    for tick in range(frames):
+        now = tick * 0.024
+
+        # Receive all superframes that arrived before this frame, the input buffer drops what doesn't fit
+        while arrival <= now:
+            fill = min(fill + 5, tuner.buffer)
+            superframe += 1
+            arrival = max(arrival, superframe * 0.12 + delay())
+
+        if not streaming:
+            if fill >= tuner.prebuffering:
+                streaming = True
+                if switch is None:
+                    switch = now
+        elif fill == 0:
+            streaming = False
+            underruns += 1
+            window_underruns += 1
+
+        if streaming:
+            fill -= 1
+            latency += fill
+            streamed += 1
+            window_fill = fill if window_fill is None else min(window_fill, fill)
+
+        if adaptive and tick % interval == interval - 1:
+            tuner.update(window_underruns, window_fill)
+            window_underruns = 0
+            window_fill = None
+
+    return switch, latency / max(streamed, 1) * 0.024, underruns * 3600 / duration, tuner.prebuffering
+
+def bench_buffer(duration:float):
+    """ Compare the switch latency and underrun rate of the buffering profiles, fixed and tuned """
+
+    print(f'{"profile":<20}{"jitter ms":>10}{"switch ms":>10}{"latency ms":>12}{"underruns/h":>13}{"prebuf":>8}')
+
+    for jitter in (0, 0.02, 0.1, 0.3):
+        for profile in buffering.PROFILES:
+            for adaptive in (False, True):
+                switch, latency, underruns, prebuffering = _simulate(jitter, profile, adaptive, duration)
+                name = f'{profile}{" tuned" if adaptive else ""}'
+                print(f'{name:<20}{jitter * 1000:>10.0f}{switch * 1000:>10.0f}{latency * 1000:>12.0f}'
+                      f'{underruns:>13.1f}{prebuffering:>8}')
+
+def _mux_config(services:int) -> str:
+    """
+    Generate an ODR-DabMux config in the style of the examples that come with ODR-DabMux, with comments, inline braces
+    and quoted strings, with the specified number of services (each with a subchannel and a component)
+    """
+
+    lines = [
+        '; This is an example configuration file that illustrates',
+        '; the structure of the configuration.',
+        'general {',
+        '    dabmode 1 ; Transmission mode I',
+        '    nbframes 0',
+        '    syslog false',
+        '    tist false',
+        '    managementport 12720',
+        '}',
+        'remotecontrol',
+        '{',
+        '    zmqendpoint "ipc:///tmp/rc.sock"',
+        '}',
+        'ensemble {',
+        '    id 0x8FFF',
+        '    ecc 0xE3',
+        '    local-time-offset auto',
+        '    label "DAB Ensemble; \\"main\\""',
+        '    shortlabel DAB',
+        '    announcements {',
+        '        alarm {',
+        '            cluster 1',
+        '            flags {',
+        '                Alarm true',
+        '            }',
+        '            subchannel sub-0',
+        '        }',
+        '    }',
+        '}',
+        'services {'
+    ]
+
+    for i in range(services):
+        lines += [f'    srv-{i} {{', f'        id 0x{0x8000 + i:04X}', f'        label "Service {i}"',
+                  f'        shortlabel "Srv{i}"', '        pty 3 ; Information', '        announcements {',
+                  '            Alarm true', '            clusters "1"', '        }', '    }']
+
+    lines += ['}', 'subchannels {']
+    for i in range(services):
+        lines += [f'    sub-{i} {{', '        type dabplus', f'        inputuri "ipc:///tmp/sub-{i}.zmq"',
+                  '        inputproto zmq', '        bitrate 96', f'        id {i}', '        protection 3',
+                  '        zmq-buffer 40', '        zmq-prebuffering 20', '    }']
+
+    lines += ['}', 'components {']
+    for i in range(services):
+        lines += [f'    comp-{i}', '    {', f'        service srv-{i}', f'        subchannel sub-{i}',
+                  '        type 2', '    }']
+
+    lines += ['}', 'outputs {', '    stdout "fifo:///dev/stdout?type=raw"', '}', '']
+
+    return '\n'.join(lines)
+
+def bench_parse(tmpdir:str, services:list):
+    """ Measure the time it takes to parse and write a multiplexer config, and to look up values in it """
+
+    print(f'{"services":>8}{"lines":>10}{"parse ms":>12}{"lines/s":>14}{"write ms":>12}{"file ms":>10}'
+          f'{"same ms":>10}{"tree KiB":>10}{"lookup us":>11}')
+
+    for count in services:
+        config = _mux_config(count)
+        path = f'{tmpdir}/dabmux-{count}.mux'
+        with open(path, 'w') as f:
+            f.write(config)
+
+        def parse():
+            parser = BoostInfoParser()
+            parser.read(path)
+            return parser
+
+        parser = parse()
+        duration, _ = _measure(parse)
+
+        root = parser.getRoot()
+        write, _ = _measure(str, root)
+
+        # Memory used by the tree
+        tracemalloc.start()
+        tree = parse()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del tree
+
+        # Read-only lookups on every service, including keys that don't exist
+        def lookup():
+            for _, service in root.services:
+                service.announcements.getboolean('Alarm')
+                service.announcements.getboolean('Warning')
+                str(service['label'])
+                str(service['country'])
+
+        lookups, _ = _measure(lookup)
+
+        # Writing a changed config to a file, and an unchanged one which is only hashed
+        outpath = f'{tmpdir}/dabmux-{count}-out.mux'
+        writer = BoostInfoParser()
+        writer.load(root)
+
+        def write_changed():
+            root.ensemble['label'] = f'DAB Ensemble {time.perf_counter()}'
+            writer.write(outpath)
+
+        label = root.ensemble['label'].value
+        filewrite, _ = _measure(write_changed)
+        root.ensemble['label'] = label
+
+        writer.write(outpath)
+        unchanged, _ = _measure(writer.write, outpath)
+
+        lines = config.count('\n')
+        print(f'{count:>8}{lines:>10}{duration * 1000:>12.2f}{lines / duration:>14.0f}{write * 1000:>12.2f}'
+              f'{filewrite * 1000:>10.2f}{unchanged * 1000:>10.2f}{size / 1024:>10.0f}{lookups / count * 1e6:>11.2f}')
+
+def _streams_config(streams:int) -> str:
+    """ Generate a streams.ini with the specified number of audio streams """
+
+    return ''.join(f'[sub-{i}]\noutput_type = dabplus\ninput_type = gst\ninput = http://127.0.0.1/stream-{i}%%20hq\n'
+                   f'bitrate = 96\nprotection_profile = EEP_A\nprotection = 3\ndls_enable = yes\n\n'
+                   for i in range(streams))
+
+def bench_snapshot(tmpdir:str, services:list):
+    """ Compare copying the multiplexer and streams config before an edit to taking a snapshot of them """
+
+    print(f'{"services":>8}{"deepcopy ms":>13}{"save us":>10}{"edit us":>10}{"restore us":>12}')
+
+    for count in services:
+        parser = BoostInfoParser()
+        parser.parse(_mux_config(count))
+        root = parser.getRoot()
+
+        path = f'{tmpdir}/streams-{count}.ini'
+        with open(path, 'w') as f:
+            f.write(_streams_config(count))
+        streams = StreamsConfig()
+        streams.load(path)
+
+        deepcopy, _ = _measure(lambda: (copy.deepcopy(root), copy.deepcopy(streams.cfg)))
+
+        start = time.perf_counter()
+        root.snapshot()
+        streams.save()
+        save = time.perf_counter() - start
+
+        # Edit the configs like the TUI does: change, add and remove services, announcements and streams
+        start = time.perf_counter()
+        for i in range(0, count, 3):
+            root.services[f'srv-{i}']['label'] = 'Changed'
+            root.services[f'srv-{i}'].announcements['Warning'] = 'true'
+            del root.services[f'srv-{i + 1}']
+            del root.components[f'comp-{i + 1}']['type']
+            root.services[f'new-{i}']['label'] = 'New'
+            streams.cfg[f'sub-{i}']['bitrate'] = '128'
+            streams.cfg.remove_section(f'sub-{i + 1}')
+        del root['outputs']
+        streams.cfg.add_section('new')
+        edit = time.perf_counter() - start
+
+        start = time.perf_counter()
+        root.rollback()
+        streams.restore()
+        restore = time.perf_counter() - start
+
+        print(f'{count:>8}{deepcopy * 1000:>13.2f}{save * 1e6:>10.0f}{edit * 1e6:>10.0f}{restore * 1e6:>12.0f}')
+
+def bench_data(tmpdir:str, sizes:list, bitrate:int) -> bool:
+    """ Run the data path benchmarks, return False if the bitrate can't be sustained for all sizes """
+
+    # Bytes per second required to fill a subchannel of this bitrate
+    required = bitrate * 125
+
+    print(f'{"name":<8}{"size":>10}{"packets/s":>14}{"MB/s":>10}{"peak B/pkt":>14}')
+
+    procmgr = ODRProcessManager()
+    engine = data.DABDataEngine(procmgr)
+
+    failed = []
+
+    try:
+        for size in sizes:
+            bench_crc(size)
+            group = bench_group(size)
+            packet = bench_packet(size)
+            fec = bench_fec(size)
+            stream = bench_stream(size, bitrate, engine, tmpdir)
+
+            # The data path as a whole has to keep up (with FEC enabled), from input to packets and from packets to the
+            # output
+            if min(1 / (1 / group + 1 / packet + 1 / fec), stream) < required:
+                failed.append(size)
+    finally:
+        procmgr.stop()
+
+    if len(failed) > 0:
+        print(f'FAIL: unable to sustain {bitrate} kbit/s ({required / 1e6:.3f} MB/s) for sizes: '
+              f'{", ".join(str(s) for s in failed)}')
+        return False
+
+    print(f'OK: sustained {bitrate} kbit/s ({required / 1e6:.3f} MB/s) for all sizes')
+    return True
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--suite', choices=('all', 'data', 'mux', 'buffer', 'parse'), default='all',
+                        help='benchmarks to run')
+    parser.add_argument('--bitrate', type=int, default=MAX_BITRATE,
+                        help=f'subchannel bitrate (kbit/s) to sustain in real time (default: {MAX_BITRATE})')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='input sizes in bytes')
+    parser.add_argument('--commands', type=int, default=2000, help='number of remote control commands to send')
+    parser.add_argument('--services', type=int, nargs='+', default=(10, 100, 1000),
+                        help='number of services in the parsed multiplexer configs')
+    parser.add_argument('--duration', type=float, default=3600, help='simulated time per buffering scenario in seconds')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    ok = True
+
+    try:
+        if args.suite in ('all', 'data'):
+            ok = bench_data(tmpdir, args.sizes, args.bitrate)
+        if args.suite in ('all', 'mux'):
+            bench_mux(tmpdir, args.commands)
+        if args.suite in ('all', 'buffer'):
+            bench_buffer(args.duration)
+        if args.suite in ('all', 'parse'):
+            bench_parse(tmpdir, args.services)
+            bench_snapshot(tmpdir, args.services)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+#
+#    CFNS - Rijkswaterstaat CIV, Delft © 2022 <cfns@rws.nl>
+#
+#    Copyright 2022 Bastiaan Teeuwen <bastiaan@mkcl.nl>
+#
+#    This file is part of cap-dab-server
+#
+#    cap-dab-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    cap-dab-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import zlib                             # Deflate compression
+
+# Supported on-air encodings of CAP messages
+ENCODING_RAW     = 'raw'
+ENCODING_DEFLATE = 'deflate'
+
+ENCODINGS = (ENCODING_RAW, ENCODING_DEFLATE)
+
+# Version byte preceding compact messages. Raw messages are sent as is, these always start with '<' (0x3C) or a UTF-8
+# BOM (0xEF), so receivers can tell the formats apart by the first byte.
+VERSION_DEFLATE = 0x01
+
+# Preset dictionary for deflate, containing the strings that (almost) every CAP v1.2 message contains.
+# Deflate favours matches that are close by, so the most common strings are at the end.
+# NOTE: changing this dictionary breaks existing receivers, add a new version byte instead
+CAP_ZDICT = (
+    b'<area><areaDesc></areaDesc><polygon></polygon><circle></circle><geocode><valueName></valueName>'
+    b'<value></value></geocode></area><parameter><valueName></valueName><value></value></parameter>'
+    b'<headline></headline><instruction></instruction><web></web><contact></contact><senderName></senderName>'
+    b'<responseType></responseType><onset></onset><note></note><references></references><incidents></incidents>'
+    b'<code></code><restriction></restriction><addresses></addresses><source></source>'
+    b'Exercise</status>System</status>Test</status>Draft</status>Update</msgType>Cancel</msgType>Ack</msgType>'
+    b'Restricted</scope>Private</scope>Immediate</urgency>Expected</urgency>Extreme</severity>Severe</severity>'
+    b'Observed</certainty>Likely</certainty>Fire</category>Met</category>Env</category>Health</category>'
+    b'en-US</language>de-DE</language>NL-Alert '
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    b'<alert xmlns="urn:oasis:names:tc:emergency:cap:1.2">\n\t<identifier></identifier>\n\t<sender></sender>\n'
+    b'\t<sent></sent>\n\t<status>Actual</status>\n\t<msgType>Alert</msgType>\n\t<scope>Public</scope>\n'
+    b'\t<info>\n\t\t<language>nl-NL</language>\n\t\t<category>Safety</category>\n\t\t<event>Alert</event>\n'
+    b'\t\t<urgency>Unknown</urgency>\n\t\t<severity>Unknown</severity>\n\t\t<certainty>Unknown</certainty>\n'
+    b'\t\t<effective></effective>\n\t\t<expires></expires>\n\t\t<description></description>\n'
+    b'\t\t<area>\n\t\t\t<areaDesc></areaDesc>\n\t\t\t<polygon></polygon>\n\t\t</area>\n\t</info>\n</alert>\n'
+)
+
+def encode(raw:bytes, encoding:str=ENCODING_RAW) -> bytes:
+    """ Encode a raw CAP XML message for broadcasting over DAB """
+
+    if encoding == ENCODING_RAW:
+        return bytes(raw)
+    elif encoding == ENCODING_DEFLATE:
+        # Raw deflate stream (no zlib header and checksum), the MSC data group CRC already protects the message
+        compressor = zlib.compressobj(level=9, wbits=-15, memLevel=9, zdict=CAP_ZDICT)
+        return bytes((VERSION_DEFLATE,)) + compressor.compress(raw) + compressor.flush()
+
+    raise ValueError(f'Unsupported CAP encoding: {encoding}')
+
+def decode(data:bytes) -> bytes:
+    """
+    Decode a CAP message received over DAB back into raw CAP XML, as a receiver would.
+
+    A ValueError is raised if data isn't exactly one complete message
+    """
+
+    if len(data) == 0 or data[0] != VERSION_DEFLATE:
+        return bytes(data)
+
+    decompressor = zlib.decompressobj(wbits=-15, zdict=CAP_ZDICT)
+    try:
+        raw = decompressor.decompress(data[1:]) + decompressor.flush()
+    except zlib.error as e:
+        raise ValueError(f'Invalid CAP message. {e}')
+
+    # Anything after the end of the deflate stream would be silently lost, e.g. a second message merged into this one
+    if not decompressor.eof:
+        raise ValueError('Incomplete CAP message')
+    if len(decompressor.unused_data) > 0:
+        raise ValueError(f'{len(decompressor.unused_data)} bytes of trailing data after CAP message')
+
+    return raw
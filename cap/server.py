@@ -143,6 +143,18 @@ class CAPServer():
         xml = cp.generate_response(cp.identifier, cp.sender, cp.sent)
         return flask.Response(response=xml, status=200, content_type='application/xml; charset=utf-8')
 
+    def _status(self):
+        if self.status_callback is None:
+            return flask.Response(status=503)
+
+        return flask.jsonify(self.status_callback())
+
+    def _metrics(self):
+        if self.metrics_callback is None:
+            return flask.Response(status=503)
+
+        return flask.jsonify(self.metrics_callback())
+
     def __init__(self, srvcfg, q):
         self.app = flask.Flask(__name__)
 
@@ -155,8 +167,16 @@ class CAPServer():
 
         self._cap = None
 
+        # Callback returning a dict with the status of all server components, exposed as JSON on '/status'
+        self.status_callback = None
+
+        # Callback returning a dict with the telemetry of the DAB multiplexer, exposed as JSON on '/metrics'
+        self.metrics_callback = None
+
         # setup the endpoint for '/'
         self.app.add_url_rule('/', 'index', self._index, methods=['POST'])
+        self.app.add_url_rule('/status', 'status', self._status, methods=['GET'])
+        self.app.add_url_rule('/metrics', 'metrics', self._metrics, methods=['GET'])
 
     def start(self):
         # Check if the version of PyExpat is vulnerable to XML DDoS attacks (version 2.4.1+).
@@ -19,20 +19,25 @@
 #    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
 #
 
-from configparser import ConfigParser   # For parsing the server config
-import logging                          # Logging facilities
-import os                               # For creating directories
-import subprocess as subproc            # Support for starting subprocesses
-import threading                        # Threading support (for running streams in the background)
-import time                             # For sleep support
+from configparser import ConfigParser           # For parsing the server config
+import logging                                  # Logging facilities
+import os                                       # For creating directories
+import subprocess as subproc                    # Support for starting subprocesses
+from dab.procmgr import ODRProcessManager       # Owner of all odr-* processes
+from dab.sched import SchedPolicy               # CPU affinity and scheduling policy
+from dab.supervisor import RestartSupervisor    # Restart policy for the encoders
 
 logger = logging.getLogger('server.dab')
 
-class DABAudioStream(threading.Thread):
-    """ This class represents an audio stream as a thread, defined in streams.ini """
+class DABAudioStream():
+    """
+    This class represents an audio stream, defined in streams.ini
 
-    def __init__(self, srvcfg:ConfigParser, name:str, streamcfg, output_path:str):
-        threading.Thread.__init__(self)
+    odr-audioenc and odr-padenc are owned by the ODRProcessManager, this class only reacts to their exits.
+    """
+
+    def __init__(self, srvcfg:ConfigParser, name:str, streamcfg, output_path:str, procmgr:ODRProcessManager):
+        self._procmgr = procmgr
 
         self.name = name
         self.streamcfg = streamcfg
@@ -41,8 +46,18 @@ class DABAudioStream(threading.Thread):
         self.streamdir = f'{srvcfg["general"]["logdir"]}/streams/{self.name}'
         self.binpath = srvcfg['dab']['odrbin_path']
 
+        self._audio_sched = SchedPolicy(srvcfg, 'audioenc')
+        self._pad_sched = SchedPolicy(srvcfg, 'padenc')
+
         self.audio = None
         self.pad = None
+        self._audio_timer = None
+        self._pad_timer = None
+        self._pad_enable = False
+
+        # Both encoders are supervised (and restarted) independently
+        self.audio_supervisor = RestartSupervisor()
+        self.pad_supervisor = RestartSupervisor()
 
         # Create a directory structure for the stream to save logs to and load DLS and MOT information from
         os.makedirs(self.streamdir, exist_ok=True)
@@ -52,114 +67,190 @@ class DABAudioStream(threading.Thread):
         if self.streamcfg.getboolean('mot_enable'):
             os.makedirs(f'{self.streamdir}/mot', exist_ok=True)
 
-        self._running = True
+        self._running = False
+
+    def _audioenc_cmdline(self, pad_enable:bool) -> list:
+        """ Generate the odr-audioenc command line """
 
-    def run(self):
+        cmdline = [
+                    f'{self.binpath}/odr-audioenc',
+                    f'--bitrate={self.streamcfg["bitrate"]}',
+                     '-D',
+                    f'--output=ipc://{self.output_path}',
+                  ]
+        if pad_enable:
+            cmdline.append(f'--pad-socket={self.name}')
+            cmdline.append(f'--pad={self.streamcfg["pad_length"]}')
+
+        # Set the DAB type
+        if self.streamcfg['output_type'] == 'dab':
+            cmdline.append('--dab')
+
+        # Add the input to cmdline
+        if self.streamcfg['input_type'] == 'gst':
+            cmdline.append(f'--gst-uri={self.streamcfg["input"]}')
+        elif self.streamcfg['input_type'] == 'fifo':
+            cmdline.append(f'--input={self.streamcfg["input"]}')
+            cmdline.append('--format=raw')
+            cmdline.append('--fifo-silence')
+        elif self.streamcfg['input_type'] == 'file':
+            cmdline.append(f'--input={self.streamcfg["input"]}')
+            cmdline.append('--format=wav')
+
+        return cmdline
+
+    def _padenc_cmdline(self) -> list:
+        """ Generate the odr-padenc command line """
+
+        cmdline = [
+                    f'{self.binpath}/odr-padenc',
+                     '--charset=0',
+                    f'--output={self.name}'
+                  ]
+
+        # Add DLS and MOT if enabled
+        if self.streamcfg.getboolean('dls_enable'):
+            cmdline.append(f'--dls={self.streamdir}/dls.txt')
+        if self.streamcfg.getboolean('mot_enable'):
+            cmdline.append(f'--dir={self.streamdir}/mot')
+            cmdline.append(f'--sleep={self.streamcfg["mot_timeout"]}')
+
+        return cmdline
+
+    def start(self):
         """ Start this audio stream """
 
         # If DLS and MOT are disabled, we won't need to start odr-padenc
-        pad_enable = self.streamcfg.getboolean('dls_enable') or self.streamcfg.getboolean('mot_enable')
+        self._pad_enable = self.streamcfg.getboolean('dls_enable') or self.streamcfg.getboolean('mot_enable')
 
         # Save our logs (FIXME rotate logs)
-        audiolog = open(f'{self.streamdir}/logs/audioenc.log', 'ab')
-        if pad_enable:
-            padlog = open(f'{self.streamdir}/logs/padenc.log', 'ab')
-
-        failcounter = 0
-        while self._running and failcounter < 4:
-            # Start up odr-audioenc DAB/DAB+ audio encoder
-            audioenc_cmdline = [
-                                f'{self.binpath}/odr-audioenc',
-                                f'--bitrate={self.streamcfg["bitrate"]}',
-                                 '-D',
-                                f'--output=ipc://{self.output_path}',
-                            ]
-            if pad_enable:
-                audioenc_cmdline.append(f'--pad-socket={self.name}')
-                audioenc_cmdline.append(f'--pad={self.streamcfg["pad_length"]}')
-
-            # Set the DAB type
-            if self.streamcfg['output_type'] == 'dab':
-                audioenc_cmdline.append('--dab')
-
-            # Add the input to cmdline
-            if self.streamcfg['input_type'] == 'gst':
-                audioenc_cmdline.append(f'--gst-uri={self.streamcfg["input"]}')
-            elif self.streamcfg['input_type'] == 'fifo':
-                audioenc_cmdline.append(f'--input={self.streamcfg["input"]}')
-                audioenc_cmdline.append('--format=raw')
-                audioenc_cmdline.append('--fifo-silence')
-            elif self.streamcfg['input_type'] == 'file':
-                audioenc_cmdline.append(f'--input={self.streamcfg["input"]}')
-                audioenc_cmdline.append('--format=wav')
-
-            self.audio = subproc.Popen(audioenc_cmdline, stdout=audiolog, stderr=audiolog)
-
-            # Start up odr-padenc PAD encoder
-            if pad_enable:
-                padenc_cmdline = [
-                                f'{self.binpath}/odr-padenc',
-                                 '--charset=0',
-                                f'--output={self.name}'
-                                ]
-
-                # Add DLS and MOT if enabled
-                if self.streamcfg.getboolean('dls_enable'):
-                    padenc_cmdline.append(f'--dls={self.streamdir}/dls.txt')
-                if self.streamcfg.getboolean('mot_enable'):
-                    padenc_cmdline.append(f'--dir={self.streamdir}/mot')
-                    padenc_cmdline.append(f'--sleep={self.streamcfg["mot_timeout"]}')
-
-                self.pad = subproc.Popen(padenc_cmdline, stdout=padlog, stderr=padlog)
-
-            # Send odr-dabmux's data to odr-dabmod. This operation blocks until the process in killed
-            self.audio.communicate()[0]
-
-            # Quit odr-padenc if odr-audioenc exits for some reason
-            self.audio.terminate()
-            if pad_enable:
-                self.pad.terminate()
-
-                # Wait max. 5 seconds for odr-padenc to terminate
-                try:
-                    self.pad.wait(timeout=5)
-                except subproc.TimeoutExpired as e:
-                    logger.error(f'Unable to terminate odr-padenc for DAB audio stream "{self.name}". Stopping stream. {e}')
-                    break
-
-            # Wait a second or 2 to prevent going into an restarting loop and overloading the system
-            if self._running:
-                time.sleep(2)
-
-            # Maintain a failcounter to automatically exit the loop if odr-audioenc terminated with an error
-            # TODO check padenc too?
-            if self._running and self.audio.wait(timeout=None) != 0:
-                failcounter += 1
-
-        if self._running:
-            logger.error(f'Terminating DAB audio stream "{self.name}". odr-audioenc failed to start {failcounter} times')
-
-        audiolog.close()
-        if pad_enable:
-            padlog.close()
+        self._audiolog = open(f'{self.streamdir}/logs/audioenc.log', 'ab')
+        if self._pad_enable:
+            self._padlog = open(f'{self.streamdir}/logs/padenc.log', 'ab')
+
+        self._running = True
+
+        # Both encoders are started (and restarted) from the process manager's event loop
+        self._procmgr.call_soon(self._start_audio)
+        if self._pad_enable:
+            self._procmgr.call_soon(self._start_pad)
+
+    def _start_audio(self):
+        """ Start up odr-audioenc DAB/DAB+ audio encoder """
+
+        self._audio_timer = None
+        if not self._running:
+            return
+
+        self.audio = self._procmgr.spawn(self._audioenc_cmdline(self._pad_enable),
+                                         on_exit=self._audio_exited, sched=self._audio_sched,
+                                         stdout=self._audiolog, stderr=self._audiolog)
+        self.audio_supervisor.started()
+
+    def _start_pad(self):
+        """ Start up odr-padenc PAD encoder """
+
+        self._pad_timer = None
+        if not self._running:
+            return
+
+        self.pad = self._procmgr.spawn(self._padenc_cmdline(),
+                                       on_exit=self._pad_exited, sched=self._pad_sched,
+                                       stdout=self._padlog, stderr=self._padlog)
+        self.pad_supervisor.started()
+
+    def _audio_exited(self, proc:subproc.Popen):
+        """ Schedule a restart of odr-audioenc, both encoders are supervised independently """
+
+        if not self._running or proc is not self.audio:
+            return
+
+        delay = self.audio_supervisor.exited(proc.returncode)
+        self._log_exit('odr-audioenc', proc.returncode, self.audio_supervisor, delay)
+        self._audio_timer = self._procmgr.loop.call_later(delay, self._start_audio)
+
+    def _pad_exited(self, proc:subproc.Popen):
+        """ Schedule a restart of odr-padenc, both encoders are supervised independently """
+
+        if not self._running or proc is not self.pad:
+            return
+
+        delay = self.pad_supervisor.exited(proc.returncode)
+        self._log_exit('odr-padenc', proc.returncode, self.pad_supervisor, delay)
+        self._pad_timer = self._procmgr.loop.call_later(delay, self._start_pad)
+
+    def _log_exit(self, binary:str, returncode:int, supervisor:RestartSupervisor, delay:float):
+        """ Log the exit of one of the encoders """
+
+        if returncode == 0:
+            logger.info(f'{binary} for DAB audio stream "{self.name}" exited, restarting in {delay:.1f}s')
+        elif supervisor.state == RestartSupervisor.STATE_CRASHLOOP:
+            logger.error(f'{binary} for DAB audio stream "{self.name}" is crash-looping (exit code {returncode}), '
+                         f'retrying in {delay:.1f}s')
+        else:
+            logger.warning(f'{binary} for DAB audio stream "{self.name}" failed with exit code {returncode}, '
+                           f'restarting in {delay:.1f}s')
+
+    def _stop(self):
+        """ Cancel pending restarts and signal both encoders to terminate, called from the event loop """
+
+        self._running = False
+
+        for timer in (self._audio_timer, self._pad_timer):
+            if timer is not None:
+                timer.cancel()
+        self._audio_timer = self._pad_timer = None
+
+        for proc in (self.audio, self.pad):
+            if proc is not None and proc.poll() is None:
+                proc.terminate()
 
     def join(self, timeout:int=5):
         """ Stop this audio stream """
 
         # TODO log termination
 
-        if not self.is_alive():
+        if not self._running:
             return
 
-        self._running = False
+        self._procmgr.call(self._stop)
+
+        # Wait max. 5 seconds for the encoders to terminate
+        for proc, binary in ((self.audio, 'odr-audioenc'), (self.pad, 'odr-padenc')):
+            if proc is None:
+                continue
 
-        if self.audio is not None:
-            self.audio.terminate()
             try:
-                self.audio.wait(timeout=5)
+                proc.wait(timeout=timeout)
             except subproc.TimeoutExpired as e:
-                logger.error(f'Unable to terminate odr-audioenc for DAB audio stream "{self.name}". {e}')
+                logger.error(f'Unable to terminate {binary} for DAB audio stream "{self.name}". {e}')
+
+        self.audio_supervisor.stopped()
+        self._audiolog.close()
+        if self._pad_enable:
+            self.pad_supervisor.stopped()
+            self._padlog.close()
 
         # TODO consider deleting the stream directory structure on exiting the thread (or at least add an option in settings)
 
-        super().join(timeout)
+    def is_alive(self) -> bool:
+        """ Check if this audio stream is (still) being supervised """
+
+        return self._running
+
+    def status(self) -> dict:
+        """ Retrieve the health and resource usage of odr-audioenc and odr-padenc as a dict """
+
+        audio = self.audio_supervisor.status()
+        audio['proc'] = self._procmgr.stats.get(self.audio.pid) if self.audio is not None else None
+
+        if self._pad_enable:
+            pad = self.pad_supervisor.status()
+            pad['proc'] = self._procmgr.stats.get(self.pad.pid) if self.pad is not None else None
+        else:
+            pad = None
+
+        return {
+            'audioenc': audio,
+            'padenc': pad
+        }
@@ -20,28 +20,122 @@
 # A copy of the GNU General Public License is in the file COPYING.
 
 import copy
-import shlex
+import hashlib
+import os
+import re
+import shutil
+import sys
+
+# Tokens of the Boost INFO format. A key and its value have to be on the same line, so newlines are tokens as well.
+# Words are bare or double quoted strings (or both, concatenated), comments start with a ';' outside of a string.
+_TOKEN = re.compile(r'''
+    [ \t\r\f\v]*
+    (?:
+        (?P<newline>\n)
+      | ;[^\n]*
+      | (?P<open>\{)
+      | (?P<close>\})
+      | (?P<word>(?:"(?:[^"\\\n]|\\.)*"|[^\s;{}"\\]|\\.)+)
+      | (?P<error>.)
+    )
+''', re.VERBOSE)
+
+# Parts of a word: a quoted string, an escaped character or a bare string
+_WORD_PART = re.compile(r'"((?:[^"\\\n]|\\.)*)"|\\(.)|([^"\\]+)')
+
+# Escape sequences of quoted strings, the same set Boost reads and writes. Other backslashes are kept as is.
+_ESCAPES = {'0': '\0', 'a': '\a', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v',
+            '"': '"', "'": "'", '\\': '\\'}
+_QUOTED_ESCAPE = re.compile(r'\\([0abfnrtv"\'\\])')
+
+# Characters that have to be escaped when writing a quoted string (Boost doesn't write \')
+_WRITE_ESCAPES = str.maketrans({c: '\\' + e for e, c in _ESCAPES.items() if e != "'"})
+_NEEDS_ESCAPE = re.compile('[' + re.escape(''.join(c for e, c in _ESCAPES.items() if e != "'")) + ']')
+
+def _unescape(match):
+    return _ESCAPES[match.group(1)]
+
+def _unquote(word):
+    if '"' not in word and '\\' not in word:
+        return word
+
+    out = []
+    for quoted, escaped, bare in _WORD_PART.findall(word):
+        if escaped:
+            out.append(escaped)
+        elif bare:
+            out.append(bare)
+        else:
+            out.append(_QUOTED_ESCAPE.sub(_unescape, quoted))
+
+    return ''.join(out)
+
+def _file_digest(filename):
+    try:
+        with open(filename, 'rb') as stream:
+            digest = hashlib.sha256()
+            for block in iter(lambda: stream.read(65536), b''):
+                digest.update(block)
+            return digest.digest()
+    except FileNotFoundError:
+        return None
+
+def _create_temp(dirname, basename):
+    """ Create a new temporary file, unlike tempfile.mkstemp() its mode is subject to the umask like any other file """
+
+    while True:
+        tmpname = os.path.join(dirname, f'.{basename}.{os.urandom(4).hex()}.tmp')
+        try:
+            return os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), tmpname
+        except FileExistsError:
+            continue
 
 class BoostInfoTree(object):
-    def __init__(self, value=None, parent=None, lastchild=None):
-        super(BoostInfoTree, self).__init__()
-        self.subTrees = {}
-        self.value = value
-        self.parent = parent
+    """
+    Node of a Boost INFO tree, with a value and child nodes.
+
+    Looking up a key that doesn't exist doesn't modify the tree, a detached node is returned instead. The detached node
+    (and any detached parents) is only attached to the tree once something is written to it, so reading a missing key
+    behaves like reading an empty node while cfg.services['new']['label'] = 'New' still creates the whole path.
+
+    snapshot() on the root of a tree starts recording an undo journal of all changes made through the tree, which
+    rollback() uses to restore the tree exactly as it was. Taking a snapshot doesn't copy anything.
+    """
+
+    __slots__ = ('subTrees', 'value', 'parent', 'lastchild', '_key', '_journal')
+
+    # Number of trees that are recording an undo journal, no need to look for the root of a tree if there aren't any
+    _recording = 0
 
-        self.lastchild = lastchild
+    def __init__(self, value=None, parent=None, lastchild=None, key=None):
+        # bypass __setattr__, as lots of nodes are created while parsing
+        _set = object.__setattr__
+        _set(self, 'subTrees', {})
+        _set(self, 'value', value)
+        _set(self, 'parent', parent)
+
+        _set(self, 'lastchild', lastchild)
+
+        # key in the parent if this node is detached, None once it's attached
+        _set(self, '_key', key)
+
+        # undo journal, only used by the root of a tree
+        _set(self, '_journal', None)
 
     def __copy__(self):
         out = self.__class__.__new__(self.__class__)
-        out.__dict__.update(self.__dict__)
+        for key in self.__slots__:
+            object.__setattr__(out, key, getattr(self, key))
+        object.__setattr__(out, '_journal', None)
 
         return out
     def __deepcopy__(self, memo):
         out = self.__class__.__new__(self.__class__)
         memo[id(self)] = out
 
-        for key, value in self.__dict__.items():
-            setattr(out, key, copy.deepcopy(value, memo))
+        for key in self.__slots__:
+            object.__setattr__(out, key, copy.deepcopy(getattr(self, key), memo))
+        object.__setattr__(out, '_journal', None)
 
         return out
 
@@ -51,38 +145,66 @@ class BoostInfoTree(object):
         else:
             return len(self.value)
 
+    def _attach(self):
+        """ Attach a detached node and its detached parents to the tree, return the node that is part of the tree """
+
+        if self._key is None:
+            return self
+
+        parent = self.parent._attach()
+        node = parent.subTrees.get(self._key)
+
+        # the key may have been created through another detached node in the meantime, use that node instead
+        if node is None:
+            parent._record('add', parent, self._key)
+            node = parent.lastchild = parent.subTrees[self._key] = self
+            object.__setattr__(self, 'parent', parent)
+            object.__setattr__(self, '_key', None)
+
+        return node
+
     def __setitem__(self, key, value=None):
-        if key in self.subTrees:
-            self.subTrees[key].value = value
+        node = self._attach()
+
+        child = node.subTrees.get(key)
+        if child is not None:
+            node._record('value', child, child.value)
+            child.value = value
         else:
-            self.lastchild = self.subTrees[key] = BoostInfoTree(value, self)
+            node._record('add', node, key)
+
+            # keys repeat a lot (every service has a label, id, ...), so only store a single copy of each
+            child = node.subTrees[sys.intern(key)] = BoostInfoTree(value, node)
+        node.lastchild = child
     def __setattr__(self, key, value=None):
-        if key in ('subTrees', 'value', 'parent', 'lastchild'):
+        if key in BoostInfoTree.__slots__:
             return object.__setattr__(self, key, value)
         return self.__setitem__(key, value)
 
     def __getitem__(self, key):
         try:
-            assert self.subTrees[key]
-        except (KeyError, AssertionError):
-            self.__setitem__(key, None)
-
-        return self.subTrees[key]
+            return self.subTrees[key]
+        except KeyError:
+            return BoostInfoTree(None, self, key=key)
     def __getattr__(self, key):
-        if key in ('subTrees', 'value', 'parent', 'lastchild'):
-            return object.__getattr__(self, key)
-        return self.__getitem__(key)
+        # only called for keys that aren't slots, don't pretend to implement any special methods
+        if key.startswith('__'):
+            raise AttributeError(key)
+
+        try:
+            return self.subTrees[key]
+        except KeyError:
+            return BoostInfoTree(None, self, key=key)
+
+    def __contains__(self, key):
+        return key in self.subTrees
 
     def __str__(self):
         return self._prettyprint()
 
     def getboolean(self, key):
-        try:
-            assert self.subTrees[key]
-        except (KeyError, AssertionError):
-            self.__setitem__(key, None)
-
-        value = self.subTrees[key].value
+        node = self.subTrees.get(key)
+        value = node.value if node is not None else None
 
         if value is not None and len(value) > 0:
             return bool(value in ('True', 'true', '1'))
@@ -93,30 +215,108 @@ class BoostInfoTree(object):
         return iter(self.subTrees.items())
 
     def __delitem__(self, key):
-        del self.subTrees[key]
+        if key in self.subTrees:
+            # keep the order of the remaining keys, so the tree can be restored exactly
+            self._record('subtrees', self, dict(self.subTrees))
+            del self.subTrees[key]
+
+    def _record(self, *change):
+        """ Add a change to the undo journal of the tree, if a snapshot was taken """
+
+        if BoostInfoTree._recording == 0:
+            return
+
+        root = self
+        while root.parent is not None:
+            root = root.parent
+
+        if root._journal is not None:
+            root._journal.append(change)
+
+    def snapshot(self):
+        """ Start recording the changes to this tree, replacing the previous snapshot """
+
+        if self._journal is None:
+            BoostInfoTree._recording += 1
+        self._journal = []
+
+    def release(self):
+        """ Stop recording the changes to this tree and keep them """
+
+        if self._journal is not None:
+            BoostInfoTree._recording -= 1
+        self._journal = None
+
+    def rollback(self):
+        """ Undo all changes to this tree since the snapshot was taken """
+
+        journal = self._journal
+        if journal is None:
+            return
+
+        self.release()
+
+        for change, node, old in reversed(journal):
+            if change == 'value':
+                node.value = old
+            elif change == 'add':
+                del node.subTrees[old]
+            elif change == 'subtrees':
+                node.subTrees = old
+
+    def _chunks(self, indentLevel=1, first=True):
+        """ Generate the pretty-printed tree in chunks, for a root node this ends with a newline that str() drops """
+
+        # walk the tree with a stack instead of recursing, so chunks aren't passed up through a generator per level
+        node = self
+        stack = []
+        while True:
+            prefix = ' ' * indentLevel
+            if node.parent is not None:
+                if node.value is not None and len(node.value) > 0:
+                    value = str(node.value)
+                    if not first:
+                        # escape the value, but keep it as is when converting a single value to a string
+                        if _NEEDS_ESCAPE.search(value) is not None:
+                            value = value.translate(_WRITE_ESCAPES)
+                    yield '"' + value + '"\n'
+                else:
+                    yield '\n'
+            if len(node.subTrees) > 0:
+                if node.parent is not None:
+                    yield prefix + '{\n'
+                stack.append((node, indentLevel, iter(node.subTrees.items())))
+
+            # continue with the next child, closing the contexts of nodes without any children left
+            while len(stack) > 0:
+                parent, parentLevel, children = stack[-1]
+                child = next(children, None)
+                if child is not None:
+                    break
+
+                stack.pop()
+                if parent.parent is not None:
+                    yield ' ' * parentLevel + '}\n'
+            else:
+                return
+
+            key, node = child
+            indentLevel = parentLevel + 2
+            first = False
+            yield ' ' * indentLevel + key + ' '
 
     def _prettyprint(self, indentLevel=1, first=True):
-        prefix = ' ' * indentLevel
-        s = ''
-        if self.parent is not None:
-            if self.value is not None and len(self.value) > 0:
-                s += '"' + str(self.value) + '"'
-            s+= '\n'
-        if len(self.subTrees) > 0:
-            if self.parent is not None:
-                s += prefix + '{\n'
-            nextLevel = ' ' * (indentLevel + 2)
-            for key, value in self.subTrees.items():
-                s += nextLevel + key + ' ' + value._prettyprint(indentLevel + 2, False)
-            if self.parent is not None:
-                s +=  prefix + '}\n'
-        elif first:
+        s = ''.join(self._chunks(indentLevel, first))
+        if first and len(self.subTrees) == 0:
             return s[1:-2]
 
         return s[:-1] if first else s
 
 
 class BoostInfoParser(object):
+    # Number of chunks of the pretty-printed tree to write at once
+    BLOCK_CHUNKS = 4096
+
     def __init__(self):
         self._reset()
 
@@ -128,52 +328,114 @@ class BoostInfoParser(object):
 
     def read(self, filename):
         with open(filename, 'r') as stream:
-            ctx = self._root
-            for line in stream:
-                ctx = self._parseLine(line.strip(), ctx)
+            self.parse(stream.read(), filename)
 
-    def write(self, filename):
-        with open(filename, 'w') as stream:
-            stream.write(str(self._root))
-
-    def _parseLine(self, string, context):
-        # skip blank lines and comments
-        commentStart = string.find(';')
-        if commentStart >= 0:
-           string = string[:commentStart].strip()
-        if len(string) == 0:
-           return context
-
-        # ok, who is the joker who put a { on the same line as the key name?!
-        sectionStart = string.find('{')
-        if sectionStart > 0:
-            firstPart = string[:sectionStart]
-            secondPart = string[sectionStart:]
-
-            ctx = self._parseLine(firstPart, context)
-            return self._parseLine(secondPart, ctx)
-
-        #if we encounter a {, we are beginning a new context
-        # TODO: error if there was already a subcontext here
-        if string[0] == '{':
-            context = context.lastchild
-            return context
-
-        # if we encounter a }, we are ending a list context
-        if string[0] == '}':
-            context = context.parent
-            return context
-
-        # else we are expecting key and optional value
-        strings = shlex.split(string)
-        key = strings[0]
-        if len(strings) > 1:
-            val = strings[1]
+    def _blocks(self):
+        """ Generate the encoded tree in blocks of chunks, like str() without the final newline """
+
+        root = self._root
+        if root.parent is None:
+            chunks = root._chunks()
         else:
-            val = None
-        context[key] = val
+            chunks = iter((str(root) + '\n',))
+
+        # hold back the last chunk, as str() drops the final newline
+        block = []
+        for chunk in chunks:
+            block.append(chunk)
+            if len(block) >= self.BLOCK_CHUNKS:
+                yield ''.join(block[:-1]).encode()
+                del block[:-1]
+
+        yield ''.join(block)[:-1].encode()
+
+    def write(self, filename):
+        """
+        Write the tree to a file atomically, return False if the file already had exactly this content.
 
-        return context
+        The tree is hashed first. If the content didn't change the file is left untouched, nothing is written at all.
+        Otherwise it's written to a temporary file in the same directory, which then replaces the file, so a reader
+        never sees a partially written file.
+        """
+
+        digest = hashlib.sha256()
+        blocks = []
+        for block in self._blocks():
+            digest.update(block)
+            blocks.append(block)
+
+        if _file_digest(filename) == digest.digest():
+            return False
+
+        dirname = os.path.dirname(filename) or '.'
+        fd, tmpname = _create_temp(dirname, os.path.basename(filename))
+        try:
+            with os.fdopen(fd, 'wb') as stream:
+                stream.writelines(blocks)
+                stream.flush()
+                os.fsync(stream.fileno())
+
+            # new files are created with the mode of the umask, existing files keep their mode
+            try:
+                shutil.copymode(filename, tmpname)
+            except FileNotFoundError:
+                pass
+
+            os.replace(tmpname, filename)
+        except BaseException:
+            try:
+                os.unlink(tmpname)
+            except FileNotFoundError:
+                pass
+            raise
+
+        # make the rename itself durable as well
+        dirfd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+        return True
+
+    def parse(self, string, filename='<string>'):
+        """ Parse a Boost INFO document in a single pass over its tokens """
+
+        ctx = self._root
+        words = []
+        line = 1
+
+        for match in _TOKEN.finditer(string):
+            kind = match.lastgroup
+            if kind is None:
+                # a comment
+                continue
+
+            if kind == 'word':
+                words.append(match.group('word'))
+                continue
+
+            # a newline or brace ends the key and its optional value, any further words are ignored
+            if len(words) > 0:
+                ctx[_unquote(words[0])] = _unquote(words[1]) if len(words) > 1 else None
+                words = []
+
+            if kind == 'newline':
+                line += 1
+            elif kind == 'open':
+                # we are beginning a new context, below the key that was just read
+                # TODO: error if there was already a subcontext here
+                ctx = ctx.lastchild
+            elif kind == 'close':
+                # we are ending a list context
+                if ctx.parent is None:
+                    raise Exception(f'{filename}:{line}: unexpected }}')
+                ctx = ctx.parent
+            else:
+                raise Exception(f'{filename}:{line}: unexpected {match.group("error")}')
+
+        if len(words) > 0:
+            ctx[_unquote(words[0])] = _unquote(words[1]) if len(words) > 1 else None
 
     def getRoot(self):
         return self._root
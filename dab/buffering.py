@@ -0,0 +1,155 @@
+#
+#    CFNS - Rijkswaterstaat CIV, Delft © 2022 <cfns@rws.nl>
+#
+#    Copyright 2022 Bastiaan Teeuwen <bastiaan@mkcl.nl>
+#
+#    This file is part of cap-dab-server
+#
+#    cap-dab-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    cap-dab-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import logging                          # Logging facilities
+import math                             # For rounding buffer sizes
+
+logger = logging.getLogger('server.dab')
+
+# Buffering profiles of ZMQ subchannel inputs
+PROFILE_DEFAULT     = 'default'
+PROFILE_LOW_LATENCY = 'low_latency'
+
+# Initial prebuffering of each profile and the range it's tuned in, in 24 ms frames
+PROFILES = {
+    PROFILE_DEFAULT:     (20, 8, 60),
+    PROFILE_LOW_LATENCY: (5, 3, 20)
+}
+
+def select_profile(streamcfg, alarm:bool) -> str:
+    """ Select the buffering profile of a stream, subchannels used by announcements default to low latency """
+
+    profile = streamcfg.get('buffer_profile', PROFILE_LOW_LATENCY if alarm else PROFILE_DEFAULT)
+    if profile not in PROFILES:
+        raise Exception(f'Invalid buffer_profile: {profile}')
+
+    return profile
+
+def clamp(profile:str, prebuffering:int | None) -> int:
+    """ Limit the prebuffering to the range of a profile, return the initial prebuffering of the profile if None """
+
+    initial, low, high = PROFILES[profile]
+
+    if prebuffering is None:
+        return initial
+
+    return max(low, min(high, prebuffering))
+
+def buffer_size(prebuffering:int) -> int:
+    """ Size of the input buffer for a prebuffering, leaving the same headroom above it for bursts """
+
+    return prebuffering * 2
+
+class BufferTuner():
+    """
+    Tune the prebuffering of a single ZMQ input from its measured buffer statistics.
+
+    An underrun increases the prebuffering right away. Once the input didn't underrun for SETTLE samples in a row and
+    the buffer never ran lower than MARGIN times the prebuffering in the meantime, the jitter doesn't need that much
+    buffering and the prebuffering is decreased a step to cut latency.
+    """
+
+    # Factors to grow and shrink the prebuffering with
+    GROW = 1.5
+    SHRINK = 0.75
+
+    # Number of samples without underruns before the prebuffering is decreased
+    SETTLE = 30
+
+    # Part of the prebuffering that has to be left unused before it is decreased
+    MARGIN = 0.5
+
+    def __init__(self, profile:str, prebuffering:int=None):
+        self.profile = profile
+        self.prebuffering = clamp(profile, prebuffering)
+
+        self._settled = 0
+        self._low = None
+
+    @property
+    def buffer(self) -> int:
+        return buffer_size(self.prebuffering)
+
+    def update(self, underruns:int, min_fill:float | None) -> bool:
+        """
+        Process a sample with the number of underruns and the lowest buffer fill (in frames) since the previous sample.
+
+        Return True if the prebuffering changed
+        """
+
+        prebuffering = self.prebuffering
+
+        if underruns > 0:
+            self.prebuffering = clamp(self.profile, math.ceil(prebuffering * self.GROW))
+            self._settled = 0
+            self._low = None
+        elif min_fill is not None:
+            self._settled += 1
+            self._low = min_fill if self._low is None else min(self._low, min_fill)
+
+            if self._settled >= self.SETTLE:
+                if self._low >= prebuffering * self.MARGIN:
+                    self.prebuffering = clamp(self.profile, math.floor(prebuffering * self.SHRINK))
+
+                self._settled = 0
+                self._low = None
+
+        return self.prebuffering != prebuffering
+
+class AdaptiveBuffering():
+    """
+    Tune the buffering of all ZMQ subchannels of odr-dabmux using the samples of the MuxTelemetry collector.
+
+    Changes are applied to the running odr-dabmux through its remote control, and written back to the multiplexer
+    config so they're kept when odr-dabmux restarts.
+    """
+
+    def __init__(self, muxctl, muxcfg):
+        self._muxctl = muxctl
+        self._muxcfg = muxcfg
+
+        self._tuners = {}
+
+    def update(self, sample:dict):
+        """ Process a telemetry sample """
+
+        for name, stat in sample['inputs'].items():
+            tuner = self._tuners.get(name)
+            if tuner is None:
+                buffering = self._muxcfg.get_buffering(name)
+                if buffering is None:
+                    continue
+
+                tuner = self._tuners[name] = BufferTuner(*buffering)
+
+            if not tuner.update(stat['new_underruns'], stat['min_fill']):
+                continue
+
+            logger.info(f'{name}: tuning the input buffer to {tuner.buffer} frames, '
+                        f'prebuffering {tuner.prebuffering} frames ({tuner.profile})')
+
+            results = self._muxctl.set_many([(name, 'buffer', str(tuner.buffer)),
+                                             (name, 'prebuffering', str(tuner.prebuffering))])
+            if results.count('ok') != len(results):
+                logger.warning(f'{name}: unable to change the input buffer of the running multiplexer, '
+                               f'it\'s applied when odr-dabmux restarts')
+
+            self._muxcfg.set_buffering(name, tuner.profile, tuner.prebuffering)
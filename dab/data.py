@@ -32,57 +32,160 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import binascii                         # For the (table driven) CRC-16-CCITT implementation
+import collections                      # For queueing packets
 from configparser import ConfigParser   # For parsing the server config
-import os                               # For creating directories
+import errno                            # For handling non-blocking FIFO errors
+import hashlib                          # For recognizing repeated messages
+import logging                          # Logging facilities
+import math                             # For aligning cached packet sequences
+import mmap                             # For mapping input files into memory
+import os                               # For creating directories and non-blocking FIFO I/O
+import shlex                            # For parsing packet data sources
 import struct			                # For generating DAB MSC and Packet headers
-import multiprocessing                  # Multiprocessing support (for running data streams in the background)
 import utils
 
-def _crc16(data:bytearray) -> bytes:
-    """ Calculate Packet/MSC data group CRC according to ETSI EN 300 401 V2.1.1 Sections 5.3.2.3 and 5.3.3.4 """
+logger = logging.getLogger('server.dab')
 
-    if data is None:
-        return bytes(0)
+def _crc16_int(data) -> int:
+    """ Calculate Packet/MSC data group CRC according to ETSI EN 300 401 V2.1.1 Sections 5.3.2.3 and 5.3.3.4 as int """
 
-    crc = 0xFFFF
+    # binascii.crc_hqx implements the same (non-reflected) CRC-16-CCITT using a lookup table
+    return ~binascii.crc_hqx(data, 0xFFFF) & 0xFFFF
 
-    for e in data:
-        x = (crc >> 8) ^ e
-        x = (x ^ (x >> 4))
-        crc = ((crc << 8) & 0xFFFF) ^ ((x << 12) & 0xFFFF) ^ ((x << 5) & 0xFFFF) ^ (x & 0xFFFF)
+def _gf_tables() -> tuple:
+    """ Generate the exponent and logarithm tables of GF(2^8) with the field generator polynomial x^8+x^4+x^3+x^2+1 """
 
-    crc = ~crc & 0xFFFF
+    exp = [0] * 512
+    log = [0] * 256
 
-    return struct.pack('!H', crc)
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
 
-def _to_bytes(x:int) -> bytes:
-    """ Convert an single byte represented as an int to a big endian byte object """
+        x <<= 1
+        if x & 0x100:
+            x ^= 0x11D
 
-    return x.to_bytes(1, 'big')
+    # Avoid having to reduce the sum of two logarithms modulo 255
+    for i in range(255, 512):
+        exp[i] = exp[i - 255]
+
+    return exp, log
+
+_GF_EXP, _GF_LOG = _gf_tables()
+
+def _gf_mul(a:int, b:int) -> int:
+    """ Multiply two elements of GF(2^8) """
+
+    if a == 0 or b == 0:
+        return 0
+
+    return _GF_EXP[_GF_LOG[a] + _GF_LOG[b]]
+
+def _rs_generator(parity:int) -> tuple:
+    """
+    Generate the Reed-Solomon code generator polynomial (x+a^0)(x+a^1)...(x+a^(parity-1)).
+
+    Return a tuple with, for every possible feedback byte, the products of that byte with the generator coefficients
+    packed into a single int (highest order coefficient in the most significant byte)
+    """
+
+    # Coefficients, highest order first
+    g = [1]
+    for i in range(parity):
+        g = [c ^ _gf_mul(n, _GF_EXP[i]) for c, n in zip(g + [0], [0] + g)]
+
+    return tuple(int.from_bytes(bytes(_gf_mul(f, c) for c in g[1:]), 'big') for f in range(256))
+
+_RS_GENERATOR = _rs_generator(16)
+
+def _rs_parity(data) -> bytes:
+    """
+    Calculate the 16 parity bytes of the shortened RS(204, 188) code (ETSI EN 300 401 V2.1.1 Section 5.3.5) for data.
+
+    The code is shortened from RS(255, 239), the leading zeros don't influence the parity bytes so they are omitted.
+    """
+
+    # The 16 byte shift register is kept in a single int, so every input byte takes a shift, a lookup and an XOR
+    generator = _RS_GENERATOR
+    parity = 0
+
+    for b in data:
+        parity = ((parity << 8) & 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF) ^ generator[b ^ (parity >> 120)]
+
+    return parity.to_bytes(16, 'big')
 
 class MSCDataGroupBuilder():
-    """ Class to split arbitrary data into MSC Data Groups """
+    """
+    Class to split arbitrary data into MSC Data Groups
+
+    Data that doesn't fit in a single data group is segmented (ETSI EN 300 401 V2.1.1 Section 5.3.3.1). All segments of
+    a message share a Transport Id, so receivers are able to reassemble the segments into the original message.
+    """
+
+    # Maximum number of bytes in the data group data field of a single segment
+    SEGMENT_SIZE = 8189
+
+    # Maximum number of segments, the segment number is 15 bits
+    MAX_SEGMENTS = 0x8000
 
     def __init__(self):
-        self.last_data = None
+        self.last_group = None
         self.coni = 15
         self.repi = 0
 
-    def _build_header(self) -> bytes:
-        """ Build the MSC data group header (ETSI EN 300 401 V2.1.1 Section 5.3.3) """
+        self.last_message = None
+        self.transport_id = 0
 
-        byte0  = 0 << 7         # Extension flag
-        byte0 |= 1 << 6         # CRC flag
-        byte0 |= 0 << 5         # Segment flag
-        byte0 |= 0 << 4         # User access flag
-        byte1  = 0              # Data group type
-        byte1 |= self.coni << 4 # Continuity index
-        byte1 |= self.repi      # Repetition index
+    def _write_header(self, buf:bytearray, segment:int | None, last:bool) -> int:
+        """
+        Write the MSC data group header and session header (ETSI EN 300 401 V2.1.1 Section 5.3.3) into buf.
 
-        return struct.pack('<cc', _to_bytes(byte0), _to_bytes(byte1))
+        Return the length of the headers
+        """
 
-    def build(self, data:bytes) -> bytearray:
-        if self.last_data == None or self.last_data != data:
+        segmented = segment is not None
+
+        byte0  = 0 << 7                 # Extension flag
+        byte0 |= 1 << 6                 # CRC flag
+        byte0 |= segmented << 5         # Segment flag
+        byte0 |= segmented << 4         # User access flag
+        byte1  = 0                      # Data group type
+        byte1 |= self.coni << 4         # Continuity index
+        byte1 |= self.repi              # Repetition index
+
+        if not segmented:
+            struct.pack_into('!BB', buf, 0, byte0, byte1)
+            return 2
+
+        segment_field  = last << 15     # Last flag
+        segment_field |= segment        # Segment number
+        user_access  = 0 << 5           # Rfa
+        user_access |= 1 << 4           # Transport Id flag
+        user_access |= 2                # Length indicator (Transport Id only, no end user address)
+
+        struct.pack_into('!BBHBH', buf, 0, byte0, byte1, segment_field, user_access, self.transport_id)
+        return 7
+
+    def _changed(self, data:memoryview, segment:int | None) -> bool:
+        """ Check if a data group differs from the previous one, compared to the data field of the previous group """
+
+        if self.last_group is None:
+            return True
+
+        last_segment, last_transport_id, group, header_length = self.last_group
+        if last_segment != segment or (segment is not None and last_transport_id != self.transport_id):
+            return True
+
+        return memoryview(group)[header_length:-2] != data
+
+    def _build_group(self, data:memoryview, segment:int | None=None, last:bool=False) -> bytearray:
+        """ Build a single MSC data group, this is the only place the data is copied """
+
+        # The continuity index changes every time the data group differs from the previous one
+        if self._changed(data, segment):
             self.coni = (self.coni + 1) % 16
             self.repi = 0
         elif self.repi > 0:
@@ -90,13 +193,50 @@ class MSCDataGroupBuilder():
         else:
             self.repi = 0
 
-        self.last_data = data
+        header_length = 2 if segment is None else 7
+        group = bytearray(header_length + len(data) + 2)
 
-        packet = bytearray(self._build_header())
-        packet.extend(data)
-        packet.extend(_crc16(packet))
+        self._write_header(group, segment, last)
+        group[header_length:-2] = data
+        struct.pack_into('!H', group, len(group) - 2, _crc16_int(memoryview(group)[:-2]))
 
-        return packet
+        # Keep the group itself to compare the next one to, not a view of data which might be unmapped afterwards
+        self.last_group = (segment, self.transport_id, group, header_length)
+
+        return group
+
+    def build(self, data) -> list[bytearray]:
+        """
+        Pack a complete message into a single MSC data group, or in multiple segments if the message doesn't fit.
+
+        data can be any buffer (i.e. a memory mapped file), it's only copied segment by segment into the data groups.
+        No references to it are kept once this returns.
+
+        Return a list with the MSC data groups
+        """
+
+        with memoryview(data) as view:
+            if view.nbytes <= self.SEGMENT_SIZE:
+                return [self._build_group(view)]
+
+            segments = (view.nbytes + self.SEGMENT_SIZE - 1) // self.SEGMENT_SIZE
+            if segments > self.MAX_SEGMENTS:
+                raise ValueError(f'Message too large to be segmented: {view.nbytes} bytes')
+
+            # A repeated message keeps its Transport Id, a new message gets a new one. Only a digest of the message is
+            # kept to detect this, instead of a copy.
+            message = (view.nbytes, hashlib.sha1(view).digest())
+            if self.last_message != message:
+                self.transport_id = (self.transport_id + 1) % 0x10000
+                self.last_message = message
+
+            groups = []
+
+            for i in range(segments):
+                with view[i * self.SEGMENT_SIZE:(i + 1) * self.SEGMENT_SIZE] as segment:
+                    groups.append(self._build_group(segment, i, i == segments - 1))
+
+            return groups
 
 class PacketBuilder():
     PACKET_LENGTH =      (24,                    48,                    72,                    96                  )
@@ -107,21 +247,10 @@ class PacketBuilder():
         self.coni = 0
         self.address = packet_address & 0xFFFF
 
-    def _build_header(self, packet_length:int, data_length:int) -> bytes:
-        """ Build the Packet header (ETSI EN 300 401 V2.1.1 Section 5.3.2.1) """
-
-        byte0 = 0
-
-        # Packet length
-        if packet_length == self.PACKET_LENGTH[3]:
-            byte0 = 0b11 << 6
-        elif packet_length == self.PACKET_LENGTH[2]:
-            byte0 = 0b10 << 6
-        elif packet_length == self.PACKET_LENGTH[1]:
-            byte0 = 0b01 << 6
-        elif packet_length == self.PACKET_LENGTH[0]:
-            byte0 = 0b00 << 6
+    def _write_header(self, buf:bytearray, offset:int, length_index:int, data_length:int):
+        """ Write the Packet header (ETSI EN 300 401 V2.1.1 Section 5.3.2.1) into buf """
 
+        byte0  = length_index << 6              # Packet length
         byte0 |= self.coni << 4                 # Continuity Index
         self.coni = (self.coni + 1) % 4
         byte0 |= self.first_last << 2           # First/Last
@@ -130,74 +259,724 @@ class PacketBuilder():
         byte2  = 0 << 7                         # Command = Data packet
         byte2 |= data_length                    # Useful data length
 
-        return struct.pack('<ccc', _to_bytes(byte0), _to_bytes(byte1), _to_bytes(byte2))
+        struct.pack_into('!BBB', buf, offset, byte0, byte1, byte2)
 
-    def _build_packet(self, data:bytes, packet_length:int, data_length:int) -> bytearray:
-        # Calculate number of padding bytes conforming to ETSI EN 300 401 V2.1.1 Section 5.3.2.2
-        padding_length = packet_length - 5 - data_length
-
-        packet = bytearray(self._build_header(packet_length, data_length))
-        packet.extend(data)
-        packet += _to_bytes(0b0) * padding_length
-        packet.extend(_crc16(packet))
+    def build(self, data:bytes) -> bytearray:
+        """
+        Split data (i.e. an MSC data group) into DAB packets.
 
-        return packet
+        The packet layout is calculated up front: as many full-size packets as needed, followed by the smallest packet
+        the remaining data fits in. All packets are written into a single preallocated buffer.
+        """
 
-    def build(self, data:bytes) -> bytearray:
+        data = memoryview(data)
         data_length = len(data)
-        i = 0
-
-        for i in reversed(range(-1, len(self.PACKET_LENGTH))):
-            # Attempt to fit data into the smallest possible packet size
-            if i < 0 or data_length > self.PACKET_DATA_LENGTH[i]:
-                if i == 3:
-                    # Data is too large, split into multiple packets
-                    if self.first_last == 0b01 or self.first_last == 0b11:
-                        self.first_last = 0b10
-                    elif self.first_last == 0b10:
-                        self.first_last = 0b00
-
-                    # Split into multiple packets, handle this recursively
-                    first_part = data[:self.PACKET_DATA_LENGTH[i]]
-                    first_packet = self._build_packet(first_part, self.PACKET_LENGTH[i], self.PACKET_DATA_LENGTH[i])
-                    other_packets = self.build(data[self.PACKET_DATA_LENGTH[i]:])
-                    first_packet.extend(other_packets)
-
-                    return first_packet
+        max_data_length = self.PACKET_DATA_LENGTH[-1]
+
+        # Number of full-size packets and the size of the last packet
+        full_packets = max(0, (data_length - 1) // max_data_length)
+        last_data_length = data_length - full_packets * max_data_length
+        last_index = next(i for i, l in enumerate(self.PACKET_DATA_LENGTH) if last_data_length <= l)
+
+        # Padding bytes (ETSI EN 300 401 V2.1.1 Section 5.3.2.2) are already zeroed by bytearray
+        packets = bytearray(full_packets * self.PACKET_LENGTH[-1] + self.PACKET_LENGTH[last_index])
+        view = memoryview(packets)
+
+        offset = 0
+        pos = 0
+        for i in range(full_packets + 1):
+            if i < full_packets:
+                # First or intermediate packet
+                if self.first_last == 0b01 or self.first_last == 0b11:
+                    self.first_last = 0b10
+                elif self.first_last == 0b10:
+                    self.first_last = 0b00
+
+                length_index = len(self.PACKET_LENGTH) - 1
+                chunk_length = max_data_length
+            else:
+                # Last (or only) packet
+                if self.first_last == 0b00 or self.first_last == 0b10:
+                    self.first_last = 0b01
                 else:
-                    if self.first_last == 0b00 or self.first_last == 0b10:
-                        self.first_last = 0b01
-                    else:
-                        self.first_last = 0b11
+                    self.first_last = 0b11
+
+                length_index = last_index
+                chunk_length = last_data_length
+
+            packet_length = self.PACKET_LENGTH[length_index]
+
+            self._write_header(packets, offset, length_index, chunk_length)
+            view[offset + 3:offset + 3 + chunk_length] = data[pos:pos + chunk_length]
+            struct.pack_into('!H', packets, offset + packet_length - 2,
+                             _crc16_int(view[offset:offset + packet_length - 2]))
+
+            offset += packet_length
+            pos += chunk_length
+
+        return packets
+
+class PacketFEC():
+    """
+    Class to generate FEC packets for a packet mode subchannel (ETSI EN 300 401 V2.1.1 Section 5.3.5)
+
+    The packets of the subchannel are written into the Application Data Table (ADT) of 12 rows of 188 bytes, column by
+    column. Once the ADT is full, RS(204, 188) parity bytes are calculated for every row. The resulting RS data table of
+    192 bytes is read column by column and sent in 9 FEC packets on packet address 1022, each consisting of a 2-byte
+    packet header and 22 bytes of parity data.
+    A lost packet is spread over all rows this way, so only a few bytes per row have to be corrected.
+    """
+
+    ROWS = 12
+    COLUMNS = 188
+    PARITY = 16
+
+    ADT_SIZE = ROWS * COLUMNS
+
+    ADDRESS = 1022
+    PACKETS = 9
+    PACKET_DATA_LENGTH = PacketBuilder.PACKET_LENGTH[0] - 2
+
+    def __init__(self):
+        self._adt = bytearray(self.ADT_SIZE)
+        self._length = 0
+        self.coni = 0
+
+    def space(self) -> int:
+        """ Return the number of bytes left in the ADT """
+
+        return self.ADT_SIZE - self._length
+
+    def add(self, packet) -> list | None:
+        """
+        Add a packet to the ADT, the packet has to fit in the remaining space.
+
+        Return the FEC packets once the ADT is full, or None otherwise
+        """
 
-                    return self._build_packet(data, self.PACKET_LENGTH[i + 1], data_length)
+        self._adt[self._length:self._length + len(packet)] = packet
+        self._length += len(packet)
 
-        # FIXME duplicate code
-        if self.first_last == 0b00 or self.first_last == 0b10:
-            self.first_last = 0b01
+        if self._length < self.ADT_SIZE:
+            return None
+
+        self._length = 0
+        return self._build()
+
+    def _build(self) -> list:
+        """ Calculate the parity bytes of the ADT and split these into FEC packets """
+
+        # The ADT is filled column by column, so a row consists of every 12th byte. The RS data table with the parity
+        # bytes of each row is read column by column as well, followed by padding to fill the last FEC packet.
+        rs = bytearray(self.PACKETS * self.PACKET_DATA_LENGTH)
+        for row in range(self.ROWS):
+            rs[row:self.ROWS * self.PARITY:self.ROWS] = _rs_parity(self._adt[row::self.ROWS])
+
+        packets = []
+        for i in range(self.PACKETS):
+            if i == 0:
+                first_last = 0b10
+            elif i == self.PACKETS - 1:
+                first_last = 0b01
+            else:
+                first_last = 0b00
+
+            byte0  = 0 << 6                         # Packet length (24 bytes)
+            byte0 |= self.coni << 4                 # Continuity Index
+            byte0 |= first_last << 2                # First/Last
+            byte0 |= 0b11 & (self.ADDRESS >> 8)     # Packet address
+            byte1  = self.ADDRESS & 0xFF
+
+            self.coni = (self.coni + 1) % 4
+
+            packet = bytes((byte0, byte1)) + rs[i * self.PACKET_DATA_LENGTH:(i + 1) * self.PACKET_DATA_LENGTH]
+            packets.append(packet)
+
+        return packets
+
+def airtime(data:bytes, bitrate:int) -> float:
+    """ Calculate the time (in seconds) it takes to send data as a single message in a subchannel of bitrate kbit/s """
+
+    packets = sum(len(PacketBuilder(0).build(g)) for g in MSCDataGroupBuilder().build(data))
+
+    return packets / (int(bitrate) * 125)
+
+class PacketQueue():
+    """
+    Queue of DAB packets of a single packet address, waiting to be sent by a PacketPacer
+    """
+
+    # Maximum number of MSC data groups waiting to be sent, the input is paused if this is exceeded
+    QUEUE_SIZE = 64
+
+    def __init__(self, weight:int=1):
+        self.weight = weight
+        self.deficit = 0
+
+        self._queue = collections.deque()
+        self._chunk = None
+        self._pos = 0
+
+    def push(self, packets:bytearray):
+        """ Queue packets (i.e. a complete MSC data group split into packets) for sending """
+
+        self._queue.append(packets)
+
+    def pending(self) -> int:
+        """ Return the number of MSC data groups waiting to be sent """
+
+        return len(self._queue) + (self._chunk is not None)
+
+    def full(self) -> bool:
+        """ Check if the input should be paused """
+
+        return len(self._queue) >= self.QUEUE_SIZE
+
+    def peek(self) -> int:
+        """ Return the length of the next packet, or 0 if the queue is empty """
+
+        if self._chunk is None:
+            if not self._queue:
+                return 0
+
+            self._chunk = memoryview(self._queue.popleft())
+            self._pos = 0
+
+        return PacketBuilder.PACKET_LENGTH[self._chunk[self._pos] >> 6]
+
+    def pop(self) -> memoryview:
+        """ Remove the next packet from the queue, peek() has to be called first """
+
+        length = PacketBuilder.PACKET_LENGTH[self._chunk[self._pos] >> 6]
+        packet = self._chunk[self._pos:self._pos + length]
+
+        self._pos += length
+        if self._pos >= len(self._chunk):
+            self._chunk = None
+
+        return packet
+
+class PacketPacer():
+    """
+    Class to pace DAB packets to the capacity of a packet mode subchannel
+
+    Every 24 ms logical frame, a packet mode subchannel carries 3 bytes per kbit/s of its bitrate. Each call to frame()
+    returns exactly one frame worth of packets. Gaps are filled with padding packets (ETSI EN 300 401 V2.1.1 Section
+    5.3.2.2: packet address 0, no useful data), so odr-dabmux never has to buffer more than a few frames.
+
+    Packets of multiple packet addresses (queues) are interleaved using deficit round robin: every round a queue may
+    send weight times the maximum packet length worth of packets.
+
+    If FEC is enabled, FEC packets are inserted after every Application Data Table worth of packets.
+    """
+
+    # Duration of a single logical frame in seconds
+    FRAME_DURATION = 0.024
+
+    def __init__(self, bitrate:int, fec:bool=False):
+        self.frame_size = int(bitrate) * 3
+
+        self._fec = PacketFEC() if fec else None
+        self._fec_packets = collections.deque()
+
+        self._queues = []
+        self._turn = 0
+        self._credited = False
+
+        self._current = None
+        self._pos = 0
+
+        self._padding = {l: self._build_padding(i, l) for i, l in enumerate(PacketBuilder.PACKET_LENGTH)}
+
+        self.packets = 0
+        self.padding_packets = 0
+
+    @staticmethod
+    def _build_padding(length_index:int, length:int) -> bytes:
+        """ Build a padding packet of the specified length """
+
+        packet = bytearray(length)
+        packet[0] = length_index << 6 | 0b11 << 2     # Packet length, First/Last, Packet address 0
+        struct.pack_into('!H', packet, length - 2, _crc16_int(memoryview(packet)[:-2]))
+
+        return bytes(packet)
+
+    def add_queue(self, weight:int=1) -> PacketQueue:
+        """ Add a new queue (for a single packet address) to interleave into the frames """
+
+        q = PacketQueue(weight)
+        self._queues.append(q)
+
+        return q
+
+    def pending(self) -> int:
+        """ Return the number of MSC data groups waiting to be sent """
+
+        return sum(q.pending() for q in self._queues)
+
+    def _next_packet(self, max_length:int) -> memoryview | None:
+        """
+        Pick the next packet using deficit round robin.
+
+        Return None if all queues are empty, or if the next packet is longer than max_length
+        """
+
+        quantum = PacketBuilder.PACKET_LENGTH[-1]
+
+        for _ in range(len(self._queues) + 1):
+            q = self._queues[self._turn]
+            length = q.peek()
+
+            if length > max_length:
+                return None
+
+            if length > 0:
+                # A queue is credited once per round, a full quantum always fits at least one packet
+                if not self._credited:
+                    q.deficit += q.weight * quantum
+                    self._credited = True
+
+                if q.deficit >= length:
+                    q.deficit -= length
+                    return q.pop()
+            else:
+                # Idle queues don't save up credit
+                q.deficit = 0
+
+            self._turn = (self._turn + 1) % len(self._queues)
+            self._credited = False
+
+        return None
+
+    def _next(self, remaining:int) -> bytes:
+        """ Get the next packet to send, remaining is the space left in the current frame """
+
+        if self._fec_packets:
+            return self._fec_packets.popleft()
+
+        # Packets may not straddle Application Data Tables
+        space = self._fec.space() if self._fec is not None else PacketBuilder.PACKET_LENGTH[-1]
+
+        packet = self._next_packet(space)
+
+        if packet is None:
+            # Pad the remaining space, using the largest padding packet that fits
+            length = max((l for l in self._padding if l <= min(remaining, space)), default=min(self._padding))
+
+            packet = self._padding[length]
+            self.padding_packets += 1
         else:
-            self.first_last = 0b11
+            self.packets += 1
+
+        if self._fec is not None:
+            fec = self._fec.add(packet)
+            if fec is not None:
+                self._fec_packets.extend(fec)
+
+        return packet
+
+    def frame(self) -> bytearray:
+        """ Build the next frame """
+
+        frame = bytearray(self.frame_size)
+        offset = 0
+
+        while offset < self.frame_size:
+            # Packets may straddle frames, continue with what is left of the current packet first
+            if self._current is None:
+                self._current = self._next(self.frame_size - offset)
+                self._pos = 0
 
-        return self._build_packet(data, self.PACKET_LENGTH[i + 1], data_length)
+            length = min(len(self._current) - self._pos, self.frame_size - offset)
+            frame[offset:offset + length] = self._current[self._pos:self._pos + length]
 
-class DABDataStream(multiprocessing.Process):
+            offset += length
+            self._pos += length
+
+            if self._pos == len(self._current):
+                self._current = None
+
+        return frame
+
+def frame_message(data:bytes) -> bytes:
+    """ Prefix a message with its length, for writing it to the input FIFO of a data stream """
+
+    return MessageDeframer.HEADER.pack(len(data)) + data
+
+class MessageDeframer():
+    """
+    Split the byte stream read from an input FIFO into messages.
+
+    Every message is prefixed with its length as a 32-bit big-endian integer, so messages written back to back (even
+    by different writers) are kept apart. Messages larger than max_size are skipped without buffering them.
+    """
+
+    HEADER = struct.Struct('!I')
+
+    def __init__(self, max_size:int):
+        self.max_size = max_size
+
+        # Sizes of the messages skipped since the last call to feed()
+        self.dropped = []
+
+        self._buf = bytearray()
+        self._length = None
+        self._skip = 0
+
+    def feed(self, chunk:bytes) -> list:
+        """ Process the next chunk read from the FIFO, return the list of messages completed by it """
+
+        messages = []
+        self.dropped = []
+
+        with memoryview(chunk) as view:
+            pos = 0
+
+            while pos < len(view):
+                if self._skip > 0:
+                    length = min(self._skip, len(view) - pos)
+                    self._skip -= length
+                    pos += length
+                    continue
+
+                if self._length is None:
+                    # The header may be split over multiple chunks as well
+                    length = self.HEADER.size - len(self._buf)
+                    self._buf += view[pos:pos + length]
+                    pos += length
+
+                    if len(self._buf) < self.HEADER.size:
+                        break
+
+                    length = self.HEADER.unpack(self._buf)[0]
+                    self._buf.clear()
+
+                    if length > self.max_size:
+                        self.dropped.append(length)
+                        self._skip = length
+                        continue
+
+                    self._length = length
+
+                length = self._length - len(self._buf)
+                self._buf += view[pos:pos + length]
+                pos += length
+
+                if len(self._buf) == self._length:
+                    messages.append(self._buf)
+                    self._buf = bytearray()
+                    self._length = None
+
+        return messages
+
+    def reset(self) -> int:
+        """ Discard an incomplete message, e.g. when the writer closed the FIFO halfway, return its size in bytes """
+
+        pending = len(self._buf)
+
+        self._buf = bytearray()
+        self._length = None
+        self._skip = 0
+
+        return pending
+
+def parse_sources(streamcfg) -> list:
+    """
+    Parse the packet data sources of a data stream from its streams.ini section.
+
+    The primary source is configured using input_type, input, packet_address (default 1000), weight (default 1) and
+    max_message_size (default 262144 bytes, only used by FIFOs). Additional sources sharing the same subchannel are
+    configured as one source per line in sources:
+      sources = 1001 fifo /tmp/cap-compressed.fifo 2 65536
+                1002 file "/srv/half duplex.bin"
+
+    Return a list of (packet address, input type, input, weight, maximum message size) tuples
+    """
+
+    sources = [(
+        int(streamcfg.get('packet_address', '1000')),
+        streamcfg['input_type'],
+        streamcfg['input'],
+        int(streamcfg.get('weight', '1')),
+        int(streamcfg.get('max_message_size', str(DABDataSource.MAX_MESSAGE_SIZE)))
+    )]
+
+    for line in streamcfg.get('sources', '').splitlines():
+        fields = shlex.split(line)
+        if len(fields) == 0:
+            continue
+
+        if len(fields) not in (3, 4, 5):
+            raise Exception(f'Invalid packet data source: {line}')
+
+        sources.append((
+            int(fields[0]),
+            fields[1],
+            fields[2],
+            int(fields[3]) if len(fields) > 3 else 1,
+            int(fields[4]) if len(fields) > 4 else DABDataSource.MAX_MESSAGE_SIZE
+        ))
+
+    # The largest message that can be segmented into MSC Data Groups
+    max_size = MSCDataGroupBuilder.SEGMENT_SIZE * MSCDataGroupBuilder.MAX_SEGMENTS
+
+    addresses = set()
+    for address, input_type, _, weight, max_message_size in sources:
+        # Address 0 is used for padding packets, 1022 and 1023 are reserved
+        if address < 1 or address > 1021:
+            raise Exception(f'Invalid packet address: {address}')
+        if address in addresses:
+            raise Exception(f'Duplicate packet address: {address}')
+        if input_type not in ('file', 'fifo'):
+            raise Exception(f'Invalid input type for packet address {address}: {input_type}')
+        if weight < 1:
+            raise Exception(f'Invalid weight for packet address {address}: {weight}')
+        if max_message_size < 1 or max_message_size > max_size:
+            raise Exception(f'Invalid maximum message size for packet address {address}: {max_message_size}')
+
+        addresses.add(address)
+
+    return sources
+
+class DABDataEngine():
     """
-    This class represents a data stream as a thread, defined in streams.ini
+    Engine that runs all packet mode data streams from the event loop of the process manager.
+
+    Input FIFOs are read non-blocking as soon as they become readable. A single frame timer writes the next logical
+    frame of every data stream to its (non-blocking) odr-dabmux FIFO.
+    """
+
+    def __init__(self, procmgr):
+        self.procmgr = procmgr
+        self.loop = procmgr.loop
+
+        self.streams = []
+
+        self._timer = None
+        self._deadline = None
+
+    def add(self, stream):
+        """ Start running a data stream, has to be called from the event loop """
+
+        self.streams.append(stream)
+
+        if self._timer is None:
+            self._deadline = self.loop.time()
+            self._timer = self.loop.call_at(self._deadline, self._tick)
+
+    def remove(self, stream):
+        """ Stop running a data stream, has to be called from the event loop """
+
+        if stream in self.streams:
+            self.streams.remove(stream)
+
+        if len(self.streams) == 0 and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _tick(self):
+        """ Send the next frame of all data streams """
+
+        # A failing stream mustn't stop the timer, which would stop all other streams as well
+        for stream in self.streams:
+            try:
+                stream.tick()
+            except Exception as e:
+                logger.error(f'Unable to send the next frame of DAB data stream "{stream.name}". {e}')
+
+        self._deadline += PacketPacer.FRAME_DURATION
+
+        # The event loop stalled, don't try to catch up by bursting frames
+        now = self.loop.time()
+        if now - self._deadline > PacketPacer.FRAME_DURATION:
+            self._deadline = now
+
+        self._timer = self.loop.call_at(self._deadline, self._tick)
+
+class DABDataSource():
+    """
+    A single input of a data stream, sent on its own packet address
+    """
+
+    # Maximum number of bytes to read from the input FIFO at once
+    READ_SIZE = 65536
+
+    # Default maximum size of a message read from the input FIFO, plenty for a CAP message
+    MAX_MESSAGE_SIZE = 262144
+
+    def __init__(self, stream, address:int, input_type:str, input_path:str, weight:int,
+                 max_message_size:int=MAX_MESSAGE_SIZE):
+        self.stream = stream
+        self.address = address
+        self.input_type = input_type
+        self.input_path = input_path
+
+        self.group_builder = MSCDataGroupBuilder()
+        self.packet_builder = PacketBuilder(address)
+        self.queue = stream.pacer.add_queue(weight)
+
+        # TODO check if this is a fifo and create if needed/check for existence file
+        if input_type == 'fifo':
+            utils.create_fifo(input_path)
+        elif input_type == 'file':
+            if not os.path.exists(input_path):
+                raise Exception('DAB data source file does not exist!')
+
+            if not os.path.isfile(input_path):
+                raise Exception('DAB data source is not a file!')
+
+        self._infd = None
+        self._deframer = MessageDeframer(max_message_size)
+
+        # Packets built from the input file, and the (inode, modification time, size) they were built from
+        self._cache = None
+        self._cache_key = None
+
+    def _message(self, data:bytes):
+        """ Pack a complete message into (segmented) MSC Data Groups and queue these as DAB Packets """
+
+        if len(data) == 0:
+            return
+
+        try:
+            groups = self.group_builder.build(data)
+        except ValueError as e:
+            logger.error(f'Dropping message of DAB data stream "{self.stream.name}" ({self.address}). {e}')
+            return
+
+        for group in groups:
+            self.queue.push(self.packet_builder.build(group))
+
+    def _open_input(self):
+        """ Start reading from the input FIFO """
+
+        # Opening a FIFO for reading in non-blocking mode succeeds, even if no writer is connected yet
+        self._infd = os.open(self.input_path, os.O_RDONLY | os.O_NONBLOCK)
+        self.stream.engine.loop.add_reader(self._infd, self._readable)
+
+    def _close_input(self):
+        if self._infd is None:
+            return
+
+        self.stream.engine.loop.remove_reader(self._infd)
+        os.close(self._infd)
+        self._infd = None
+
+    def _readable(self):
+        """ Read from the input FIFO, called from the event loop """
+
+        try:
+            chunk = os.read(self._infd, self.READ_SIZE)
+        except BlockingIOError:
+            return
+
+        if len(chunk) > 0:
+            for message in self._deframer.feed(chunk):
+                self._message(message)
+
+            for length in self._deframer.dropped:
+                logger.error(f'Message of DAB data stream "{self.stream.name}" ({self.address}) exceeds '
+                             f'{self._deframer.max_size} bytes, dropping {length} bytes')
+            return
+
+        # All writers closed the FIFO, a message they didn't finish is lost. Reopen the FIFO to wait for the next
+        # writer, unless too many packets are queued already, tick() will reopen the FIFO once the queue has drained.
+        self._close_input()
+
+        pending = self._deframer.reset()
+        if pending > 0:
+            logger.error(f'Incomplete message of DAB data stream "{self.stream.name}" ({self.address}), '
+                         f'dropping {pending} bytes')
+
+        if not self.queue.full():
+            self._open_input()
+
+    def _read_file(self):
+        """
+        Queue the input file as a single message.
+
+        The packets built from the file are cached until its modification time or size changes, so repeating an
+        unchanged file doesn't have to run the MSC Data Group and Packet builders again.
+        """
+
+        st = os.stat(self.input_path)
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+        if self._cache_key != key:
+            self._cache = None
+            self._cache_key = key
+
+            if st.st_size == 0:
+                return
+
+            # The file is segmented straight from the mapping, the data is only copied into the MSC Data Groups
+            try:
+                with open(self.input_path, 'rb') as infile:
+                    with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        groups = self.group_builder.build(data)
+            except ValueError as e:
+                # Also raised by mmap if the file was truncated to zero bytes in the meantime
+                logger.error(f'Unable to send input file of DAB data stream "{self.stream.name}" '
+                             f'({self.address}). {e}')
+                return
+
+            # The continuity index of the packets has to continue seamlessly when the cached sequence is repeated, so
+            # repeat the MSC Data Groups until the number of packets is a multiple of 4 (the continuity index modulo)
+            coni = self.packet_builder.coni
+            packets = bytearray().join(self.packet_builder.build(g) for g in groups)
+            count = (self.packet_builder.coni - coni) % 4
+            repeat = 4 // math.gcd(count, 4)
+
+            for _ in range(repeat - 1):
+                packets += bytearray().join(self.packet_builder.build(g) for g in groups)
+
+            self._cache = bytes(packets)
+
+        if self._cache is not None:
+            self.queue.push(self._cache)
+
+    def tick(self):
+        """ Refill the queue if needed, called from the event loop every frame """
+
+        try:
+            # Input files are repeated, but only reread once everything has been sent
+            if self.input_type == 'file' and self.queue.pending() == 0:
+                self._read_file()
+            elif self.input_type == 'fifo' and self._infd is None and not self.queue.full():
+                self._open_input()
+        except OSError as e:
+            logger.error(f'Unable to read input of DAB data stream "{self.stream.name}" ({self.address}). {e}')
+
+    def start(self):
+        """ Start reading the input, called from the event loop """
+
+        try:
+            if self.input_type == 'fifo':
+                self._open_input()
+        except OSError as e:
+            logger.error(f'Unable to open input of DAB data stream "{self.stream.name}" ({self.address}). {e}')
+
+    def stop(self):
+        """ Stop reading the input, called from the event loop """
+
+        self._close_input()
+
+class DABDataStream():
     """
+    This class represents a data stream, defined in streams.ini
 
-    # FIFO read buffer size
-    # TODO configure in GUI
-    BUFFER_SIZE = 1024
+    A data stream (packet mode subchannel) carries one or more sources, each on its own packet address.
+    """
 
-    def __init__(self, srvcfg:ConfigParser, name:str, streamcfg, output_path:str):
-        multiprocessing.Process.__init__(self)
+    # Interval at which to retry opening the output FIFO, if odr-dabmux hasn't opened it yet
+    RETRY_INTERVAL = 1
 
+    def __init__(self, srvcfg:ConfigParser, name:str, streamcfg, output_path:str, engine:DABDataEngine):
         self.name = name
-        self.input_path = streamcfg['input']
         self.output_path = output_path
+        self.engine = engine
 
-        self.group_builder = MSCDataGroupBuilder()
-        self.packet_builder = PacketBuilder(1000) # FIXME don't hardcode the packet address, allow configuring in GUI
+        self.pacer = PacketPacer(streamcfg['bitrate'], streamcfg.getboolean('fec', fallback=False))
 
         self.streamdir = f'{srvcfg["general"]["logdir"]}/streams/{self.name}'
 
@@ -205,41 +984,95 @@ class DABDataStream(multiprocessing.Process):
         os.makedirs(self.streamdir, exist_ok=True)
         os.makedirs(f'{self.streamdir}/logs', exist_ok=True)
 
-        # TODO check if this is a fifo and create if needed/check for existence file
-        path = streamcfg['input']
-        if streamcfg['input_type'] == 'fifo':
-            utils.create_fifo(path)
-        elif streamcfg['input_type'] == 'file':
-            if not os.path.exists(path):
-                raise Exception('DAB data source file does not exist!')
+        self.sources = [DABDataSource(self, *source) for source in parse_sources(streamcfg)]
 
-            if not os.path.isfile(path):
-                raise Exception('DAB data source is not a file!')
+        self._outfd = None
+        self._outbuf = None
+        self._retry = None
 
-        self._running = True
+        self.frames = 0
+
+        self._running = False
+
+    def _open_output(self):
+        """ Open the output FIFO, once odr-dabmux has opened it for reading """
+
+        self._retry = None
+
+        try:
+            self._outfd = os.open(self.output_path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            # ENXIO means odr-dabmux hasn't opened the FIFO (yet)
+            if e.errno != errno.ENXIO:
+                logger.error(f'Unable to open output of DAB data stream "{self.name}". {e}')
+
+            self._retry = self.engine.loop.call_later(self.RETRY_INTERVAL, self._open_output)
+
+    def _close_output(self):
+        if self._outfd is None:
+            return
+
+        os.close(self._outfd)
+        self._outfd = None
+        self._outbuf = None
+
+    def tick(self):
+        """ Write the next frame to odr-dabmux, called from the event loop every frame """
+
+        for source in self.sources:
+            source.tick()
+
+        if self._outfd is None:
+            return
+
+        # If the previous frame hasn't been written completely yet odr-dabmux isn't keeping up, don't queue up more
+        if self._outbuf is None:
+            self._outbuf = memoryview(self.pacer.frame())
+            self.frames += 1
 
-    def run(self):
+        try:
+            written = os.write(self._outfd, self._outbuf)
+        except BlockingIOError:
+            return
+        except BrokenPipeError:
+            # odr-dabmux closed the FIFO, wait for it to reopen it
+            self._close_output()
+            self._open_output()
+            return
+
+        self._outbuf = self._outbuf[written:] if written < len(self._outbuf) else None
+
+    def start(self):
         """ Start this data stream """
 
-        while self._running:
-            with open(self.input_path, 'rb') as infile:
-                with open(self.output_path, 'wb') as outfifo:
-                    # Read in blocks to prevent having to load all file contents into memory
-                    while self._running:
-                        indata = infile.read(self.BUFFER_SIZE)
+        self._running = True
+        self.engine.procmgr.call_soon(self._start)
+
+    def _start(self):
+        if not self._running:
+            return
+
+        for source in self.sources:
+            source.start()
+
+        self._open_output()
+        self.engine.add(self)
 
-                        if len(indata) == 0:
-                            # EOF
-                            break
+    def _stop(self):
+        """ Stop reading and writing, called from the event loop """
 
-                        # Pack the data into MSC Data Groups
-                        group = self.group_builder.build(indata)
-                        # Split the MSC Data Groups into DAB Packets
-                        packets = self.packet_builder.build(group)
+        self._running = False
+
+        self.engine.remove(self)
+
+        if self._retry is not None:
+            self._retry.cancel()
+            self._retry = None
 
-                        # Write our packets to odr-dabmux
-                        outfifo.write(packets)
-                        outfifo.flush()
+        for source in self.sources:
+            source.stop()
+
+        self._close_output()
 
     def join(self, timeout:int=3):
         """ Stop this data stream """
@@ -247,8 +1080,22 @@ class DABDataStream(multiprocessing.Process):
         if not self.is_alive():
             return
 
-        self._running = False
-
         # TODO consider deleting the stream directory structure on exiting the thread (or at least add an option in settings)
 
-        super().join(timeout)
+        self.engine.procmgr.call(self._stop)
+
+    def is_alive(self) -> bool:
+        return self._running
+
+    def status(self) -> dict:
+        """ Retrieve the state of this data stream as a dict """
+
+        return {
+            'data': {
+                'connected': self._outfd is not None,
+                'frames': self.frames,
+                'packets': self.pacer.packets,
+                'padding_packets': self.pacer.padding_packets,
+                'pending': self.pacer.pending()
+            }
+        }
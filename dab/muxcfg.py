@@ -19,10 +19,12 @@
 #    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
 #
 
-import copy                                                         # For saving/restoring Config objects
 import os                                                           # For file I/O
 import logging                                                      # Logging facilities
+import threading                                                    # For serializing config writes
+import dab.buffering as buffering                                   # Buffering profiles of ZMQ subchannels
 from dab.boost_info_parser import BoostInfoTree, BoostInfoParser    # C++ Boost INFO format parser (used for dabmux.cfg)
+from dab.data import parse_sources                                  # Packet data sources of data streams
 from dab.streams import DABStreams                               	# DAB streams manager
 
 logger = logging.getLogger('server.dab')
@@ -30,25 +32,49 @@ logger = logging.getLogger('server.dab')
 class ODRMuxConfig():
     """ ODR-DabMux config file wrapper class """
 
-    def __init__(self, zmqfifo: str, streams: DABStreams):
+    def __init__(self, zmqfifo: str, streams: DABStreams, statsport: int = 0):
         self._parser = BoostInfoParser()
 
         self._zmqfifo = zmqfifo
         self._streams = streams
+        self._statsport = statsport
 
         self._cfgfile = None
-        self._oldcfg = None
+        self._saved = False
+        self._pending = False
+        self._lock = threading.Lock()
         self.cfg = None
 
+        # (profile, prebuffering) of every ZMQ subchannel
+        self._buffering = {}
+
     def _overwrite(self, cfg:BoostInfoTree):
         """ Generate subchannels and components from streams.ini """
 
         # overwrite/set zmqendpoint to the temp file generated by DABServer
         cfg.remotecontrol['zmqendpoint'] = f'ipc://{self._zmqfifo}'
 
-        cfg['subchannels']
+        # enable the management server for the telemetry collector, unless the config already sets the port itself
+        if not cfg.general['managementport'].value and self._statsport > 0:
+            cfg.general['managementport'] = str(self._statsport)
+
+        # Keep the (tuned) prebuffering of ZMQ subchannels, and lower the latency of subchannels used by announcements
+        prebuffering = {}
+        for s, subchannel in cfg.subchannels:
+            try:
+                prebuffering[s] = int(subchannel['zmq-prebuffering'].value)
+            except (TypeError, ValueError):
+                pass
+
+        alarm_subchannels = set(str(a.subchannel) for _, a in cfg.ensemble.announcements)
+
         del cfg['subchannels']
-        cfg['components']
+
+        # odr-dabmux requires a components section, even if it's empty
+        if 'components' not in cfg:
+            cfg['components'] = None
+
+        self._buffering = {}
 
         # Generate subchannels from streams.ini
         i = 0
@@ -74,8 +100,20 @@ class ODRMuxConfig():
             if input_type == 'gst':
                 cfg.subchannels[s]['inputproto'] = 'zmq'
                 cfg.subchannels[s]['inputuri'] = f'ipc://{o}'
-                cfg.subchannels[s]['zmq-buffer'] = '40'
-                cfg.subchannels[s]['zmq-prebuffering'] = '20'
+
+                try:
+                    profile = buffering.select_profile(c, s in alarm_subchannels)
+                except Exception as e:
+                    logger.error(f'{s}: {e}')
+                    profile = buffering.PROFILE_DEFAULT
+
+                # Subchannels used by announcements start out at the lowest latency again, as these may have been
+                # regular subchannels before
+                prebuf = buffering.clamp(profile, prebuffering.get(s) if profile == buffering.PROFILE_DEFAULT else None)
+                cfg.subchannels[s]['zmq-buffer'] = str(buffering.buffer_size(prebuf))
+                cfg.subchannels[s]['zmq-prebuffering'] = str(prebuf)
+
+                self._buffering[s] = (profile, prebuf)
             elif input_type in ('file', 'fifo'):
                 cfg.subchannels[s]['inputproto'] = 'file'
                 if output_type == 'data':
@@ -89,7 +127,8 @@ class ODRMuxConfig():
             i += 1
 
         # Generate components
-        for _, component in cfg.components:
+        packet_components = {}
+        for name, component in cfg.components:
             stream_cfg = self._streams.getcfg(str(component['subchannel']))
 
             if stream_cfg is None:
@@ -102,6 +141,9 @@ class ODRMuxConfig():
                 component['type'] = '2'     # multi-channel audio stream
             elif output_type == 'data':
                 component['type'] = '59'    # IP data stream
+                component['packet']['datagroup'] = 'true'
+
+                packet_components.setdefault(str(component['subchannel']), []).append((name, component))
             else:
                 logger.error(f'Invalid output_type: {output_type}')
 
@@ -110,6 +152,58 @@ class ODRMuxConfig():
             if stream_cfg.getboolean('mot_enable'):
                 component['user-applications']['userapp'] = 'slideshow'
 
+        for subchannel, components in packet_components.items():
+            self._overwrite_packet_components(cfg, subchannel, components)
+
+        return True
+
+    def _overwrite_packet_components(self, cfg:BoostInfoTree, subchannel:str, components:list):
+        """
+        Make sure every packet address of a data stream is signalled by exactly one component.
+
+        A component carries the MSC Data Groups of a single packet address of its subchannel. Components that refer to
+        an address that isn't sent, or that is signalled already, take an address without a component, or are removed
+        if there are none left. A component is generated for each remaining address, based on the first component.
+        """
+
+        stream_cfg = self._streams.getcfg(subchannel)
+
+        try:
+            addresses = [str(source[0]) for source in parse_sources(stream_cfg)]
+        except Exception as e:
+            logger.error(f'Invalid packet data sources for {subchannel}. {e}')
+            return
+
+        signalled = {}
+        for name, component in components:
+            address = str(component['packet']['address'])
+            if address in addresses and address not in signalled:
+                signalled[address] = name
+
+        unsignalled = [address for address in addresses if address not in signalled]
+
+        for name, component in components:
+            if signalled.get(str(component['packet']['address'])) == name:
+                continue
+
+            if len(unsignalled) > 0:
+                component['packet']['address'] = unsignalled.pop(0)
+            else:
+                logger.warning(f'Removing component {name}, all packet addresses of {subchannel} have a component')
+                del cfg.components[name]
+
+        first_name, first = components[0]
+        for address in unsignalled:
+            component = cfg.components[f'{first_name}-{address}']
+            component['service'] = str(first['service'])
+            component['subchannel'] = subchannel
+            component['type'] = '59'        # IP data stream
+            component['packet']['address'] = address
+            component['packet']['datagroup'] = 'true'
+
+            if stream_cfg.getboolean('mot_enable'):
+                component['user-applications']['userapp'] = 'slideshow'
+
         return True
 
     def load(self, cfgfile:str) -> bool:
@@ -145,7 +239,6 @@ class ODRMuxConfig():
         self.cfg.general['nbframes'] = '0'              # Don't limit the number of ETI frames generated
         self.cfg.general['syslog'] = 'false'
         self.cfg.general['tist'] = 'false'              # Disable downloading leap second information
-        self.cfg.general['managementport'] = '0'        # Disable management port
 
         # Some sane ensemble defaults
         self.cfg.ensemble['id'] = '0x8FFF'               # Default to The Netherlands
@@ -167,21 +260,71 @@ class ODRMuxConfig():
         return True
 
     def save(self):
-        """ Save a temporary copy of the current config file in memory """
+        """ Take a snapshot of the current config, this only starts recording the changes made from now on """
 
-        self._oldcfg = copy.deepcopy(self.cfg)
+        with self._lock:
+            self.cfg.snapshot()
+            self._saved = True
 
     def restore(self):
-        """ Restore the temporary copy made with save() """
+        """ Undo all changes since the snapshot was taken with save() """
 
-        if self._oldcfg is None:
-            return
+        with self._lock:
+            if not self._saved:
+                return
+
+            self.cfg.rollback()
+            self._saved = False
+
+            # Write any changes to the buffering that weren't written because of the snapshot
+            if self._pending:
+                self._write(self.cfg)
+                self._pending = False
 
-        self.cfg = self._oldcfg
-        self._oldcfg = None
+    @property
+    def managementport(self) -> int:
+        """ Port of the management server of odr-dabmux, 0 if it's disabled """
+
+        try:
+            return int(self.cfg.general['managementport'].value)
+        except (TypeError, ValueError):
+            return 0
+
+    def get_buffering(self, subchannel:str) -> tuple[str, int] | None:
+        """ Get the buffering profile and prebuffering (in frames) of a ZMQ subchannel, or None if it isn't one """
+
+        return self._buffering.get(subchannel)
+
+    def set_buffering(self, subchannel:str, profile:str, prebuffering:int):
+        """ Change the buffering of a ZMQ subchannel and write it to the config file """
+
+        with self._lock:
+            if subchannel in self.cfg.subchannels:
+                # Assign the values directly, so these changes aren't undone by restore()
+                subch = self.cfg.subchannels[subchannel]
+                subch['zmq-buffer'].value = str(buffering.buffer_size(prebuffering))
+                subch['zmq-prebuffering'].value = str(prebuffering)
+
+            self._buffering[subchannel] = (profile, prebuffering)
+
+            # Don't write out any changes that are still being made, these are saved or restored later on
+            if self._saved:
+                self._pending = True
+            else:
+                self._write(self.cfg)
+
+    def _write(self, cfg:BoostInfoTree):
+        self._parser.load(cfg)
+        if not self._parser.write(self._cfgfile):
+            logger.debug(f'{self._cfgfile} is unchanged, not writing it')
 
     def write(self):
-        """ Write the config to a file """
+        """ Write the config to a file, this makes all changes permanent and releases the snapshot taken by save() """
+
+        with self._lock:
+            self._write(self.cfg)
+            self._pending = False
 
-        self._parser.load(self.cfg)
-        self._parser.write(self._cfgfile)
+            if self._saved:
+                self.cfg.release()
+                self._saved = False
@@ -0,0 +1,330 @@
+#
+#    CFNS - Rijkswaterstaat CIV, Delft © 2022 <cfns@rws.nl>
+#
+#    Copyright 2022 Bastiaan Teeuwen <bastiaan@mkcl.nl>
+#
+#    This file is part of cap-dab-server
+#
+#    cap-dab-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    cap-dab-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import logging                          # Logging facilities
+import threading                        # For serializing access to the socket
+import time                             # For command deadlines
+import zmq                              # For signalling (alarm) announcements to ODR-DabMux
+
+logger = logging.getLogger('server.dab')
+
+def _failed(reply:str) -> bool:
+    """ Check if a reply is an error, these consist of 'fail' followed by the error message """
+
+    return reply.startswith('fail')
+
+class MuxControlClient():
+    """
+    Thread-safe client for the ZMQ remote control of ODR-DabMux.
+
+    The remote control is a REP socket. A DEALER socket is used to talk to it, so the socket doesn't get stuck in the
+    strict send/receive cycle of a REQ socket. All commands are serialized using a lock, so there's only ever a single
+    command in flight and every reply belongs to the command that was just sent.
+
+    The remote control is pinged once after connecting, not before every command.
+
+    Multiple commands can be pipelined as a batch, which only takes a single round trip.
+
+    Every command has a deadline. If no reply is received in time, the socket is recreated (so a late reply can't be
+    mistaken for the reply to the next command) and get/set commands, which are idempotent, are retried. After a number
+    of consecutive failed commands the circuit breaker opens: commands fail right away, until a single command is let
+    through again after a cooldown period. This way a dead odr-dabmux can't hang the CAPWatcher or the TUI.
+
+    The values of parameters that were set or retrieved are mirrored locally, so reads don't need a round trip and sets
+    that wouldn't change anything are skipped. The mirror is refreshed in the background, to pick up changes made by
+    other remote control clients, and has to be invalidated when odr-dabmux restarts.
+    """
+
+    # Maximum time to wait for a reply in seconds
+    TIMEOUT = 1.0
+
+    # Number of times to retry get/set commands
+    RETRIES = 2
+
+    # Number of consecutive failed commands after which the circuit breaker opens, and the time it stays open
+    BREAKER_THRESHOLD = 3
+    BREAKER_COOLDOWN = 10
+
+    # Interval at which the mirrored parameters are refreshed in seconds
+    REFRESH_INTERVAL = 5
+
+    def __init__(self, context:zmq.Context, endpoint:str):
+        self._context = context
+        self._endpoint = endpoint
+
+        self._lock = threading.Lock()
+        self._sock = None
+        self._verified = False
+
+        self._failures = 0
+        self._open_until = None
+
+        # Mirrored (module, param) values, with a separate lock so reads never wait for a command in flight
+        self._mirror_lock = threading.Lock()
+        self._mirror = {}
+        self._tracked = set()
+
+        # Incremented by every set and invalidate, lookups that were started before it are stale and aren't mirrored
+        self._generation = 0
+
+        self._refresher = None
+        self._closed = threading.Event()
+
+    def _connect(self):
+        self._sock = self._context.socket(zmq.DEALER)
+        self._sock.setsockopt(zmq.LINGER, 0)
+        self._sock.connect(self._endpoint)
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+        self._verified = False
+
+    def _request(self, batch:list, deadline:float) -> list:
+        """
+        Send a batch of requests at once and wait for all replies, the lock has to be held.
+
+        The remote control handles the requests one by one and replies in the same order, so the requests are pipelined
+        and only a single round trip is needed for the entire batch.
+
+        A TimeoutError exception is raised if not all replies were received before the deadline
+        """
+
+        if self._sock is None:
+            self._connect()
+
+        # A DEALER socket has to add the empty delimiter frame a REQ socket adds implicitly
+        for msgs in batch:
+            self._sock.send_multipart([b'', *(part.encode() for part in msgs)])
+
+        replies = []
+        while len(replies) < len(batch):
+            timeout = max(0, deadline - time.monotonic())
+            if self._sock.poll(int(timeout * 1000), zmq.POLLIN) == 0:
+                raise TimeoutError(f'No reply from ODR-DabMux within {self.TIMEOUT}s')
+
+            reply = self._sock.recv_multipart()
+            replies.append(reply[1:] if len(reply) > 0 and reply[0] == b'' else reply)
+
+        return replies
+
+    def _attempt(self, batch:list) -> list | None:
+        """ Attempt to send a batch of commands once, the lock has to be held """
+
+        deadline = time.monotonic() + self.TIMEOUT
+
+        if not self._verified:
+            reply = self._request([('ping',)], deadline)[0]
+            if len(reply) == 0 or reply[0].decode() != 'ok':
+                return None
+
+            self._verified = True
+
+        return [''.join(part.decode() for part in reply) for reply in self._request(batch, deadline)]
+
+    def batch(self, batch:list, retries:int=0) -> list:
+        """
+        Send a batch of commands to ODR-DabMux in a single round trip and wait for all replies, this can be called from
+        any thread. Use this to make multiple changes land in the same few ETI frames.
+
+        Return a list with the reply to each command, all replies are None if the remote control didn't respond (in time)
+        """
+
+        if len(batch) == 0:
+            return []
+
+        with self._lock:
+            now = time.monotonic()
+
+            if self._open_until is not None and now < self._open_until:
+                return [None] * len(batch)
+
+            for attempt in range(retries + 1):
+                try:
+                    res = self._attempt(batch)
+                except (TimeoutError, zmq.ZMQError) as e:
+                    cmds = '; '.join(' '.join(msgs) for msgs in batch)
+                    logger.warning(f'ODR-DabMux remote control: {cmds} failed (attempt {attempt + 1}). {e}')
+
+                    # Recreate the socket, so a late reply isn't received as the reply to the next command
+                    self._disconnect()
+                    continue
+
+                if res is not None:
+                    if self._open_until is not None:
+                        logger.info('ODR-DabMux remote control is responding again')
+
+                    self._failures = 0
+                    self._open_until = None
+
+                    return res
+
+            self._failures += 1
+            if self._failures >= self.BREAKER_THRESHOLD:
+                if self._open_until is None:
+                    logger.error(f'ODR-DabMux remote control is not responding, pausing commands for '
+                                 f'{self.BREAKER_COOLDOWN}s')
+
+                self._open_until = time.monotonic() + self.BREAKER_COOLDOWN
+
+            return [None] * len(batch)
+
+    def send(self, msgs:tuple, retries:int=0) -> str | None:
+        """
+        Send a command to ODR-DabMux and wait for the reply, this can be called from any thread.
+
+        Return the received reply, or None if the remote control didn't respond (in time)
+        """
+
+        return self.batch([msgs], retries)[0]
+
+    def _update(self, params:list, results:list, generation:int=None):
+        """
+        Update the mirror with the results of a batch of (module, param, value) changes, or of lookups if generation is
+        set.
+
+        The results of lookups are dropped if a set or invalidate happened since generation was taken, as they might
+        have been answered before the set took effect and would overwrite the newer value
+        """
+
+        with self._mirror_lock:
+            if generation is None:
+                self._generation += 1
+            elif generation != self._generation:
+                self._tracked.update((module, param) for module, param, _ in params)
+                return
+
+            for (module, param, value), res in zip(params, results):
+                key = (module, param)
+                self._tracked.add(key)
+
+                # The value is unknown if the command failed, don't keep a stale value around
+                if res is None or value is None or _failed(value):
+                    self._mirror.pop(key, None)
+                else:
+                    self._mirror[key] = value
+
+    def get(self, module:str, param:str, cached:bool=True) -> str | None:
+        """ Get the value of a parameter of a module, from the mirror if available unless cached is False """
+
+        with self._mirror_lock:
+            value = self._mirror.get((module, param)) if cached else None
+            generation = self._generation
+        if value is not None:
+            return value
+
+        value = self.send(('get', module, param), self.RETRIES)
+        self._update([(module, param, value)], [value], generation)
+
+        return value
+
+    def set(self, module:str, param:str, value:str, force:bool=False) -> str | None:
+        """ Set a parameter of a module, return 'ok' on success """
+
+        return self.set_many([(module, param, value)], force)[0]
+
+    def set_many(self, params:list, force:bool=False) -> list:
+        """
+        Set multiple (module, param, value) parameters in a single batch, return 'ok' for each successful set.
+
+        Parameters that already have this value according to the mirror are skipped (and reported as 'ok'), unless
+        force is True
+        """
+
+        results = ['ok'] * len(params)
+
+        with self._mirror_lock:
+            pending = [i for i, (module, param, value) in enumerate(params)
+                       if force or self._mirror.get((module, param)) != value]
+
+        # Setting a parameter to a value is idempotent, so it's safe to retry
+        sent = [params[i] for i in pending]
+        replies = self.batch([('set', *p) for p in sent], self.RETRIES)
+
+        for i, res in zip(pending, replies):
+            results[i] = res
+
+        if len(sent) > 0:
+            self._update(sent, [res if res == 'ok' else None for res in replies])
+
+        return results
+
+    def track(self, keys:list):
+        """ Start mirroring a list of (module, param) parameters, their values are retrieved on the next refresh """
+
+        with self._mirror_lock:
+            self._tracked.update(keys)
+
+    def invalidate(self):
+        """ Forget all mirrored values, call this when odr-dabmux was restarted and is back at its configured state """
+
+        with self._mirror_lock:
+            self._mirror.clear()
+            self._generation += 1
+
+    def refresh(self):
+        """ Retrieve the current values of all tracked parameters from odr-dabmux in a single batch """
+
+        with self._mirror_lock:
+            keys = sorted(self._tracked)
+            generation = self._generation
+
+        replies = self.batch([('get', module, param) for module, param in keys])
+        self._update([(module, param, res) for (module, param), res in zip(keys, replies)], replies, generation)
+
+    def _refresh_loop(self):
+        while not self._closed.wait(self.REFRESH_INTERVAL):
+            self.refresh()
+
+    def start_refresh(self):
+        """ Start refreshing the mirror in the background """
+
+        if self._refresher is not None:
+            return
+
+        self._closed.clear()
+        self._refresher = threading.Thread(target=self._refresh_loop, name='muxctl-refresh', daemon=True)
+        self._refresher.start()
+
+    def status(self) -> dict:
+        """ Retrieve the state of the remote control connection as a dict """
+
+        with self._lock:
+            return {
+                'connected': self._verified,
+                'failures': self._failures,
+                'breaker_open': self._open_until is not None
+            }
+
+    def close(self):
+        """ Stop refreshing the mirror and close the socket, it's reopened on the next command """
+
+        self._closed.set()
+        if self._refresher is not None:
+            self._refresher.join()
+            self._refresher = None
+
+        with self._lock:
+            self._disconnect()
+
+        self.invalidate()
@@ -0,0 +1,178 @@
+#
+#    CFNS - Rijkswaterstaat CIV, Delft © 2022 <cfns@rws.nl>
+#
+#    Copyright 2022 Bastiaan Teeuwen <bastiaan@mkcl.nl>
+#
+#    This file is part of cap-dab-server
+#
+#    cap-dab-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    cap-dab-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import asyncio                          # Event loop that watches all child processes
+import atexit                           # For stopping the event loop on exit
+import concurrent.futures               # For waiting on calls executed in the event loop
+import logging                          # Logging facilities
+import os                               # For pidfd support
+import subprocess as subproc            # Support for starting subprocesses
+import threading                        # Threading support (for running the event loop in the background)
+from dab.procstat import ProcessStats   # Per-process resource accounting
+from dab.sched import SchedPolicy       # CPU affinity and scheduling policy
+
+logger = logging.getLogger('server.dab')
+
+class ODRProcessManager():
+    """
+    Child process manager that owns all odr-* processes.
+
+    A single asyncio event loop is run in a background thread. Process exits are picked up through a pidfd (Linux 5.3+)
+    registered with the event loop, so no thread has to block on a process. On platforms without pidfd support, the
+    processes are polled from the event loop instead.
+
+    The resource usage of all processes is sampled periodically from the event loop, other processes can be added to
+    the sampling using stats.watch().
+    """
+
+    # Interval at which to poll for exited processes if pidfds are not supported
+    POLL_INTERVAL = 0.5
+
+    # Interval at which to sample the resource usage of all processes
+    SAMPLE_INTERVAL = 5
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._stopped = False
+
+        self.stats = ProcessStats()
+        if self.stats.enabled:
+            self.loop.call_soon_threadsafe(self._sample)
+
+        self._thread = threading.Thread(target=self._run, name='odr-procmgr', daemon=True)
+        self._thread.start()
+
+        atexit.register(self.stop)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _in_loop(self) -> bool:
+        """ Check if we're currently running in the event loop thread """
+
+        return threading.current_thread() is self._thread
+
+    def call_soon(self, callback, *args):
+        """ Schedule callback to be run in the event loop, this can be called from any thread """
+
+        if self._in_loop():
+            self.loop.call_soon(callback, *args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def call(self, callback, *args):
+        """
+        Run callback in the event loop and wait for it to finish, this can be called from any thread.
+
+        Return the value returned by callback
+        """
+
+        if self._in_loop() or self._stopped:
+            return callback(*args)
+
+        future = concurrent.futures.Future()
+
+        def _call():
+            try:
+                future.set_result(callback(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(_call)
+
+        return future.result()
+
+    def _sample(self):
+        """ Periodically sample the resource usage of all processes """
+
+        self.stats.sample()
+        self.loop.call_later(self.SAMPLE_INTERVAL, self._sample)
+
+    def spawn(self, args, on_exit=None, sched:SchedPolicy=None, **kwargs) -> subproc.Popen:
+        """
+        Start a new child process, kwargs are passed on to subprocess.Popen.
+
+        on_exit(proc) is called from the event loop once the process has exited and has been reaped.
+        sched is applied to the process right after it has been started.
+
+        Return the Popen handle of the new process
+        """
+
+        proc = subproc.Popen(args, **kwargs)
+        if sched is not None and sched.enabled():
+            sched.apply_process(proc.pid)
+            sched.check(proc.pid)
+        self.stats.watch(proc.pid)
+
+        # Open the pidfd right away, before anyone else gets the chance to reap the process
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except (AttributeError, OSError):
+            pidfd = None
+
+        self.call_soon(self._watch, proc, pidfd, on_exit)
+
+        return proc
+
+    def _watch(self, proc:subproc.Popen, pidfd:int | None, on_exit):
+        """ Start watching a process for its exit """
+
+        if pidfd is None:
+            self._poll(proc, on_exit)
+        else:
+            # A pidfd becomes readable once the process exits
+            self.loop.add_reader(pidfd, self._reap, proc, pidfd, on_exit)
+
+    def _reap(self, proc:subproc.Popen, pidfd:int, on_exit):
+        """ Reap an exited process and call its exit callback """
+
+        self.loop.remove_reader(pidfd)
+        os.close(pidfd)
+
+        # The process has already exited, so this doesn't block
+        proc.wait()
+        self.stats.unwatch(proc.pid)
+
+        if on_exit is not None:
+            on_exit(proc)
+
+    def _poll(self, proc:subproc.Popen, on_exit):
+        """ Fallback for platforms without pidfd support """
+
+        if proc.poll() is None:
+            self.loop.call_later(self.POLL_INTERVAL, self._poll, proc, on_exit)
+            return
+
+        self.stats.unwatch(proc.pid)
+        if on_exit is not None:
+            on_exit(proc)
+
+    def stop(self):
+        """ Stop the event loop """
+
+        if self._stopped:
+            return
+
+        self._stopped = True
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
@@ -0,0 +1,124 @@
+#
+#    CFNS - Rijkswaterstaat CIV, Delft © 2022 <cfns@rws.nl>
+#
+#    Copyright 2022 Bastiaan Teeuwen <bastiaan@mkcl.nl>
+#
+#    This file is part of cap-dab-server
+#
+#    cap-dab-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    cap-dab-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os                               # For reading /proc and system configuration
+import time                             # For monotonic timestamps
+
+class ProcessStats():
+    """
+    Per-process CPU, memory, context switch and I/O accounting, sampled from /proc/<pid>.
+
+    Only Linux is supported, on other platforms no samples are available.
+    """
+
+    def __init__(self):
+        self.enabled = os.path.isdir('/proc/self')
+
+        self._clk_tck = os.sysconf('SC_CLK_TCK') if self.enabled else 100
+        self._pagesize = os.sysconf('SC_PAGE_SIZE') if self.enabled else 4096
+
+        # Last (cpu ticks, timestamp) per pid, used to calculate CPU usage between samples
+        self._ticks = {}
+        self._samples = {}
+
+    def watch(self, pid:int):
+        """ Start sampling the process with the specified pid """
+
+        self._ticks.setdefault(pid, None)
+
+    def unwatch(self, pid:int):
+        """ Stop sampling the process with the specified pid """
+
+        self._ticks.pop(pid, None)
+        self._samples.pop(pid, None)
+
+    def get(self, pid:int) -> dict | None:
+        """ Get the last sample of a process, or None if no sample is available (yet) """
+
+        return self._samples.get(pid)
+
+    def _read(self, pid:int) -> dict:
+        """ Read the current counters of a process from /proc/<pid> """
+
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            # Skip the pid and command name, the latter may contain spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+
+        # Fields are offset by 3 (pid, comm and state) compared to proc(5)
+        sample = {
+            'pid': pid,
+            'ticks': int(fields[11]) + int(fields[12]),     # utime + stime
+            'rss': int(fields[21]) * self._pagesize,
+            'ctx_voluntary': None,
+            'ctx_involuntary': None,
+            'read_bytes': None,
+            'write_bytes': None
+        }
+
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('voluntary_ctxt_switches:'):
+                    sample['ctx_voluntary'] = int(line.split()[1])
+                elif line.startswith('nonvoluntary_ctxt_switches:'):
+                    sample['ctx_involuntary'] = int(line.split()[1])
+
+        # rchar/wchar also count I/O on pipes, FIFOs and sockets, which is what most of our processes do
+        try:
+            with open(f'/proc/{pid}/io', 'r') as f:
+                for line in f:
+                    if line.startswith('rchar:'):
+                        sample['read_bytes'] = int(line.split()[1])
+                    elif line.startswith('wchar:'):
+                        sample['write_bytes'] = int(line.split()[1])
+        except OSError:
+            # Not permitted on hardened kernels
+            pass
+
+        return sample
+
+    def sample(self):
+        """ Take a new sample of all watched processes """
+
+        if not self.enabled:
+            return
+
+        now = time.monotonic()
+
+        for pid in list(self._ticks.keys()):
+            try:
+                sample = self._read(pid)
+            except (OSError, IndexError, ValueError):
+                # The process has exited in the meantime
+                self._samples.pop(pid, None)
+                continue
+
+            ticks = sample.pop('ticks')
+            last = self._ticks.get(pid)
+
+            if last is not None and now > last[1]:
+                sample['cpu'] = round((ticks - last[0]) / self._clk_tck / (now - last[1]) * 100, 1)
+            else:
+                sample['cpu'] = None
+
+            # Don't resurrect processes that were unwatched while sampling
+            if pid in self._ticks:
+                self._ticks[pid] = (ticks, now)
+                self._samples[pid] = sample
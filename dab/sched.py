@@ -0,0 +1,167 @@
+#
+#    CFNS - Rijkswaterstaat CIV, Delft © 2022 <cfns@rws.nl>
+#
+#    Copyright 2022 Bastiaan Teeuwen <bastiaan@mkcl.nl>
+#
+#    This file is part of cap-dab-server
+#
+#    cap-dab-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    cap-dab-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
+#
+
+from configparser import ConfigParser   # For parsing the server config
+import logging                          # Logging facilities
+import os                               # For setting affinity, nice levels and scheduling policies
+
+logger = logging.getLogger('server.dab')
+
+def _parse_cpus(cpus:str) -> set:
+    """ Parse a CPU list such as "0-1,3" into a set of CPU numbers """
+
+    cpuset = set()
+
+    for part in cpus.split(','):
+        part = part.strip()
+        if part == '':
+            continue
+
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpuset.update(range(int(first), int(last) + 1))
+        else:
+            cpuset.add(int(part))
+
+    return cpuset
+
+class SchedPolicy():
+    """
+    CPU affinity, nice level and scheduling policy for a class of processes (dabmux, dabmod, audioenc or padenc).
+
+    These are configured in the [sched] section of server.ini, using the following options (all optional):
+      {class}_cpus      CPU list the processes are allowed to run on, i.e. 0-1,3
+      {class}_nice      Nice level (-20 to 19)
+      {class}_policy    Scheduling policy: other, batch, idle, fifo or rr
+      {class}_priority  Real-time priority (1 to 99) for the fifo and rr policies
+    """
+
+    POLICIES = {
+        'other': 'SCHED_OTHER',
+        'batch': 'SCHED_BATCH',
+        'idle':  'SCHED_IDLE',
+        'fifo':  'SCHED_FIFO',
+        'rr':    'SCHED_RR'
+    }
+
+    def __init__(self, srvcfg:ConfigParser, proc_class:str):
+        self.proc_class = proc_class
+
+        self.cpus = None
+        self.nice = None
+        self.policy = None
+        self.priority = 0
+
+        if not srvcfg.has_section('sched'):
+            return
+
+        cfg = srvcfg['sched']
+
+        try:
+            cpus = cfg.get(f'{proc_class}_cpus', '')
+            if cpus != '':
+                self.cpus = _parse_cpus(cpus)
+
+            nice = cfg.get(f'{proc_class}_nice', '')
+            if nice != '':
+                self.nice = int(nice)
+
+            policy = cfg.get(f'{proc_class}_policy', '')
+            if policy != '':
+                self.policy = getattr(os, self.POLICIES[policy])
+
+            priority = cfg.get(f'{proc_class}_priority', '')
+            if priority != '':
+                self.priority = int(priority)
+        except (KeyError, ValueError) as e:
+            raise Exception(f'Invalid scheduling configuration for {proc_class}. {e}')
+        except AttributeError:
+            logger.warning(f'Scheduling policy {policy} for {proc_class} is not supported on this platform')
+            self.policy = None
+
+        # Real-time policies require a priority, others require a priority of 0
+        if self.policy in (getattr(os, 'SCHED_FIFO', None), getattr(os, 'SCHED_RR', None)):
+            if self.priority < 1:
+                self.priority = 1
+        else:
+            self.priority = 0
+
+        if self.cpus is not None and not hasattr(os, 'sched_setaffinity'):
+            logger.warning(f'CPU affinity for {proc_class} is not supported on this platform')
+            self.cpus = None
+
+    def enabled(self) -> bool:
+        """ Check if anything has to be applied at all """
+
+        return self.cpus is not None or self.nice is not None or self.policy is not None
+
+    def apply(self, pid:int=0):
+        """
+        Apply the affinity, nice level and scheduling policy to a process, pid 0 refers to the calling process.
+
+        An OSError exception is raised if this is not permitted.
+        """
+
+        if self.cpus is not None:
+            os.sched_setaffinity(pid, self.cpus)
+        if self.nice is not None:
+            os.setpriority(os.PRIO_PROCESS, pid, self.nice)
+        if self.policy is not None:
+            os.sched_setscheduler(pid, self.policy, os.sched_param(self.priority))
+
+    def apply_process(self, pid:int):
+        """
+        Apply the policy to a running child process and all threads it has created so far, threads created afterwards
+        inherit it. Errors aren't reported from here, use check() afterwards instead.
+
+        This is done from the parent after spawning the process instead of in between fork and exec, as a preexec_fn
+        isn't safe to use in a process with multiple threads.
+        """
+
+        try:
+            tids = [int(tid) for tid in os.listdir(f'/proc/{pid}/task')]
+        except OSError:
+            tids = [pid]
+
+        for tid in tids:
+            try:
+                self.apply(tid)
+            except ProcessLookupError:
+                # The thread has exited already
+                pass
+            except OSError:
+                # Not permitted, reported by check()
+                return
+
+    def check(self, pid:int):
+        """ Check if the policy was applied to a process and log a warning if it wasn't """
+
+        try:
+            if self.cpus is not None and os.sched_getaffinity(pid) != self.cpus:
+                logger.warning(f'Unable to set CPU affinity of {self.proc_class} (pid {pid})')
+            if self.nice is not None and os.getpriority(os.PRIO_PROCESS, pid) != self.nice:
+                logger.warning(f'Unable to set nice level of {self.proc_class} (pid {pid})')
+            if self.policy is not None and os.sched_getscheduler(pid) != self.policy:
+                logger.warning(f'Unable to set scheduling policy of {self.proc_class} (pid {pid}), '
+                               'real-time policies require CAP_SYS_NICE')
+        except OSError:
+            # The process has exited already
+            pass
@@ -19,27 +19,39 @@
 #    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
 #
 
-import atexit                           # For cleaning up ZMQ context upon garbage collection
-from configparser import ConfigParser   # For parsing the server config
-import os                               # For file I/O
-import logging                          # Logging facilities
-import queue                            # Queue for passing data to the DAB processing thread
-import subprocess as subproc            # Support for starting subprocesses
-import threading                        # Threading support (for running odr-dabmux and odr-dabmod in the background)
-import time                             # For sleep support
-import zmq                              # For signalling (alarm) announcements to ODR-DabMux
-from dab.muxcfg import ODRMuxConfig     # odr-dabmux config
-from dab.streams import DABStreams      # DAB streams manager
-from dab.watcher import CAPWatcher      # DAB CAP message watcher
+import atexit                               # For cleaning up ZMQ context upon garbage collection
+from configparser import ConfigParser       # For parsing the server config
+import os                                   # For file I/O
+import logging                              # Logging facilities
+import queue                                # Queue for passing data to the DAB processing thread
+import subprocess as subproc                # Support for starting subprocesses
+import time                                 # For monotonic timestamps
+import zmq                                  # For signalling (alarm) announcements to ODR-DabMux
+from dab.buffering import AdaptiveBuffering # Tuning of the ZMQ input buffers of odr-dabmux
+from dab.muxcfg import ODRMuxConfig         # odr-dabmux config
+from dab.muxctl import MuxControlClient     # odr-dabmux remote control
+from dab.procmgr import ODRProcessManager   # Owner of all odr-* processes
+from dab.sched import SchedPolicy           # CPU affinity and scheduling policy
+from dab.streams import DABStreams          # DAB streams manager
+from dab.telemetry import MuxTelemetry      # odr-dabmux telemetry collector
+from dab.watcher import CAPWatcher          # DAB CAP message watcher
 import utils
 
 logger = logging.getLogger('server.dab')
 
-class ODRServer(threading.Thread):
-    """ OpenDigitalRadio DAB Multiplexer and Modulator support """
+class ODRServer():
+    """
+    OpenDigitalRadio DAB Multiplexer and Modulator support
 
-    def __init__(self, srvcfg:ConfigParser):
-        threading.Thread.__init__(self)
+    odr-dabmux and odr-dabmod are owned by the ODRProcessManager, this class only reacts to their exits.
+    """
+
+    # Seconds to wait for sockets to unbind before restarting
+    RESTART_DELAY = 4
+
+    def __init__(self, srvcfg:ConfigParser, procmgr:ODRProcessManager, on_mux_start=None):
+        self._procmgr = procmgr
+        self._on_mux_start = on_mux_start
 
         self.logdir = srvcfg['general']['logdir']
         self.binpath = srvcfg['dab']['odrbin_path']
@@ -47,6 +59,9 @@ class ODRServer(threading.Thread):
         self.modcfg = srvcfg['dab']['mod_config']
         self.output = '/tmp/welle-io.fifo'           # FIXME FIXME FIXME FIXME get from dabmod.ini (filename)
 
+        self._mux_sched = SchedPolicy(srvcfg, 'dabmux')
+        self._mod_sched = SchedPolicy(srvcfg, 'dabmod')
+
         self.mux = None
         self.mod = None
 
@@ -65,73 +80,170 @@ class ODRServer(threading.Thread):
             if not os.access(modbin, os.X_OK):
                 raise Exception(f'DAB Modulator binary not executable: {modbin}')
 
-        self._running = True
+        # Cached state of odr-dabmux and odr-dabmod, updated when they're started and by exit notifications
+        self._procstate = {
+            'odr-dabmux': {'running': False, 'started': None, 'restarts': 0, 'last_exit': None},
+            'odr-dabmod': {'running': False, 'started': None, 'restarts': 0, 'last_exit': None}
+        }
+
+        self._failcounter = 0
+        self._timer = None
+        self._muxlog = None
+        self._modlog = None
+        self._running = False
 
-    def run(self):
-        """ Start the DAB server thread, which includes odr-dabmux and odr-dabmod """
+    def start(self):
+        """ Start the DAB server, which includes odr-dabmux and odr-dabmod """
 
         # TODO rotate this log, this is not so straightforward it appears
-        muxlog = open(f'{self.logdir}/dabmux.log', 'ab')
-        modlog = open(f'{self.logdir}/dabmod.log', 'ab')
+        self._muxlog = open(f'{self.logdir}/dabmux.log', 'ab')
+        self._modlog = open(f'{self.logdir}/dabmod.log', 'ab')
 
         # Create the FIFO that odr-dabmod outputs to
         utils.create_fifo(self.output)
 
-        failcounter = 0
-        while self._running and failcounter < 4:
-            # Start up odr-dabmux DAB multiplexer
-            muxlog.write('\n'.encode('utf-8'))
-            self.mux = subproc.Popen((f'{self.binpath}/odr-dabmux', self.muxcfg), stdout=subproc.PIPE, stderr=muxlog)
+        self._running = True
+        self._procmgr.call_soon(self._start)
 
-            # Start up odr-dabmod DAB modulator
-            modlog.write('\n'.encode('utf-8'))
-            self.mod = subproc.Popen((f'{self.binpath}/odr-dabmod', self.modcfg),
-                                    stdin=self.mux.stdout, stdout=subproc.PIPE, stderr=modlog)
+    def _start(self):
+        """ Start up odr-dabmux and odr-dabmod, called from the event loop """
 
-            # Allow odr-dabmux to receive SIGPIPE if odr-dabmod exits
-            self.mux.stdout.close()
-            # Send odr-dabmux's data to odr-dabmod. This operation blocks until the process in killed
-            self.mod.communicate()[0]
+        self._timer = None
+        if not self._running:
+            return
 
-            # Wait 4 seconds for sockets to unbind
-            time.sleep(4)
+        # Start up odr-dabmux DAB multiplexer
+        self._muxlog.write('\n'.encode('utf-8'))
+        self._muxlog.flush()
+        self.mux = self._procmgr.spawn((f'{self.binpath}/odr-dabmux', self.muxcfg),
+                                       on_exit=self._mux_exited, sched=self._mux_sched,
+                                       stdout=subproc.PIPE, stderr=self._muxlog)
+        self._started('odr-dabmux')
 
-            # Maintain a failcounter to automatically exit the loop if we are unable to bring the server up
-            failcounter += 1
+        # odr-dabmux starts out with its configured state again
+        if self._on_mux_start is not None:
+            self._on_mux_start()
 
-        if self._running:
-            logger.error(f'Terminating DAB server. odr-dabmux and/or odr-dabmod failed to start {failcounter} times')
+        # Start up odr-dabmod DAB modulator, which is fed odr-dabmux's output
+        self._modlog.write('\n'.encode('utf-8'))
+        self._modlog.flush()
+        self.mod = self._procmgr.spawn((f'{self.binpath}/odr-dabmod', self.modcfg),
+                                       on_exit=self._exited, sched=self._mod_sched,
+                                       stdin=self.mux.stdout, stdout=subproc.DEVNULL, stderr=self._modlog)
+        self._started('odr-dabmod')
 
-        modlog.close()
-        muxlog.close()
+        # Allow odr-dabmux to receive SIGPIPE if odr-dabmod exits
+        self.mux.stdout.close()
 
-    def join(self):
-        """ Terminate the DAB server thread """
+    def _started(self, name:str):
+        """ Update the cached state of a process that was just started """
+
+        state = self._procstate[name]
+
+        if state['started'] is not None:
+            state['restarts'] += 1
+
+        state['running'] = True
+        state['started'] = time.monotonic()
+
+    def _mux_exited(self, proc:subproc.Popen):
+        """ odr-dabmux exited, odr-dabmod will exit too and take care of the restart """
+
+        if proc is self.mux:
+            self._procstate['odr-dabmux']['running'] = False
+            self._procstate['odr-dabmux']['last_exit'] = proc.returncode
+
+    def _exited(self, proc:subproc.Popen):
+        """ odr-dabmod exited (odr-dabmux exiting causes odr-dabmod to exit too), schedule a restart """
+
+        if proc is not self.mod:
+            return
+
+        self._procstate['odr-dabmod']['running'] = False
+        self._procstate['odr-dabmod']['last_exit'] = proc.returncode
+
+        if not self._running:
+            return
+
+        # Make sure odr-dabmux doesn't linger around
+        if self.mux.poll() is None:
+            self.mux.terminate()
 
-        if not self.is_alive():
+        # Maintain a failcounter to automatically stop if we are unable to bring the server up
+        self._failcounter += 1
+        if self._failcounter >= 4:
+            logger.error(f'Terminating DAB server. odr-dabmux and/or odr-dabmod failed to start {self._failcounter} times')
+            self._running = False
             return
 
+        # Wait 4 seconds for sockets to unbind
+        self._timer = self._procmgr.loop.call_later(self.RESTART_DELAY, self._start)
+
+    def _stop(self):
+        """ Cancel a pending restart and signal odr-dabmux and odr-dabmod to terminate, called from the event loop """
+
         self._running = False
 
-        # Terminate the modulator and multiplexer
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        for proc in (self.mod, self.mux):
+            if proc is not None and proc.poll() is None:
+                proc.terminate()
+
+    def join(self):
+        """ Terminate the DAB server """
+
+        if self._muxlog is None:
+            return
+
+        self._procmgr.call(self._stop)
+
+        # Wait for the modulator and multiplexer to terminate
         if self.mod is not None:
-            self.mod.terminate()
             try:
                 self.mod.wait(timeout=5)
             except subproc.TimeoutExpired as e:
                 logger.error(f'Unable to terminate odr-dabmod. {e}')
 
         if self.mux is not None:
-            self.mux.terminate()
             try:
                 self.mux.wait(timeout=5)
             except subproc.TimeoutExpired as e:
                 logger.error(f'Unable to terminate odr-dabmux. {e}')
 
+        self._modlog.close()
+        self._muxlog.close()
+        self._muxlog = self._modlog = None
+
         # Remove the fifo file that was used as output
         os.remove(self.output)
 
-        super().join()
+    def is_alive(self) -> bool:
+        """ Check if the DAB server is (still) being supervised """
+
+        return self._running
+
+    def status(self) -> dict:
+        """
+        Retrieve the cached state of odr-dabmux and odr-dabmod.
+
+        Return a dict with per process whether it is running, its uptime, restart count and last exit code
+        """
+
+        now = time.monotonic()
+        status = {}
+
+        for name, state in self._procstate.items():
+            status[name] = {
+                'running': state['running'],
+                'uptime': now - state['started'] if state['running'] else None,
+                'restarts': state['restarts'],
+                'last_exit': state['last_exit']
+            }
+
+        return status
 
 class DABServer():
     """ DABServer and CAPWatcher management class """
@@ -146,7 +258,8 @@ class DABServer():
         self.config = None
 
         self._zmq = zmq.Context()
-        self.zmqsock = None
+        self.muxctl = None
+        self.telemetry = None
 
         atexit.register(self._deinit)
 
@@ -160,16 +273,33 @@ class DABServer():
         # Create a temporary fifo for IPC with ODR-DabMux over ZMQ
         self._zmqsock_path = utils.create_fifo()
 
-        # Load ODR-DabMux configuration into memory
-        self.config = ODRMuxConfig(self._zmqsock_path, self._streams)
+        # Load ODR-DabMux configuration into memory, stats_port is only used if it doesn't set the management port
+        statsport = self._srvcfg['dab'].getint('stats_port', fallback=0)
+        self.config = ODRMuxConfig(self._zmqsock_path, self._streams, statsport)
         cfgfile = self._srvcfg['dab']['mux_config']
         if not self.config.load(cfgfile):
             logger.error(f'Unable to load DAB multiplexer configuration: {cfgfile}')
             return False
 
+        # Connect to the multiplexer ZMQ socket, and mirror the announcements and the labels and PTYs of the services
+        # that are changed during alarm announcements
+        self.muxctl = MuxControlClient(self._zmq, f'ipc://{self._zmqsock_path}')
+        self.muxctl.track([(name, 'active') for name, _ in self.config.cfg.ensemble.announcements])
+        self.muxctl.track([(s, p) for s, p, _ in utils.relabel_params(self._srvcfg, self.config.cfg, False)])
+        self.muxctl.start_refresh()
+
+        # Collect telemetry from the multiplexer if its management server is enabled, and use it to tune the buffering
+        # of all ZMQ inputs
+        managementport = self.config.managementport
+        if managementport > 0:
+            tuning = AdaptiveBuffering(self.muxctl, self.config)
+            self.telemetry = MuxTelemetry(self._zmq, managementport, self.muxctl, self.config, self._streams,
+                                          tuning.update)
+            self.telemetry.start()
+
         # Start the DABServer thread
         try:
-            self._odr = ODRServer(self._srvcfg)
+            self._odr = ODRServer(self._srvcfg, self._streams.procmgr, self.muxctl.invalidate)
             self._odr.start()
         except:
             err = 'Unable to start DAB server thread.'
@@ -187,13 +317,9 @@ class DABServer():
 
         # TODO check if multiplexer and modulator were successfully started
 
-        # Connect to the multiplexer ZMQ socket
-        self.zmqsock = self._zmq.socket(zmq.REQ)
-        self.zmqsock.connect(f'ipc://{self._zmqsock_path}')
-
         # Start a watcher thread to process messages from the CAPServer
         try:
-            self._watcher = CAPWatcher(self._srvcfg, self._q, self.zmqsock, self._streams, self.config)
+            self._watcher = CAPWatcher(self._srvcfg, self._q, self.muxctl, self._streams, self.config)
             self._watcher.start()
         except:
             err = 'Unable to start CAPWatcher thread.'
@@ -217,9 +343,13 @@ class DABServer():
         if self.config is None:
             return
 
+        if self.telemetry is not None:
+            self.telemetry.stop()
+            self.telemetry = None
+
         # Remove the ZMQ ODR-DabMux IPC FIFO
-        if self.zmqsock is not None:
-            self.zmqsock.disconnect(f'ipc://{self._zmqsock_path}')
+        if self.muxctl is not None:
+            self.muxctl.close()
             utils.remove_fifo(self._zmqsock_path)
 
         if self._odr is not None:
@@ -239,16 +369,23 @@ class DABServer():
         # Start the server back up
         return self.start()
 
-    def status(self) -> tuple[bool, bool, bool, bool]:
-        """ Retrieve the status of the (DABServer, CAPWatcher, DAB Multiplexer, DAB Modulator) in a tuple """
+    def status(self) -> tuple[bool, bool, bool, bool, dict]:
+        """
+        Retrieve the status of the (DABServer, CAPWatcher, DAB Multiplexer, DAB Modulator) in a tuple, followed by a
+        dict with the uptime, restart count, last exit code and resource usage of odr-dabmux and odr-dabmod
+        """
 
         if self.config is None:
-            return (False, False, False, False)
+            return (False, False, False, False, {})
 
         server = self._odr.is_alive() if self._odr is not None else None
         watcher = self._watcher.is_alive() if self._watcher is not None else None
-        # FIXME check these properly
-        mux = subproc.run(('pgrep', 'odr-dabmux'), capture_output=True).returncode == 0
-        mod = subproc.run(('pgrep', 'odr-dabmod'), capture_output=True).returncode == 0
 
-        return (server, watcher, mux, mod)
+        if self._odr is None:
+            return (server, watcher, False, False, {})
+
+        procs = self._odr.status()
+        for name, proc in (('odr-dabmux', self._odr.mux), ('odr-dabmod', self._odr.mod)):
+            procs[name]['proc'] = self._streams.procmgr.stats.get(proc.pid) if proc is not None else None
+
+        return (server, watcher, procs['odr-dabmux']['running'], procs['odr-dabmod']['running'], procs)
@@ -21,33 +21,37 @@
 
 import configparser                         # Python INI file parser
 import logging                              # Logging facilities
-import multiprocessing                      # Multiprocessing support (for running data streams in the background)
 import time                                 # For sleep support
 from dab.audio import DABAudioStream        # DAB audio (DAB/DAB+) stream
+from dab.data import DABDataEngine          # Engine that runs all DAB data streams
 from dab.data import DABDataStream          # DAB data (packet mode) stream
+from dab.procmgr import ODRProcessManager   # Owner of all odr-* processes
 from dab.streamscfg import StreamsConfig    # streams.ini config
 import utils
 
 logger = logging.getLogger('server.dab')
 
 class DABStreams():
-    """ Class that manages individual DAB stream threads """
+    """ Class that manages individual DAB streams """
 
     def __init__(self, srvcfg: configparser.ConfigParser):
-        # Set spawn instead of fork, locks up dialog otherwise (TODO find out why)
-        multiprocessing.set_start_method('spawn')
-
         self._srvcfg = srvcfg
 
+        # All odr-* processes (of both the streams and the DABServer) are owned by a single process manager
+        self.procmgr = ODRProcessManager()
+
+        # All data streams are run from the event loop of the process manager
+        self.dataengine = DABDataEngine(self.procmgr)
+
         self.config = StreamsConfig()
         self.streams = []
 
     def _start_stream(self, stream, index, output, streamcfg):
         try:
             if streamcfg['output_type'] == 'data':
-                thread = DABDataStream(self._srvcfg, stream, streamcfg, output)
+                thread = DABDataStream(self._srvcfg, stream, streamcfg, output, self.dataengine)
             else:
-                thread = DABAudioStream(self._srvcfg, stream, streamcfg, output)
+                thread = DABAudioStream(self._srvcfg, stream, streamcfg, output, self.procmgr)
 
             thread.start()
 
@@ -64,6 +68,11 @@ class DABStreams():
             except Exception as e:
                 raise Exception(e)
 
+    def _stop_stream(self, t):
+        """ Stop a single stream """
+
+        t.join()
+
     def start(self):
         # Load streams.ini configuration into memory
         cfgfile = self._srvcfg['dab']['stream_config']
@@ -126,15 +135,7 @@ class DABStreams():
 
                 # Stop the old stream
                 if t is not None:
-                    t.join()
-
-                    # Attempt terminating if joining wasn't successful (in case of a process)
-                    if t.is_alive() and isinstance(t, multiprocessing.Process):
-                        t.terminate()
-
-                        # A last resort
-                        if t.is_alive():
-                            t.kill()
+                    self._stop_stream(t)
 
                     # Allow sockets some time to unbind (FIXME needed?)
                     time.sleep(4)
@@ -152,15 +153,7 @@ class DABStreams():
 
         for _, t, _, o in self.streams:
             if t is not None:
-                t.join()
-
-                # Attempt terminating if joining wasn't successful (in case of a process)
-                if t.is_alive() and isinstance(t, multiprocessing.Process):
-                    t.terminate()
-
-                    # A last resort
-                    if t.is_alive():
-                        t.kill()
+                self._stop_stream(t)
 
             if o is not None:
                 utils.remove_fifo(o)
@@ -178,10 +171,20 @@ class DABStreams():
         return self.start()
 
     def status(self):
+        """
+        Retrieve the status of all streams as a list of (name, alive, health) tuples.
+
+        For audio streams, health contains the state, restart count, mean time to recovery and resource usage ('proc')
+        of odr-audioenc and odr-padenc. For data streams health contains the number of frames and padding packets sent.
+        """
+
         streams = []
 
         if self.config is not None:
             for s, t, _, _ in self.streams:
-                streams.append((s, t.is_alive() if t is not None else None))
+                if t is None:
+                    streams.append((s, None, {}))
+                else:
+                    streams.append((s, t.is_alive(), t.status()))
 
         return streams
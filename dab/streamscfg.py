@@ -19,10 +19,11 @@
 #    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
 #
 
-import configparser # Python INI file parser
-import copy         # For saving/restoring Config objects
-import os           # For file I/O
-import logging      # Logging facilities
+import collections.abc  # For the SectionOverlay mapping
+import configparser     # Python INI file parser
+import io               # For taking snapshots of the config
+import os               # For file I/O
+import logging          # Logging facilities
 
 logger = logging.getLogger('server.dab')
 
@@ -53,17 +54,27 @@ class StreamsConfig():
         return True
 
     def save(self):
-        """ Save a temporary copy of the current config file in memory """
+        """
+        Save a snapshot of the current config in memory.
 
-        self._oldcfg = copy.deepcopy(self.cfg)
+        The snapshot is the config as it would be written to the file, the ConfigParser itself isn't copied
+        """
+
+        # The ConfigParser mixes the DEFAULT section into every section, so its options can't be copied section by
+        # section without losing track of which options were set explicitly (possibly to their default value)
+        buf = io.StringIO()
+        self.cfg.write(buf)
+
+        self._oldcfg = buf.getvalue()
 
     def restore(self):
-        """ Restore the temporary copy made with save() """
+        """ Restore the snapshot made with save() """
 
         if self._oldcfg is None:
             return
 
-        self.cfg = self._oldcfg
+        self.cfg = configparser.ConfigParser()
+        self.cfg.read_string(self._oldcfg)
         self._oldcfg = None
 
     def write(self):
@@ -71,3 +82,44 @@ class StreamsConfig():
 
         with open(self._cfgfile, 'w') as f:
             self.cfg.write(f)
+
+class SectionOverlay(collections.abc.Mapping):
+    """
+    Read-only view of a stream's config section with some of its options replaced, used for stream replacement.
+
+    Only the replaced options are stored, all other options are looked up in the section itself.
+    """
+
+    def __init__(self, section, **options):
+        # Don't stack overlays, replace the options of the existing overlay instead
+        if isinstance(section, SectionOverlay):
+            options = {**section._options, **options}
+            section = section._section
+
+        self._section = section
+        self._options = options
+
+        self.name = section.name
+
+    def __getitem__(self, option):
+        try:
+            return self._options[option]
+        except KeyError:
+            return self._section[option]
+
+    def __iter__(self):
+        yield from self._options
+        yield from (option for option in self._section if option not in self._options)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def getboolean(self, option, fallback=None):
+        value = self.get(option)
+        if value is None:
+            return fallback
+
+        try:
+            return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+        except KeyError:
+            raise ValueError(f'Not a boolean: {value}')
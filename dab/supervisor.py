@@ -0,0 +1,149 @@
+#
+#    CFNS - Rijkswaterstaat CIV, Delft © 2022 <cfns@rws.nl>
+#
+#    Copyright 2022 Bastiaan Teeuwen <bastiaan@mkcl.nl>
+#
+#    This file is part of cap-dab-server
+#
+#    cap-dab-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    cap-dab-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import random                           # For adding jitter to the restart delay
+import time                             # For monotonic timestamps
+
+class RestartSupervisor():
+    """
+    Restart policy for a single supervised child process.
+
+    Failed processes are restarted with an exponential backoff (with jitter). A crash-loop score is kept that increases
+    on every failure and decays over time, if the score exceeds the threshold the process is only retried every
+    max_delay seconds until it becomes stable again.
+    """
+
+    # Health states
+    STATE_STOPPED   = 'stopped'
+    STATE_RUNNING   = 'running'
+    STATE_BACKOFF   = 'backoff'
+    STATE_CRASHLOOP = 'crashloop'
+
+    def __init__(self, base_delay:float=2, max_delay:float=120, jitter:float=0.2, stable_time:float=30,
+                 crashloop_threshold:float=5, crashloop_halflife:float=300):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.stable_time = stable_time
+        self.crashloop_threshold = crashloop_threshold
+        self.crashloop_halflife = crashloop_halflife
+
+        self.state = self.STATE_STOPPED
+        self.restarts = 0
+        self.failures = 0
+        self.last_exit = None
+
+        self._attempt = 0
+        self._score = 0.0
+        self._scored_at = time.monotonic()
+        self._started_at = None
+        self._failed_at = None
+        self._recoveries = 0
+        self._downtime = 0.0
+
+    def _crashloop_score(self, now:float) -> float:
+        """ Get the crash-loop score, decayed exponentially since the last failure """
+
+        return self._score * 0.5 ** ((now - self._scored_at) / self.crashloop_halflife)
+
+    def started(self):
+        """ Register a (re)start of the process """
+
+        now = time.monotonic()
+
+        if self._started_at is None and self.last_exit is not None:
+            self.restarts += 1
+
+        # Keep track of how long it took us to recover from the last failure
+        if self._failed_at is not None:
+            self._downtime += now - self._failed_at
+            self._recoveries += 1
+            self._failed_at = None
+
+        self._started_at = now
+        self.state = self.STATE_RUNNING
+
+    def exited(self, returncode:int) -> float:
+        """
+        Register the exit of the process.
+
+        Return the number of seconds to wait before restarting the process
+        """
+
+        now = time.monotonic()
+
+        self.last_exit = returncode
+
+        # Start over with the backoff if the process was running stable for a while
+        if self._started_at is not None and now - self._started_at >= self.stable_time:
+            self._attempt = 0
+        self._started_at = None
+
+        # A clean exit (i.e. end of an input file) isn't a failure, restart after the base delay without backing off
+        if returncode == 0:
+            self.state = self.STATE_BACKOFF
+            return self.base_delay
+
+        self.failures += 1
+        self._failed_at = now
+
+        self._score = self._crashloop_score(now) + 1
+        self._scored_at = now
+
+        if self._score >= self.crashloop_threshold:
+            self.state = self.STATE_CRASHLOOP
+            delay = self.max_delay
+        else:
+            self.state = self.STATE_BACKOFF
+            delay = min(self.max_delay, self.base_delay * 2 ** self._attempt)
+            self._attempt += 1
+
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def stopped(self):
+        """ Register that the process was stopped on purpose """
+
+        self.state = self.STATE_STOPPED
+        self._started_at = None
+        self._failed_at = None
+
+    def mttr(self) -> float | None:
+        """ Return the mean time to recovery in seconds, or None if the process never had to recover """
+
+        if self._recoveries == 0:
+            return None
+
+        return self._downtime / self._recoveries
+
+    def status(self) -> dict:
+        """ Retrieve the health of the supervised process as a dict """
+
+        now = time.monotonic()
+
+        return {
+            'state': self.state,
+            'restarts': self.restarts,
+            'failures': self.failures,
+            'last_exit': self.last_exit,
+            'uptime': now - self._started_at if self._started_at is not None else None,
+            'mttr': self.mttr(),
+            'crashloop_score': round(self._crashloop_score(now), 2)
+        }
@@ -0,0 +1,228 @@
+#
+#    CFNS - Rijkswaterstaat CIV, Delft © 2022 <cfns@rws.nl>
+#
+#    Copyright 2022 Bastiaan Teeuwen <bastiaan@mkcl.nl>
+#
+#    This file is part of cap-dab-server
+#
+#    cap-dab-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    cap-dab-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import collections                          # For the ring buffer of samples
+import json                                 # For parsing the statistics of ODR-DabMux
+import logging                              # Logging facilities
+import threading                            # For collecting samples in the background
+import time                                 # For timestamping samples
+import zmq                                  # For querying the ODR-DabMux management server
+from dab.muxctl import MuxControlClient     # odr-dabmux remote control
+from dab.streams import DABStreams          # DAB streams manager
+
+logger = logging.getLogger('server.dab')
+
+class MuxTelemetry():
+    """
+    Background collector of odr-dabmux telemetry.
+
+    The input statistics (buffer fill, underruns and overruns) of all subchannels are periodically retrieved from the
+    management server of odr-dabmux (managementport in dabmux.mux), together with the state of all announcements from
+    the remote control. Samples are kept in a fixed-size ring buffer, the oldest samples are dropped first.
+
+    odr-dabmux only keeps statistics of inputs that are buffered (i.e. ZMQ inputs), other subchannels don't show up.
+    """
+
+    # Interval at which to collect a sample in seconds
+    INTERVAL = 2
+
+    # Number of samples to keep, 10 minutes worth
+    SAMPLES = 300
+
+    # Maximum time to wait for a reply from the management server in seconds
+    TIMEOUT = 1.0
+
+    def __init__(self, context:zmq.Context, port:int, muxctl:MuxControlClient, muxcfg, streams:DABStreams,
+                 on_sample=None):
+        self._context = context
+        self._on_sample = on_sample
+        self._endpoint = f'tcp://127.0.0.1:{port}'
+        self._muxctl = muxctl
+        self._muxcfg = muxcfg
+        self._streams = streams
+
+        self._sock = None
+        self._samples = collections.deque(maxlen=self.SAMPLES)
+        self._connected = False
+
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+        self._connected = False
+
+    def _query(self) -> dict | None:
+        """ Retrieve the statistics of all inputs from the management server, return None if it didn't respond """
+
+        if self._sock is None:
+            self._sock = self._context.socket(zmq.DEALER)
+            self._sock.setsockopt(zmq.LINGER, 0)
+            self._sock.connect(self._endpoint)
+
+        try:
+            self._sock.send_multipart([b'', b'values'])
+
+            if self._sock.poll(int(self.TIMEOUT * 1000), zmq.POLLIN) == 0:
+                # Recreate the socket, so a late reply isn't received as the reply to the next query
+                self._disconnect()
+                return None
+
+            reply = self._sock.recv_multipart()
+        except zmq.ZMQError as e:
+            logger.warning(f'Unable to query the ODR-DabMux management server. {e}')
+            self._disconnect()
+            return None
+
+        try:
+            values = json.loads(reply[-1].decode())['values']
+        except (UnicodeDecodeError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f'Invalid statistics received from the ODR-DabMux management server. {e}')
+            return None
+
+        self._connected = True
+        return values
+
+    def _inputs(self, values:dict, previous:dict | None) -> dict:
+        """ Convert the input statistics into per-subchannel samples """
+
+        inputs = {}
+
+        for name, value in values.items():
+            try:
+                stat = value['inputstat']
+            except (KeyError, TypeError):
+                continue
+
+            # The buffer fill is reported in bytes, convert it to 24 ms frames (3 bytes per kbit/s)
+            cfg = self._streams.getcfg(name)
+            try:
+                frame_size = int(cfg['bitrate']) * 3
+            except (KeyError, TypeError, ValueError):
+                frame_size = None
+
+            def frames(fill):
+                return fill / frame_size if frame_size and fill is not None else None
+
+            sample = {
+                'state': stat.get('state'),
+                'min_fill': frames(stat.get('min_fill')),
+                'max_fill': frames(stat.get('max_fill')),
+                'underruns': stat.get('num_underruns', 0),
+                'overruns': stat.get('num_overruns', 0)
+            }
+
+            # The counters are reset when odr-dabmux restarts
+            prev = previous['inputs'].get(name) if previous is not None else None
+            for counter in ('underruns', 'overruns'):
+                if prev is None or sample[counter] < prev[counter]:
+                    sample[f'new_{counter}'] = 0
+                else:
+                    sample[f'new_{counter}'] = sample[counter] - prev[counter]
+
+            if sample['new_underruns'] > 0 and (prev is None or prev['new_underruns'] == 0):
+                logger.warning(f'{name}: input buffer of ODR-DabMux is running empty '
+                               f'({sample["new_underruns"]} underruns in {self.INTERVAL}s)')
+
+            inputs[name] = sample
+
+        return inputs
+
+    def _announcements(self) -> dict:
+        """ Retrieve the state of all announcements, answered from the mirror of the remote control """
+
+        announcements = {}
+
+        for name, _ in self._muxcfg.cfg.ensemble.announcements:
+            state = self._muxctl.get(name, 'active')
+            announcements[name] = bool(int(state)) if state is not None and state.isdigit() else None
+
+        return announcements
+
+    def sample(self):
+        """ Collect a single sample and add it to the ring buffer, on_sample(sample) is called with the new sample """
+
+        values = self._query()
+        previous = self.latest()
+
+        sample = {
+            'time': time.time(),
+            'inputs': self._inputs(values, previous) if values is not None else {},
+            'announcements': self._announcements()
+        }
+        self._samples.append(sample)
+
+        if self._on_sample is not None:
+            try:
+                self._on_sample(sample)
+            except Exception as e:
+                logger.error(f'Unable to process telemetry sample. {e}')
+
+    def _run(self):
+        while not self._stopped.wait(self.INTERVAL):
+            self.sample()
+
+        self._disconnect()
+
+    def start(self):
+        """ Start collecting samples in the background """
+
+        if self._thread is not None:
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='mux-telemetry', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop collecting samples """
+
+        if self._thread is None:
+            return
+
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def latest(self) -> dict | None:
+        """ Return the most recent sample, or None if no samples were collected yet """
+
+        try:
+            return self._samples[-1]
+        except IndexError:
+            return None
+
+    def samples(self) -> list:
+        """ Return all samples in the ring buffer, oldest first """
+
+        return list(self._samples)
+
+    def status(self) -> dict:
+        """ Retrieve the state of the collector and the most recent sample as a dict """
+
+        return {
+            'connected': self._connected,
+            'samples': len(self._samples),
+            'latest': self.latest()
+        }
@@ -25,7 +25,10 @@ import pyttsx3                      # Text To Speech engine frontend
 import queue                        # Queue for passing data to the DAB processing thread
 import subprocess as subproc        # For spawning ffmpeg to convert mp3 to wav
 import threading                    # Threading support (for running Mux and Mod in the background)
+import cap.encoding as encoding     # On-air encoding of CAP messages
 from cap.parser import CAPParser    # CAP XML parser (internal)
+from dab.data import airtime        # For calculating the data carousel cycle time
+from dab.data import frame_message  # For framing the messages written to the data FIFO
 import utils
 
 logger = logging.getLogger('server.dab')
@@ -43,11 +46,11 @@ class CAPWatcher(threading.Thread):
         'nl-NL': ('Bericht {num}', 'Einde bericht {num}', 'Er volgt nu een herhaling')
     }
 
-    def __init__(self, srvcfg, q, zmqsock, streams, muxcfg):
+    def __init__(self, srvcfg, q, muxctl, streams, muxcfg):
         threading.Thread.__init__(self)
 
         self.q = q
-        self.zmqsock = zmqsock
+        self.muxctl = muxctl
         self.streams = streams
         self.muxcfg = muxcfg.cfg
         self.srvcfg = srvcfg
@@ -55,6 +58,7 @@ class CAPWatcher(threading.Thread):
         self.alarm = srvcfg['warning'].getboolean('alarm')
         self.replace = srvcfg['warning'].getboolean('replace')
         self.data = srvcfg['warning'].getboolean('data')
+        self.data_encoding = srvcfg['warning'].get('data_encoding', encoding.ENCODING_RAW)
         self.alarmpath = f'{srvcfg["general"]["logdir"]}/streams/sub-alarm'
         self.announcement = srvcfg['warning']['announcement']
 
@@ -63,6 +67,10 @@ class CAPWatcher(threading.Thread):
         #      this way of doing things is fine for debugging, but not for production
         self.datafifo = f'{self.alarmpath}/data.fifo'
 
+        if self.data_encoding not in encoding.ENCODINGS:
+            logger.error(f'Invalid data encoding: {self.data_encoding}, falling back to {encoding.ENCODING_RAW}')
+            self.data_encoding = encoding.ENCODING_RAW
+
         self.tts = pyttsx3.init()
 
         self._announcements = []
@@ -103,20 +111,49 @@ class CAPWatcher(threading.Thread):
             logger.error('Aborting TTS broadcast, ffmpeg timed out, please report this to the developer')
             return
 
-        # Signal the alarm announcement if enabled in settings
+        # Signal the alarm announcement and relabel the services (if enabled in settings) in a single batch
+        params = []
         if self.alarm:
-            out = utils.mux_send(self.zmqsock, ('set', self.announcement, 'active', '1'))
-            logger.info(f'Activating alarm announcement, res: {out}')
+            params.append((self.announcement, 'active', '1'))
+        if self.replace:
+            params += utils.relabel_params(self.srvcfg, self.muxcfg, True)
+        self._mux_set(params, 'Activating alarm announcement')
 
         # Perform stream replacement if enabled in settings
         if self.replace:
             try:
-                utils.replace_streams(self.zmqsock, self.srvcfg, self.muxcfg, self.streams, 'file', wav)
+                utils.replace_streams(self.muxcfg, self.streams, 'file', wav)
             except Exception as e:
                 logger.error(f'Failed to perform stream replacement: {e}')
             else:
                 logger.info('Replaced audio streams with alarm stream successfully')
 
+    def _mux_set(self, params:list, action:str):
+        """ Send all announcement, label and PTY changes of an alert transition to odr-dabmux in a single batch """
+
+        if len(params) == 0:
+            return
+
+        results = self.muxctl.set_many(params)
+        for (module, param, value), res in zip(params, results):
+            if res != 'ok':
+                logger.error(f'{action}: failed to set {module} {param} to {value}, res: {res}')
+
+        logger.info(f'{action}: {results.count("ok")}/{len(params)} changes applied')
+
+    def _log_carousel(self, announcements):
+        """ Log the time it takes to send all announcements once on each data stream """
+
+        size = sum(len(a['data']) for a in announcements)
+
+        for s, _, c, _ in self.streams.streams:
+            if c['output_type'] != 'data':
+                continue
+
+            cycle = sum(airtime(a['data'], c['bitrate']) for a in announcements)
+            logger.info(f'Data carousel of {s}: {len(announcements)} messages, {size} bytes, '
+                        f'cycle time {cycle:.2f}s at {c["bitrate"]} kbit/s')
+
     def run(self):
         # Maintain a list of currently active announcements
         announcements = []
@@ -168,7 +205,7 @@ class CAPWatcher(threading.Thread):
                         for a in [*announcements, *future_announcements]:
                             with open(self.datafifo, 'wb') as outfifo:
                                 # FIXME this is dangerous because it blocks
-                                outfifo.write(a['raw'])
+                                outfifo.write(frame_message(a['data']))
                                 outfifo.flush()
 
             # Check if there's any future announcements to be activated
@@ -191,6 +228,12 @@ class CAPWatcher(threading.Thread):
                         self.q.task_done()
                         continue
 
+                    # Encode the message for the data streams once, it's repeated every second
+                    a['data'] = encoding.encode(a['raw'], self.data_encoding)
+                    if self.data:
+                        logger.info(f'CAP message {a["identifier"]}: {len(a["raw"])} bytes, '
+                                    f'{len(a["data"])} bytes {self.data_encoding} encoded')
+
                     # FIXME handle daylight savings properly
                     if a['effective'] <= datetime.datetime.now(a['effective'].tzinfo):
                         logger.info(f'New CAP message: {a["identifier"]}')
@@ -238,42 +281,44 @@ class CAPWatcher(threading.Thread):
                 break
             changed = False
 
+            if self.data:
+                self._log_carousel([*announcements, *future_announcements])
+
+            # Check if there's audio (alarm announcement and stream replacement) and data streams to be processed
+            audiostreams = sum(1 for _, _, c, _ in self.streams.streams if c['output_type'] != 'data')
+            datastreams = len(self.streams.streams) - audiostreams
+
             if len(announcements) == 0:
-                # Stop the alarm announcement and switch services back to their original streams
-                for _, _, c, _ in self.streams.streams:
-                    if c['output_type'] != 'data':
-                        if self.alarm:
-                            out = utils.mux_send(self.zmqsock, ('set', 'alarm', 'active', '0'))
-                            logger.info(f'Alarm announcement deactivated, res: {out}')
-
-                        if self.replace:
-                            try:
-                                utils.replace_streams(self.zmqsock, self.srvcfg, self.muxcfg, self.streams)
-                            except Exception as e:
-                                logger.error(f'Failed to restore original audio streams: {e}')
-                            else:
-                                logger.info('Original audio streams restored successfully')
-                    elif self.data:
-                        try:
-                            utils.replace_streams(self.zmqsock, self.srvcfg, self.muxcfg, self.streams, None, None, data_streams=True)
-                        except Exception as e:
-                            logger.error(f'Failed to restore original data streams: {e}')
-                        else:
-                            logger.info('Original data streams restored successfully')
-            elif self.alarm or self.replace:
-                # Check if there's audio (alarm announcement and stream replacement) streams to be processed
-                # FIXME do pythonic way, this is lazy
-                audiostreams = datastreams = 0
-                for _, _, c, _ in self.streams.streams:
-                    if c['output_type'] != 'data':
-                        audiostreams += 1
+                # Stop the alarm announcement and restore the service labels in a single batch
+                params = []
+                if audiostreams > 0 and self.alarm:
+                    params.append((self.announcement, 'active', '0'))
+                if (audiostreams > 0 and self.replace) or (datastreams > 0 and self.data):
+                    params += utils.relabel_params(self.srvcfg, self.muxcfg, False)
+                self._mux_set(params, 'Deactivating alarm announcement')
+
+                # Switch services back to their original streams
+                if audiostreams > 0 and self.replace:
+                    try:
+                        utils.replace_streams(self.muxcfg, self.streams)
+                    except Exception as e:
+                        logger.error(f'Failed to restore original audio streams: {e}')
                     else:
-                        datastreams += 1
-
+                        logger.info('Original audio streams restored successfully')
+                if datastreams > 0 and self.data:
+                    try:
+                        utils.replace_streams(self.muxcfg, self.streams, None, None, data_streams=True)
+                    except Exception as e:
+                        logger.error(f'Failed to restore original data streams: {e}')
+                    else:
+                        logger.info('Original data streams restored successfully')
+            elif self.alarm or self.replace:
                 # Replace data streams with a custom stream of warnings
                 if self.data and datastreams > 0:
+                    self._mux_set(utils.relabel_params(self.srvcfg, self.muxcfg, True), 'Relabelling data services')
+
                     try:
-                        utils.replace_streams(self.zmqsock, self.srvcfg, self.muxcfg, self.streams, 'fifo', self.datafifo, True)
+                        utils.replace_streams(self.muxcfg, self.streams, 'fifo', self.datafifo, True)
                     except Exception as e:
                         logger.error(f'Failed to perform stream replacement: {e}')
                     else:
@@ -42,8 +42,8 @@ from dialog import Dialog               # Beautiful dialogs using the external p
 from cap.server import CAPServer        # CAP server
 from dab.server import DABServer        # DAB server
 from dab.streams import DABStreams      # DAB streams
+from dab.telemetry import MuxTelemetry  # DAB multiplexer telemetry
 import dab.types                        # DAB types
-import utils
 
 # Max path length from limits.h
 MAX_PATH = os.pathconf('/', 'PC_PATH_MAX')
@@ -76,7 +76,8 @@ else:
                          'stream_config': f'{CONFIG_HOME}/cap-dab-server/streams.ini',
                          'odrbin_path': f'/usr/local/bin',
                          'mux_config': f'{CONFIG_HOME}/cap-dab-server/dabmux.mux',
-                         'mod_config': f'{CONFIG_HOME}/cap-dab-server/dabmod.ini'
+                         'mod_config': f'{CONFIG_HOME}/cap-dab-server/dabmod.ini',
+                         'stats_port': '12720'
                         }
     srvcfg['cap'] =     {
                          'host': '127.0.0.1',
@@ -89,6 +90,7 @@ else:
                          'alarm': 'yes',
                          'replace': 'yes',
                          'data': 'no',
+                         'data_encoding': 'raw',
                          'announcement': 'alarm',
                          'label': 'Alert',
                          'shortlabel': 'Alert',
@@ -159,6 +161,32 @@ def dab_restart(start=0, target=100):
                  width=GAUGE_WIDTH, height=GAUGE_HEIGHT)
         d.gauge_start('', height=GAUGE_HEIGHT, width=GAUGE_WIDTH, percent=target)
 
+def status_dict():
+    """ Retrieve the status of all server components as a (JSON serializable) dict """
+
+    dab_server, dab_watcher, dab_mux, dab_mod, dab_procs = dabsrv.status()
+
+    return {
+        'cap': {'server': capsrv.status()},
+        'dab': {
+            'server': dab_server,
+            'watcher': dab_watcher,
+            'mux': dab_mux,
+            'mod': dab_mod,
+            'procs': dab_procs
+        },
+        'streams': {s[0]: {'alive': s[1], **s[2]} for s in dabstreams.status()},
+        'telemetry': dabsrv.telemetry.status() if dabsrv.telemetry is not None else None
+    }
+
+def metrics_dict():
+    """ Retrieve all telemetry samples collected from the DAB multiplexer as a (JSON serializable) dict """
+
+    return {
+        'interval': MuxTelemetry.INTERVAL,
+        'samples': dabsrv.telemetry.samples() if dabsrv.telemetry is not None else []
+    }
+
 def status():
     def state(b):
         if b is None:
@@ -168,23 +196,75 @@ def status():
         elif not b:
             return '\Zb\Z1STOPPED\Zn'
 
+    def usage(proc):
+        if proc is None:
+            return '-'
+
+        cpu = f'{proc["cpu"]:.1f}%' if proc['cpu'] is not None else '-'
+        text = f'CPU: {cpu}, RSS: {proc["rss"] // 1024} KiB'
+        if proc['read_bytes'] is not None:
+            text += f', I/O: {proc["read_bytes"] // 1024}/{proc["write_bytes"] // 1024} KiB'
+
+        return text
+
+    def details(proc):
+        if proc is None:
+            return []
+
+        uptime = f'{proc["uptime"]:.0f}s' if proc['uptime'] is not None else '-'
+        last_exit = proc['last_exit'] if proc['last_exit'] is not None else '-'
+
+        return [
+            ['      state',     f'uptime: {uptime}, restarts: {proc["restarts"]}, last exit: {last_exit}'],
+            ['      usage',     usage(proc['proc'])]
+        ]
+
     while True:
         cap_server = capsrv.status()
-        dab_server, dab_watcher, dab_mux, dab_mod = dabsrv.status()
+        dab_server, dab_watcher, dab_mux, dab_mod, dab_procs = dabsrv.status()
 
         # Query the state of the various subcomponents
         states = [
             ['CAP HTTP Server', state(cap_server)],
             ['DAB Server',      state(dab_server)],
             ['DAB Multiplexer', state(dab_mux)],
-            ['DAB Modulator',   state(dab_mod)]
+            *details(dab_procs.get('odr-dabmux')),
+            ['DAB Modulator',   state(dab_mod)],
+            *details(dab_procs.get('odr-dabmod'))
         ]
 
+        # Input buffer statistics of the multiplexer, per subchannel
+        sample = dabsrv.telemetry.latest() if dabsrv.telemetry is not None else None
+        inputs = sample['inputs'] if sample is not None else {}
+
         # Insert the state of DAB Streams in separate rows (after 'DAB Streams')
         streamstates = dabstreams.status()
         states.insert(2, ['DAB Streams', str(len(streamstates))])
         for s in streamstates:
-            states.insert(3, [f'  - {s[0]}', state(s[1])])
+            rows = [[f'  - {s[0]}', state(s[1])]]
+
+            # Add the health and resource usage of the stream's processes
+            for proc, health in s[2].items():
+                if health is None:
+                    continue
+
+                if 'state' in health:
+                    mttr = f'{health["mttr"]:.1f}s' if health['mttr'] is not None else '-'
+                    rows.append([f'      {proc}', f'{health["state"]} (restarts: {health["restarts"]}, MTTR: {mttr})'])
+                if 'frames' in health:
+                    rows.append([f'      {proc}', f'frames: {health["frames"]}, packets: {health["packets"]}, '
+                                                 f'padding: {health["padding_packets"]}, '
+                                                 f'queued: {health["pending"]}'])
+                if 'proc' in health:
+                    rows.append([f'      {proc} usage', usage(health['proc'])])
+
+            stat = inputs.get(s[0])
+            if stat is not None:
+                fill = f'{stat["min_fill"]:.0f}-{stat["max_fill"]:.0f}' if stat['min_fill'] is not None else '-'
+                rows.append(['      mux input', f'{stat["state"]} (fill: {fill} frames, '
+                                                f'underruns: {stat["underruns"]}, overruns: {stat["overruns"]})'])
+
+            states[3:3] = rows
 
         # Format the states list into columns
         sstr = ''
@@ -515,8 +595,6 @@ The \ZbService ID\Zn is a 3 character, unique, hexadecimal identifier for a serv
                         break
 
             def announcements(service):
-                dabsrv.config.cfg.services[service].announcements
-
                 menu = [(k, v, bool(dabsrv.config.cfg.services[service].announcements.getboolean(k))) for k, v in dab.types.ANNOUNCEMENT_TYPES.items()]
 
                 code, tags = d.checklist('', title=f'Announcements - {localtitle}', choices=menu)
@@ -558,7 +636,6 @@ The \ZbService ID\Zn is a 3 character, unique, hexadecimal identifier for a serv
                     elif ' ' in service:
                         _error('Identifier cannot contain spaces.')
                     else:
-                        dabsrv.config.cfg.services[service]
                         dabsrv.config.cfg.components[f'comp-{service}']['service'] = service
 
                         # Configure required components
@@ -643,8 +720,6 @@ The \ZbService ID\Zn is a 3 character, unique, hexadecimal identifier for a serv
             i = 0
             for key, value in dabsrv.config.cfg.services:
                 label = str(dabsrv.config.cfg.services[key]['label']) # TODO CHANGE
-                if label == '':
-                    del dabsrv.config.cfg.services[key]['label']
 
                 menu.insert(i, (key, label))
                 i += 1
@@ -806,7 +881,10 @@ def settings():
              'dabmux.mux config file path'),
 
             ('ODR-DabMod config',   8,  1, srvcfg['dab']['mod_config'],       8,  20, 64, MAX_PATH, 0,
-             'dabmod.ini config file path')
+             'dabmod.ini config file path'),
+
+            ('ODR-DabMux stats',    9,  1, srvcfg['dab'].get('stats_port', '0'), 9, 20, 8, 5,     0,
+             'Local port of the ODR-DabMux management server used for telemetry, 0 to disable')
             ])
 
         if code == Dialog.OK:
@@ -820,7 +898,8 @@ def settings():
                                  'stream_config':elems[4],
                                  'odrbin_path':  elems[5],
                                  'mux_config':   elems[6],
-                                 'mod_config':   elems[7]
+                                 'mod_config':   elems[7],
+                                 'stats_port':   elems[8]
                                 }
             with open(server_config, 'w') as config_file:
                 srvcfg.write(config_file)
@@ -936,8 +1015,9 @@ def announce():
 
             subch = str(announcement.subchannel)
 
-            # query the state of the announcement
-            state = bool(int(utils.mux_send(dabsrv.zmqsock, ('get', name, 'active'))))
+            # query the state of the announcement, this is answered from the mirror of the multiplexer state
+            state = dabsrv.muxctl.get(name, 'active')
+            state = state is not None and state.isdigit() and bool(int(state))
 
             menu.append((f'{"* " if state else "  "}{name}', f'Cluster {cluster}: {supported} (Switch to "{subch}")'))
 
@@ -957,10 +1037,10 @@ Announcements prefixed with a * are currently active.
             # Check if the announcement is active or not
             out = ''
             if tag[0] == '*':
-                out = utils.mux_send(dabsrv.zmqsock, ('set', announcement, 'active', '0'))
+                out = dabsrv.muxctl.set(announcement, 'active', '0')
                 logger.info(f'Manually deactivating {announcement} announcement, res: {out}')
             else:
-                out = utils.mux_send(dabsrv.zmqsock, ('set', announcement, 'active', '1'))
+                out = dabsrv.muxctl.set(announcement, 'active', '1')
                 logger.info(f'Manually activating {announcement} announcement, res: {out}')
 
             # Check if the announcement was successfully activated
@@ -1040,6 +1120,10 @@ def main():
                  width=GAUGE_WIDTH, height=GAUGE_HEIGHT)
         d.gauge_start('', height=GAUGE_HEIGHT, width=GAUGE_WIDTH, percent=66)
 
+    # Expose the server status on the CAP HTTP server
+    capsrv.status_callback = status_dict
+    capsrv.metrics_callback = metrics_dict
+
     d.gauge_update(100, 'Ready!', update_text=True)
     time.sleep(0.5)
     d.gauge_stop()
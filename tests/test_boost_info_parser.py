@@ -0,0 +1,226 @@
+#
+#    CFNS - Rijkswaterstaat CIV, Delft © 2022 <cfns@rws.nl>
+#
+#    Copyright 2022 Bastiaan Teeuwen <bastiaan@mkcl.nl>
+#
+#    This file is part of cap-dab-server
+#
+#    cap-dab-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    cap-dab-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import glob                             # For finding the example configs
+import os                               # For file paths
+import stat                             # For checking file modes
+import tempfile                         # For writing configs to a temporary directory
+import unittest                         # Unit testing framework
+from unittest import mock               # For checking that unchanged configs aren't written
+import dab.boost_info_parser
+from dab.boost_info_parser import BoostInfoParser
+
+# Example configs of ODR-DabMux (doc/example.mux and doc/advanced.mux)
+EXAMPLES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), '*.mux')))
+
+def _example(name:str) -> BoostInfoParser:
+    parser = BoostInfoParser()
+    parser.read(os.path.join(os.path.dirname(__file__), name))
+    return parser
+
+def _parse(string:str) -> BoostInfoParser:
+    parser = BoostInfoParser()
+    parser.parse(string)
+    return parser
+
+def _nodes(tree) -> list:
+    """ Convert a tree into nested lists of (key, value, children), to compare trees """
+
+    return [(key, node.value, _nodes(node)) for key, node in tree]
+
+class RoundTripTest(unittest.TestCase):
+    def test_examples(self):
+        self.assertGreater(len(EXAMPLES), 0)
+
+        for path in EXAMPLES:
+            with self.subTest(os.path.basename(path)):
+                parser = BoostInfoParser()
+                parser.read(path)
+                output = str(parser.getRoot())
+
+                reparsed = _parse(output)
+                self.assertEqual(_nodes(reparsed.getRoot()), _nodes(parser.getRoot()))
+                self.assertEqual(str(reparsed.getRoot()), output)
+
+    def test_example_values(self):
+        cfg = _example('example.mux').getRoot()
+
+        self.assertEqual(str(cfg.general['managementport']), '12720')
+        self.assertEqual(str(cfg.ensemble['ecc']), '0xe1')
+        self.assertEqual(str(cfg.ensemble['local-time-offset']), 'auto')
+        self.assertEqual(str(cfg.ensemble['label']), 'OpenDigitalRadio')
+        self.assertEqual(str(cfg.subchannels['sub-fu']['inputfile']), 'tcp://*:9000')
+        self.assertEqual(str(cfg.outputs['stdout']), 'fifo:///dev/stdout?type=raw')
+        self.assertEqual([key for key, _ in cfg.services], ['srv-fu', 'srv-ri'])
+
+    def test_nested(self):
+        cfg = _example('advanced.mux').getRoot()
+
+        self.assertTrue(cfg.ensemble.announcements['test_announcement'].flags.getboolean('Traffic'))
+        self.assertEqual(str(cfg.services['srv-fu'].announcements['clusters']), '1,2')
+        self.assertEqual(str(cfg.components['comp-lu'].packet['address']), '1000')
+
+class EscapeTest(unittest.TestCase):
+    def test_read(self):
+        cfg = _parse('a "tab\\tx"\nb "q\\"uo\\\\te"\nc "it\\\'s"\nd "nul\\0"\ne "\\q"\n').getRoot()
+
+        self.assertEqual(cfg['a'].value, 'tab\tx')
+        self.assertEqual(cfg['b'].value, 'q"uo\\te')
+        self.assertEqual(cfg['c'].value, 'it\'s')
+        self.assertEqual(cfg['d'].value, 'nul\0')
+
+        # Unknown escape sequences are kept as is
+        self.assertEqual(cfg['e'].value, '\\q')
+
+    def test_write(self):
+        config = 'a "tab\\tx"\nb "q\\"uo\\\\te"\nc "line\\nbreak"'
+
+        self.assertEqual(str(_parse(config).getRoot()).replace('   ', ''), config)
+
+    def test_round_trip(self):
+        cfg = _parse('').getRoot()
+        values = ['tab\tx', 'q"uo\\te', 'it\'s', 'line\nbreak\r', '\\q', '\0\a\b\f\v', 'plain; {not} a comment']
+        for i, value in enumerate(values):
+            cfg[f'key{i}'] = value
+
+        reparsed = _parse(str(cfg)).getRoot()
+        self.assertEqual([node.value for _, node in reparsed], values)
+
+        # Single values are converted to strings as is
+        self.assertEqual(str(reparsed['key0']), 'tab\tx')
+
+    def test_errors(self):
+        with self.assertRaises(Exception):
+            _parse('a {\n}\n}\n')
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.cfg = _example('advanced.mux').getRoot()
+        self.original = str(self.cfg)
+
+    def _edit(self):
+        """ Edit the config like the TUI does: change, add and remove services, announcements and options """
+
+        self.cfg.services['srv-fu']['label'] = 'Changed'
+        self.cfg.services['srv-fu'].announcements['Warning'] = 'true'
+        self.cfg.services['srv-new']['label'] = 'New'
+        del self.cfg.services['srv-ri']
+        del self.cfg.subchannels['sub-fu']['zmq-buffer']
+        self.cfg.subchannels['sub-fu']['zmq-buffer'] = '80'
+        self.cfg.ensemble.announcements['test_announcement'].flags['Warning'] = 'true'
+        del self.cfg['outputs']
+
+    def test_rollback(self):
+        self.cfg.snapshot()
+        self._edit()
+        self.assertNotEqual(str(self.cfg), self.original)
+
+        self.cfg.rollback()
+        self.assertEqual(str(self.cfg), self.original)
+
+        # Changes after a rollback aren't recorded anymore
+        self.cfg.services['srv-fu']['label'] = 'Changed'
+        self.cfg.rollback()
+        self.assertEqual(str(self.cfg.services['srv-fu']['label']), 'Changed')
+
+    def test_release(self):
+        self.cfg.snapshot()
+        self._edit()
+        edited = str(self.cfg)
+
+        self.cfg.release()
+        self.cfg.rollback()
+        self.assertEqual(str(self.cfg), edited)
+
+
+    def test_lookups(self):
+        # Looking up keys that don't exist doesn't change the tree
+        for _, service in self.cfg.services:
+            service.announcements.getboolean('Alarm')
+            str(service['country'])
+            service.missing.nested['key']
+
+        self.assertEqual(str(self.cfg), self.original)
+
+
+class WriteTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'dabmux.mux')
+
+        self.parser = _example('advanced.mux')
+        self.cfg = self.parser.getRoot()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _read(self) -> str:
+        with open(self.path) as f:
+            return f.read()
+
+    def test_write(self):
+        self.assertTrue(self.parser.write(self.path))
+        self.assertEqual(self._read(), str(self.cfg))
+        self.assertEqual(os.listdir(self.tmpdir.name), ['dabmux.mux'])
+
+        # The file is replaced, not overwritten in place
+        inode = os.stat(self.path).st_ino
+        self.cfg.ensemble['label'] = 'Changed'
+        self.assertTrue(self.parser.write(self.path))
+        self.assertEqual(self._read(), str(self.cfg))
+        self.assertNotEqual(os.stat(self.path).st_ino, inode)
+
+    def test_unchanged(self):
+        self.parser.write(self.path)
+        mtime = os.stat(self.path).st_mtime_ns
+
+        with mock.patch.object(dab.boost_info_parser, '_create_temp', side_effect=AssertionError('written')):
+            self.assertFalse(self.parser.write(self.path))
+
+        self.assertEqual(os.stat(self.path).st_mtime_ns, mtime)
+
+    def test_large(self):
+        # More chunks than are joined into a single block
+        for i in range(BoostInfoParser.BLOCK_CHUNKS):
+            self.cfg.services[f'srv-{i}']['label'] = f'Service "{i}"'
+
+        self.parser.write(self.path)
+        self.assertEqual(self._read(), str(self.cfg))
+
+    def test_empty(self):
+        parser = BoostInfoParser()
+        self.assertTrue(parser.write(self.path))
+        self.assertEqual(self._read(), '')
+
+    def test_mode(self):
+        umask = os.umask(0o027)
+        try:
+            self.parser.write(self.path)
+        finally:
+            os.umask(umask)
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o640)
+
+        # Existing files keep their mode
+        os.chmod(self.path, 0o600)
+        self.cfg.ensemble['label'] = 'Changed'
+        self.parser.write(self.path)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
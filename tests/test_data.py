@@ -0,0 +1,322 @@
+#
+#    CFNS - Rijkswaterstaat CIV, Delft © 2022 <cfns@rws.nl>
+#
+#    Copyright 2022 Bastiaan Teeuwen <bastiaan@mkcl.nl>
+#
+#    This file is part of cap-dab-server
+#
+#    cap-dab-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    cap-dab-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
+#
+
+from configparser import ConfigParser   # For configuring data streams
+import random                           # For generating test data
+import struct                           # For reading CRCs from packets
+import tempfile                         # For creating input FIFOs
+import threading                        # For writing input FIFOs in the background
+import time                             # For waiting on the event loop
+import unittest                         # Unit testing framework
+from unittest import mock               # For collecting the messages read by a data source
+import dab.data as data
+from dab.procmgr import ODRProcessManager
+import utils
+
+def _crc16_reference(data:bytes) -> int:
+    """ Bitwise CRC-16-CCITT as specified in ETSI EN 300 401 V2.1.1 Section 5.3.2.3, the original implementation """
+
+    crc = 0xFFFF
+
+    for e in data:
+        x = (crc >> 8) ^ e
+        x = (x ^ (x >> 4))
+        crc = ((crc << 8) & 0xFFFF) ^ ((x << 12) & 0xFFFF) ^ ((x << 5) & 0xFFFF) ^ (x & 0xFFFF)
+
+    return ~crc & 0xFFFF
+
+class CRC16Test(unittest.TestCase):
+    def test_vectors(self):
+        # CRC-16-CCITT with an initial value of 0xFFFF, inverted (also known as CRC-16/GENIBUS)
+        self.assertEqual(data._crc16_int(b''), 0x0000)
+        self.assertEqual(data._crc16_int(b'123456789'), 0xD64E)
+        self.assertEqual(data._crc16_int(b'\x00'), 0x1E0F)
+
+    def test_reference(self):
+        rng = random.Random(0)
+
+        for length in (*range(300), 1024, 5000, 8191):
+            buf = rng.randbytes(length)
+            self.assertEqual(data._crc16_int(buf), _crc16_reference(buf), f'length {length}')
+
+    def test_buffers(self):
+        buf = bytearray(random.Random(1).randbytes(100))
+
+        self.assertEqual(data._crc16_int(memoryview(buf)[10:60]), _crc16_reference(buf[10:60]))
+
+    def test_residue(self):
+        # A data group including its CRC always results in the same residue, this is how receivers check it
+        for group in data.MSCDataGroupBuilder().build(bytes(20000)):
+            self.assertEqual(data._crc16_int(group), 0xE2F0)
+
+    def test_packets(self):
+        builder = data.PacketBuilder(1000)
+        packets = builder.build(bytes(range(250)))
+        offset = 0
+
+        while offset < len(packets):
+            length = data.PacketBuilder.PACKET_LENGTH[packets[offset] >> 6]
+            packet = packets[offset:offset + length]
+
+            self.assertEqual(struct.unpack('!H', packet[-2:])[0], _crc16_reference(packet[:-2]))
+            offset += length
+
+def _gf_mul(a:int, b:int) -> int:
+    """ Multiply two elements of GF(2^8) bit by bit, with the field generator polynomial x^8+x^4+x^3+x^2+1 """
+
+    product = 0
+
+    while b > 0:
+        if b & 1:
+            product ^= a
+        b >>= 1
+
+        a <<= 1
+        if a & 0x100:
+            a ^= 0x11D
+
+    return product
+
+def _gf_pow(a:int, n:int) -> int:
+    result = 1
+    for _ in range(n):
+        result = _gf_mul(result, a)
+
+    return result
+
+def _gf_inv(a:int) -> int:
+    return _gf_pow(a, 254)
+
+def _rs_syndromes(codeword:bytes) -> list:
+    """ Calculate the 16 syndromes of a shortened RS(204, 188) codeword, all are 0 for a valid codeword """
+
+    syndromes = []
+
+    for j in range(16):
+        root = _gf_pow(2, j)
+        s = 0
+        for b in codeword:
+            s = _gf_mul(s, root) ^ b
+        syndromes.append(s)
+
+    return syndromes
+
+def _rs_correct_erasures(codeword:bytearray, erasures:list):
+    """ Correct up to 16 bytes at known positions of a shortened RS(204, 188) codeword in place """
+
+    for pos in erasures:
+        codeword[pos] = 0
+
+    # Solve sum(e_i * x_i^j) = S_j for the erased values e_i, with x_i the field element of each position
+    syndromes = _rs_syndromes(codeword)
+    locators = [_gf_pow(2, len(codeword) - 1 - pos) for pos in erasures]
+    rows = [[_gf_pow(x, j) for x in locators] + [syndromes[j]] for j in range(len(erasures))]
+
+    # Gauss-Jordan elimination, addition and subtraction are both XOR
+    for col in range(len(erasures)):
+        pivot = next(r for r in range(col, len(rows)) if rows[r][col] != 0)
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+
+        inv = _gf_inv(rows[col][col])
+        rows[col] = [_gf_mul(v, inv) for v in rows[col]]
+
+        for r in range(len(rows)):
+            if r != col and rows[r][col] != 0:
+                factor = rows[r][col]
+                rows[r] = [v ^ _gf_mul(factor, p) for v, p in zip(rows[r], rows[col])]
+
+    for pos, row in zip(erasures, rows):
+        codeword[pos] = row[-1]
+
+class PacketFECTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(2)
+
+        # Fill the ADT with 24-byte packets
+        self.fec = data.PacketFEC()
+        self.packets = [rng.randbytes(24) for _ in range(data.PacketFEC.ADT_SIZE // 24)]
+        for packet in self.packets[:-1]:
+            self.assertIsNone(self.fec.add(packet))
+        self.fec_packets = self.fec.add(self.packets[-1])
+
+        self.adt = b''.join(self.packets)
+
+    def _rs_table(self) -> list:
+        """ Read the parity bytes of every row from the FEC packets, as a receiver would (column by column) """
+
+        rs = b''.join(packet[2:] for packet in self.fec_packets)
+        rows = data.PacketFEC.ROWS
+
+        return [bytes(rs[col * rows + row] for col in range(data.PacketFEC.PARITY)) for row in range(rows)]
+
+    def _codeword(self, adt:bytes, rs_table:list, row:int) -> bytearray:
+        return bytearray(adt[row::data.PacketFEC.ROWS] + rs_table[row])
+
+    def test_packets(self):
+        self.assertEqual(len(self.fec_packets), data.PacketFEC.PACKETS)
+
+        for i, packet in enumerate(self.fec_packets):
+            self.assertEqual(len(packet), 24)
+            self.assertEqual(((packet[0] & 0b11) << 8) | packet[1], data.PacketFEC.ADDRESS)
+            self.assertEqual((packet[0] >> 4) & 0b11, i % 4)
+            self.assertEqual((packet[0] >> 2) & 0b11, 0b10 if i == 0 else 0b01 if i == 8 else 0b00)
+
+        # The RS data table is 192 bytes, the rest of the last packet is padding
+        self.assertEqual(self.fec_packets[-1][-6:], bytes(6))
+
+    def test_codewords(self):
+        rs_table = self._rs_table()
+
+        for row in range(data.PacketFEC.ROWS):
+            self.assertEqual(_rs_syndromes(self._codeword(self.adt, rs_table, row)), [0] * 16, f'row {row}')
+
+    def test_recover(self):
+        rs_table = self._rs_table()
+
+        # Lose 4 whole packets (96 bytes, spread over all rows as the ADT is filled column by column)
+        lost = set()
+        for index in (3, 4, 50, 93):
+            lost.update(range(index * 24, (index + 1) * 24))
+
+        corrupted = bytearray(self.adt)
+        for pos in lost:
+            corrupted[pos] ^= 0xFF
+
+        recovered = bytearray(corrupted)
+        for row in range(data.PacketFEC.ROWS):
+            codeword = self._codeword(corrupted, rs_table, row)
+            erasures = sorted((pos - row) // data.PacketFEC.ROWS for pos in lost if pos % data.PacketFEC.ROWS == row)
+            self.assertLessEqual(len(erasures), 16)
+
+            _rs_correct_erasures(codeword, erasures)
+            recovered[row::data.PacketFEC.ROWS] = codeword[:data.PacketFEC.COLUMNS]
+
+        self.assertNotEqual(bytes(corrupted), self.adt)
+        self.assertEqual(bytes(recovered), self.adt)
+
+class MessageDeframerTest(unittest.TestCase):
+    def setUp(self):
+        self.messages = [b'<alert>A</alert>', b'', b'<alert>B</alert>' * 100]
+        self.stream = b''.join(data.frame_message(m) for m in self.messages)
+
+    def test_chunks(self):
+        # Headers and messages split at every possible position
+        for size in (1, 2, 3, 5, 17, len(self.stream)):
+            deframer = data.MessageDeframer(4096)
+            messages = []
+            for i in range(0, len(self.stream), size):
+                messages += deframer.feed(self.stream[i:i + size])
+
+            self.assertEqual(messages, self.messages, f'chunk size {size}')
+            self.assertEqual(deframer.reset(), 0)
+
+    def test_oversized(self):
+        deframer = data.MessageDeframer(100)
+
+        messages = []
+        dropped = []
+        for i in range(0, len(self.stream), 7):
+            messages += deframer.feed(self.stream[i:i + 7])
+            dropped += deframer.dropped
+
+        self.assertEqual(messages, self.messages[:2])
+        self.assertEqual(dropped, [len(self.messages[2])])
+
+        # The next message is read again after skipping the oversized one
+        self.assertEqual(deframer.feed(data.frame_message(b'C')), [b'C'])
+
+    def test_incomplete(self):
+        deframer = data.MessageDeframer(4096)
+
+        self.assertEqual(deframer.feed(self.stream[:10]), [])
+        self.assertEqual(deframer.reset(), 6)
+        self.assertEqual(deframer.feed(self.stream), self.messages)
+
+class ParseSourcesTest(unittest.TestCase):
+    def _parse(self, **options) -> list:
+        streamcfg = ConfigParser()
+        streamcfg['data'] = {'input_type': 'fifo', 'input': '/tmp/cap.fifo', **options}
+
+        return data.parse_sources(streamcfg['data'])
+
+    def test_defaults(self):
+        self.assertEqual(self._parse(), [(1000, 'fifo', '/tmp/cap.fifo', 1, data.DABDataSource.MAX_MESSAGE_SIZE)])
+
+    def test_sources(self):
+        sources = self._parse(max_message_size='4096', sources='1001 fifo /tmp/a.fifo 2 65536\n1002 file "/tmp/b c"')
+
+        self.assertEqual(sources, [
+            (1000, 'fifo', '/tmp/cap.fifo', 1, 4096),
+            (1001, 'fifo', '/tmp/a.fifo', 2, 65536),
+            (1002, 'file', '/tmp/b c', 1, data.DABDataSource.MAX_MESSAGE_SIZE)
+        ])
+
+    def test_invalid(self):
+        for options in ({'max_message_size': '0'}, {'sources': '1001 fifo /tmp/a.fifo 1 0'},
+                        {'sources': '1001 fifo /tmp/a.fifo 1 1 1'}, {'sources': '1000 fifo /tmp/a.fifo'}):
+            with self.assertRaises(Exception, msg=options):
+                self._parse(**options)
+
+class DABDataSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.procmgr = ODRProcessManager()
+        self.engine = data.DABDataEngine(self.procmgr)
+
+        self.input = f'{self.tmpdir.name}/input.fifo'
+
+        srvcfg = ConfigParser()
+        srvcfg['general'] = {'logdir': self.tmpdir.name}
+        streamcfg = ConfigParser()
+        streamcfg['data'] = {'input_type': 'fifo', 'input': self.input, 'bitrate': '16'}
+
+        # Nothing reads the output, the stream keeps waiting for odr-dabmux to open it
+        output = utils.create_fifo(f'{self.tmpdir.name}/output.fifo')
+
+        self.stream = data.DABDataStream(srvcfg, 'data', streamcfg['data'], output, self.engine)
+
+    def tearDown(self):
+        self.stream.join()
+        self.procmgr.stop()
+        self.tmpdir.cleanup()
+
+    def test_back_to_back(self):
+        alerts = [f'<alert>{i}</alert>'.encode() for i in range(10)]
+        messages = []
+
+        def writer():
+            # Every message is written by a writer of its own, like CAPWatcher does
+            for alert in alerts:
+                with open(self.input, 'wb') as f:
+                    f.write(data.frame_message(alert))
+
+        with mock.patch.object(self.stream.sources[0], '_message', side_effect=messages.append):
+            self.stream.start()
+
+            thread = threading.Thread(target=writer, daemon=True)
+            thread.start()
+            thread.join(5)
+
+            deadline = time.monotonic() + 5
+            while len(messages) < len(alerts) and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        self.assertEqual([bytes(m) for m in messages], alerts)
@@ -0,0 +1,49 @@
+#
+#    CFNS - Rijkswaterstaat CIV, Delft © 2022 <cfns@rws.nl>
+#
+#    Copyright 2022 Bastiaan Teeuwen <bastiaan@mkcl.nl>
+#
+#    This file is part of cap-dab-server
+#
+#    cap-dab-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    cap-dab-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os                               # For locating the CAP fixtures
+import unittest                         # Unit testing framework
+import cap.encoding as encoding
+
+def _fixture(name:str) -> bytes:
+    with open(os.path.join(os.path.dirname(__file__), name), 'rb') as f:
+        return f.read()
+
+class EncodingTest(unittest.TestCase):
+    def setUp(self):
+        self.alerts = [_fixture('waarschuwing.xml'), _fixture('controlebericht-en.xml')]
+
+    def test_round_trip(self):
+        for alert in self.alerts:
+            for method in (encoding.ENCODING_RAW, encoding.ENCODING_DEFLATE):
+                self.assertEqual(encoding.decode(encoding.encode(alert, method)), alert)
+
+    def test_concatenated(self):
+        data = b''.join(encoding.encode(alert, encoding.ENCODING_DEFLATE) for alert in self.alerts)
+
+        with self.assertRaises(ValueError):
+            encoding.decode(data)
+
+    def test_truncated(self):
+        data = encoding.encode(self.alerts[0], encoding.ENCODING_DEFLATE)
+
+        with self.assertRaises(ValueError):
+            encoding.decode(data[:len(data) // 2])
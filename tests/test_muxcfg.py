@@ -0,0 +1,126 @@
+#
+#    CFNS - Rijkswaterstaat CIV, Delft © 2022 <cfns@rws.nl>
+#
+#    Copyright 2022 Bastiaan Teeuwen <bastiaan@mkcl.nl>
+#
+#    This file is part of cap-dab-server
+#
+#    cap-dab-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    cap-dab-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
+#
+
+from configparser import ConfigParser   # For configuring streams
+import os                               # For file paths
+import shutil                           # For copying the example configs
+import tempfile                         # For writing configs to a temporary directory
+import unittest                         # Unit testing framework
+from dab.muxcfg import ODRMuxConfig
+
+class _Streams():
+    """ Streams of the multiplexer, as DABStreams has them once started """
+
+    def __init__(self, streamscfg:ConfigParser):
+        self.streams = [(s, None, streamscfg[s], f'/tmp/{s}.fifo') for s in streamscfg.sections()]
+
+    def getcfg(self, stream:str):
+        for s, _, c, _ in self.streams:
+            if s == stream:
+                return c
+
+        return None
+
+class PacketComponentTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cfgfile = os.path.join(self.tmpdir.name, 'dabmux.mux')
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'advanced.mux'), self.cfgfile)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _load(self, sources:str) -> dict:
+        """ Load advanced.mux with sub-lu sending the packet addresses in sources, return the address per component """
+
+        streamscfg = ConfigParser()
+        streamscfg['sub-lu'] = {
+            'output_type': 'data',
+            'input_type': 'fifo',
+            'input': '/tmp/lu.fifo',
+            'bitrate': '16',
+            'protection_profile': 'EEP_A',
+            'protection': '3',
+            'packet_address': '1000',
+            'sources': sources
+        }
+
+        muxcfg = ODRMuxConfig('/tmp/dabmux.zmq', _Streams(streamscfg))
+        self.assertTrue(muxcfg.load(self.cfgfile))
+
+        components = {}
+        for name, component in muxcfg.cfg.components:
+            if str(component['subchannel']) == 'sub-lu':
+                self.assertEqual(str(component['service']), 'srv-lu')
+                self.assertEqual(str(component['type']), '59')
+                self.assertEqual(str(component['packet']['datagroup']), 'true')
+                components[name] = str(component['packet']['address'])
+
+        return components
+
+    def test_configured(self):
+        self.assertEqual(self._load('1001 fifo /tmp/traffic.fifo'), {'comp-lu': '1000', 'comp-lu-traffic': '1001'})
+
+    def test_generated(self):
+        components = self._load('1001 fifo /tmp/traffic.fifo\n1002 file /tmp/weather.bin')
+        self.assertEqual(components, {'comp-lu': '1000', 'comp-lu-traffic': '1001', 'comp-lu-1002': '1002'})
+
+        # Generated components are kept once written
+        self.assertEqual(self._load('1001 fifo /tmp/traffic.fifo\n1002 file /tmp/weather.bin'), components)
+
+    def test_reassigned(self):
+        self.assertEqual(self._load('1002 fifo /tmp/weather.fifo'), {'comp-lu': '1000', 'comp-lu-traffic': '1002'})
+
+    def test_removed(self):
+        self.assertEqual(self._load(''), {'comp-lu': '1000'})
+
+class ManagementPortTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cfgfile = os.path.join(self.tmpdir.name, 'dabmux.mux')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _load(self, statsport:int) -> ODRMuxConfig:
+        muxcfg = ODRMuxConfig('/tmp/dabmux.zmq', _Streams(ConfigParser()), statsport)
+        self.assertTrue(muxcfg.load(self.cfgfile))
+
+        return muxcfg
+
+    def test_configured(self):
+        # advanced.mux enables the management server on port 12720
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'advanced.mux'), self.cfgfile)
+
+        self.assertEqual(self._load(0).managementport, 12720)
+        self.assertEqual(self._load(12721).managementport, 12720)
+
+    def test_absent(self):
+        self.assertEqual(self._load(12721).managementport, 12721)
+
+        # Once written, the port is kept
+        self.assertEqual(self._load(0).managementport, 12721)
+
+    def test_disabled(self):
+        self.assertEqual(self._load(0).managementport, 0)
+
+        # A disabled management server isn't written, so it's enabled once stats_port is set
+        self.assertEqual(self._load(12721).managementport, 12721)
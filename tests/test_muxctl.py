@@ -0,0 +1,104 @@
+#
+#    CFNS - Rijkswaterstaat CIV, Delft © 2022 <cfns@rws.nl>
+#
+#    Copyright 2022 Bastiaan Teeuwen <bastiaan@mkcl.nl>
+#
+#    This file is part of cap-dab-server
+#
+#    cap-dab-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    cap-dab-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import unittest                         # Unit testing framework
+from dab.muxctl import MuxControlClient
+
+class _Client(MuxControlClient):
+    """ Client answering commands from a dict of parameters instead of odr-dabmux, with a hook in between batches """
+
+    def __init__(self):
+        super().__init__(None, None)
+
+        self.params = {}
+        self.sent = []
+        self.after_batch = None
+
+    def batch(self, batch:list, retries:int=0) -> list:
+        replies = []
+
+        for cmd, module, param, *value in batch:
+            self.sent.append((cmd, module, param, *value))
+
+            if (module, param) not in self.params:
+                # The 'fail' frame and the error message are joined into a single reply
+                replies.append('fail' + 'Unknown parameter')
+            elif cmd == 'set':
+                self.params[module, param] = value[0]
+                replies.append('ok')
+            else:
+                replies.append(self.params[module, param])
+
+        # Simulate another thread getting its command in right after this batch, before the mirror is updated
+        hook, self.after_batch = self.after_batch, None
+        if hook is not None:
+            hook()
+
+        return replies
+
+class MirrorTest(unittest.TestCase):
+    def setUp(self):
+        self.client = _Client()
+        self.client.params['alarm', 'active'] = '0'
+
+    def test_skip_unchanged(self):
+        self.client.set('alarm', 'active', '1')
+        self.client.set('alarm', 'active', '1')
+
+        self.assertEqual(self.client.sent, [('set', 'alarm', 'active', '1')])
+        self.assertEqual(self.client.get('alarm', 'active'), '1')
+
+    def test_refresh_after_set(self):
+        # A refresh answered before a set mustn't overwrite the value of the set in the mirror
+        self.client.after_batch = lambda: self.client.set('alarm', 'active', '1')
+        self.client.track([('alarm', 'active')])
+        self.client.refresh()
+
+        self.assertEqual(self.client.get('alarm', 'active'), '1')
+
+        self.client.sent.clear()
+        self.client.set('alarm', 'active', '0')
+        self.assertEqual(self.client.sent, [('set', 'alarm', 'active', '0')])
+
+    def test_refresh_after_invalidate(self):
+        self.client.set('alarm', 'active', '1')
+
+        # odr-dabmux restarted in between, it's back at the configured state
+        def restart():
+            self.client.params['alarm', 'active'] = '0'
+            self.client.invalidate()
+
+        self.client.after_batch = restart
+        self.client.refresh()
+
+        self.assertNotIn(('alarm', 'active'), self.client._mirror)
+
+        self.client.sent.clear()
+        self.client.set('alarm', 'active', '1')
+        self.assertEqual(self.client.sent, [('set', 'alarm', 'active', '1')])
+
+    def test_failed_lookup(self):
+        self.client.track([('missing', 'active')])
+        self.client.refresh()
+
+        self.assertNotIn(('missing', 'active'), self.client._mirror)
+        self.assertTrue(self.client.get('missing', 'active').startswith('fail'))
+        self.assertNotIn(('missing', 'active'), self.client._mirror)
@@ -0,0 +1,115 @@
+#
+#    CFNS - Rijkswaterstaat CIV, Delft © 2022 <cfns@rws.nl>
+#
+#    Copyright 2022 Bastiaan Teeuwen <bastiaan@mkcl.nl>
+#
+#    This file is part of cap-dab-server
+#
+#    cap-dab-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    cap-dab-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with cap-dab-server. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import io                               # For writing configs to a string
+import unittest                         # Unit testing framework
+from dab.streamscfg import SectionOverlay, StreamsConfig
+
+STREAMS = '''
+[DEFAULT]
+bitrate = 96
+protection = 3
+
+[sub-0]
+output_type = dabplus
+input_type = gst
+input = http://127.0.0.1/stream%%20hq
+bitrate = 96
+dls_enable = yes
+
+[sub-1]
+output_type = dabplus
+input_type = file
+input = /tmp/sub-1.wav
+bitrate = 128
+'''
+
+def _write(streams:StreamsConfig) -> str:
+    out = io.StringIO()
+    streams.cfg.write(out)
+    return out.getvalue()
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.streams = StreamsConfig()
+        self.streams.cfg.read_string(STREAMS)
+        self.original = _write(self.streams)
+
+    def test_restore(self):
+        self.streams.save()
+
+        self.streams.cfg['sub-0']['input'] = 'http://127.0.0.1/alarm'
+        self.streams.cfg['sub-1']['protection'] = '1'
+        self.streams.cfg['DEFAULT']['bitrate'] = '64'
+        self.streams.cfg.remove_section('sub-1')
+        self.streams.cfg.add_section('new')
+        self.assertNotEqual(_write(self.streams), self.original)
+
+        self.streams.restore()
+        self.assertEqual(_write(self.streams), self.original)
+
+    def test_default_value(self):
+        # An option that was explicitly set to the value of the DEFAULT section has to stay in its section
+        self.streams.save()
+        self.streams.cfg['DEFAULT']['bitrate'] = '64'
+        self.streams.restore()
+
+        self.assertEqual(self.streams.cfg['DEFAULT']['bitrate'], '96')
+        self.assertEqual(_write(self.streams), self.original)
+
+        # The option isn't inherited from the DEFAULT section
+        self.streams.cfg['DEFAULT']['bitrate'] = '64'
+        self.assertEqual(self.streams.cfg['sub-0']['bitrate'], '96')
+
+    def test_restore_twice(self):
+        self.streams.save()
+        self.streams.cfg['sub-0']['bitrate'] = '64'
+        self.streams.restore()
+        self.streams.cfg['sub-0']['bitrate'] = '64'
+        self.streams.restore()
+
+        self.assertEqual(self.streams.cfg['sub-0']['bitrate'], '64')
+
+class SectionOverlayTest(unittest.TestCase):
+    def setUp(self):
+        self.streams = StreamsConfig()
+        self.streams.cfg.read_string(STREAMS)
+        self.section = self.streams.cfg['sub-0']
+
+    def test_overlay(self):
+        overlay = SectionOverlay(self.section, input_type='file', input='/tmp/alarm.wav', dls_enable='no')
+
+        self.assertEqual(overlay.name, 'sub-0')
+        self.assertEqual(overlay['input'], '/tmp/alarm.wav')
+        self.assertEqual(overlay['output_type'], 'dabplus')
+        self.assertEqual(overlay['protection'], '3')
+        self.assertFalse(overlay.getboolean('dls_enable'))
+        self.assertIsNone(overlay.getboolean('mot_enable'))
+        self.assertEqual(sorted(overlay), sorted(self.section))
+
+        # The section itself isn't changed
+        self.assertEqual(self.section['input'], 'http://127.0.0.1/stream%20hq')
+
+    def test_nested(self):
+        overlay = SectionOverlay(SectionOverlay(self.section, input='/tmp/a.wav'), input='/tmp/b.wav')
+
+        self.assertEqual(overlay['input'], '/tmp/b.wav')
+        self.assertIs(overlay._section, self.section)
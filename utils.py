@@ -20,15 +20,14 @@
 #
 
 from configparser import ConfigParser           # For parsing the server config
-import copy                                     # For creating a copy on the stream configuration
 import logging                                  # Logging facilities
 import os                                       # For file I/O
 import stat                                     # For checking if output is a FIFO
 import tempfile                                 # For creating a temporary FIFO
 import uuid                                     # For generating random FIFO file names
-import zmq                                      # For signalling (alarm) announcements to ODR-DabMux
 from dab.boost_info_parser import BoostInfoTree # For parsing the multiplexer config
 from dab.streams import DABStreams              # DAB streams
+from dab.streamscfg import SectionOverlay       # For replacing the input of a stream's configuration
 
 def logger_strict(logger:logging.Logger, strict:bool, msg:str) -> bool:
     """
@@ -91,49 +90,15 @@ def remove_fifo(path:str):
     except OSError:
         pass
 
-def mux_send(sock, msgs:tuple) -> str | None:
+def relabel_params(srvcfg:ConfigParser, muxcfg:BoostInfoTree, alarm_on:bool) -> list:
     """
-    Send a message over ZeroMQ to ODR-DabMux and wait for a reply.
+    Generate the label and PTY changes of all services which support Alarm announcements, either to the label and PTY
+    configured for Alarm announcements or back to their original label and PTY.
 
-    Return the received message
+    Return a list of (service, parameter, value) tuples, to be passed to MuxControlClient.set_many()
     """
 
-    # TODO handle failed scenario
-
-    # Perform a quick ping test
-    sock.send(b'ping')
-    data = sock.recv_multipart()
-    if data[0].decode() != 'ok':
-        return None
-
-    # Send our actual command
-    for i, part in enumerate(msgs):
-        if i == len(msgs) - 1:
-            f = 0
-        else:
-            f = zmq.SNDMORE
-
-        sock.send(part.encode(), flags=f)
-
-    # Wait for the results
-    data = sock.recv_multipart()
-    res = ''
-
-    for i, part in enumerate(data):
-        res += part.decode()
-
-    return res
-
-def replace_streams(zmqsock, srvcfg:ConfigParser, muxcfg:BoostInfoTree, streams:DABStreams, input_type:str=None, inputuri:str=None, data_streams:bool=False):
-    """
-    Replace all streams which support Alarm announcements with the specified input and input_type.
-
-    An exception is raised in case any stream wasn't able to be replaced.
-    """
-    # FIXME the way this function is integrated in the application is not very elegant
-    #       it works, but it's ugly
-
-    alarm_on = input_type is not None or inputuri is not None
+    params = []
 
     for sname, service in muxcfg.services:
         # Check if this service supports alarm announcements
@@ -155,9 +120,30 @@ def replace_streams(zmqsock, srvcfg:ConfigParser, muxcfg:BoostInfoTree, streams:
             shortlabel = str(service['shortlabel'])
             pty = str(service['pty'])
 
-        mux_send(zmqsock, ('set', sname, 'label', f'{label},{shortlabel}'))
+        params.append((sname, 'label', f'{label},{shortlabel}'))
         if pty != '':
-            mux_send(zmqsock, ('set', sname, 'pty', pty))
+            params.append((sname, 'pty', pty))
+
+    return params
+
+def replace_streams(muxcfg:BoostInfoTree, streams:DABStreams, input_type:str=None, inputuri:str=None, data_streams:bool=False):
+    """
+    Replace the streams of all services which support Alarm announcements with the specified input and input_type, or
+    restore the original streams if no input is specified. Use relabel_params() to change the labels of these services.
+
+    An exception is raised in case any stream wasn't able to be replaced.
+    """
+    # FIXME the way this function is integrated in the application is not very elegant
+    #       it works, but it's ugly
+
+    alarm_on = input_type is not None or inputuri is not None
+
+    for sname, service in muxcfg.services:
+        # Check if this service supports alarm announcements
+        # TODO also support Warning announcement
+        alarm = service.announcements.getboolean('Alarm')
+        if not alarm:
+            continue
 
         # Get the streams corresponding to this service
         for _, component in muxcfg.components:
@@ -185,14 +171,8 @@ def replace_streams(zmqsock, srvcfg:ConfigParser, muxcfg:BoostInfoTree, streams:
 
                     # TODO change DLS
                     if alarm_on:
-                        # Create a copy of the stream's config
-                        cfg = copy.deepcopy(c)
-
-                        cfg['input_type'] = input_type
-                        cfg['input'] = inputuri
-
-                        cfg['dls_enable'] = 'no'
-                        cfg['mot_enable'] = 'no'
+                        # Replace the input of the stream's config, without copying it
+                        cfg = SectionOverlay(c, input_type=input_type, input=inputuri, dls_enable='no', mot_enable='no')
 
                         # Perform stream replacement on the corresponding subchannel/stream
                         streams.setcfg(s, cfg)